@@ -14,6 +14,12 @@
 #
 # 3) Use this script to combine the layers in a new folder. The overlay will be combined with 70% opacity in this example:
 #    ./overlay-tiles.sh -b Nepal-Everest-Base -o Nepal-Everest-Overlay -d Nepal-Everest-Overlayed -p 0.7
+#
+# NOTE: stitch-osm-tiles.py can now compose the tiles itself, in parallel and for any tile layout, with the
+#       --overlay-project, --overlay-destination and --overlay-opacity options (step 3 then becomes):
+#    ./stitch-osm-tiles.py -p Nepal-Everest-Base -n 28.0344 -s 27.6501 -w 86.6698 -e 86.9479 -z 1-14 --overlay-project Nepal-Everest-Overlay --overlay-destination Nepal-Everest-Overlayed --overlay-opacity 0.7
+#       This script is kept for existing workflows. It only works with projects that use the (default) flat
+#       tile layout (see the --tile-layout option of stitch-osm-tiles.py).
 
 function get_color {
 	echo '\033['"$1"'m'
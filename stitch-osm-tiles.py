@@ -22,24 +22,37 @@ from __future__ import print_function
 
 import argparse
 import calendar
+import concurrent.futures
 import configparser
+import contextlib
 import datetime
+import hashlib
 import http.client as httplib
+import json
 import logging
 import math
 import multiprocessing
 import os
 import queue
+import random
 import re
 import shutil
+import signal
 import socket
+import sqlite3
+import struct
 import subprocess
 import sys
 import threading
 import time
-from collections import OrderedDict
+import urllib.parse
+import zlib
+from collections import OrderedDict, deque
+from fractions import Fraction
 from shutil import which
 
+import mercantile
+import numpy as np
 import pgmagick
 import progressbar
 import urllib3
@@ -62,6 +75,48 @@ __author__ = 'Vangelis Tasoulas (vangelis@tasoulas.net)'
 
 LOG = logging.getLogger('default.' + __name__)
 
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# The size of the chunks that are read from the network and written to disk when downloading tiles.
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# The layouts that can be chosen for the stitches (see stitch_layout_sizes()), and the fixed cost
+# of every stitch (spawning the stitching, encoding, thumbnail and calibration files) for the
+# stitch layout planner, expressed in megapixels of decoded tiles.
+STITCH_LAYOUTS = ['exact', 'tile-aligned', 'remainder']
+STITCH_OVERHEAD_MPIXELS = 4.0
+# The memory that is needed per stitched pixel: the RGBA numpy canvas (4 bytes), the graphicsmagick
+# image (8 bytes with a 16 bit quantum) and the encoder buffers (4 bytes).
+STITCH_BYTES_PER_PIXEL = 16
+# The output scale of the stitches is a fraction with at most this denominator, so the smallest scale is its inverse.
+OUTPUT_SCALE_DENOMINATOR = 1024
+# The stitching worker processes are replaced after this many stitches, to return the memory
+# that the image libraries keep to the system.
+STITCH_TASKS_PER_CHILD = 20
+# The address space that a stitching worker process needs besides the stitch itself
+# (interpreter, shared libraries, thread stacks and malloc arenas).
+PROCESS_BASE_ADDRESS_SPACE = 2 * 1024 * 1024 * 1024
+# The decoded tile cache of a stitching worker process (see init_stitch_process()).
+PROCESS_TILE_CACHE = None
+# Tiles of a single solid color (sea, empty overlay tiles, no-data fills) compress to a few hundred
+# bytes. Only the tiles up to this size are checked for a uniform color (see uniform_tile_index).
+UNIFORM_TILE_MAX_BYTES = 4096
+# The layouts of the downloaded tiles of a zoom level (see tile_relative_path()). The sharded layout
+# splits the tiles in folders of TILE_SHARD_SIZE columns and rows.
+TILE_LAYOUTS = ['flat', 'sharded']
+TILE_SHARD_SIZE = 256
+# The tiles of this many stitches are read ahead of the stitching workers (see tile_prefetcher), and
+# the paths of the last PREFETCH_RECENT_TILES prefetched tiles are remembered, so that the tiles on the
+# boundaries of neighbouring stitches are read only once.
+PREFETCH_STITCHES_AHEAD = 2
+PREFETCH_RECENT_TILES = 65536
+# The width (and height) of the whole web mercator (EPSG:3857) map in meters.
+WEB_MERCATOR_EXTENT = 2 * math.pi * 6378137.0
+# The paper sizes of the atlas sheets (width x height in mm, portrait), and the margin of every sheet
+# around the map, for the grid labels.
+PAPER_SIZES = OrderedDict([
+    ('A0', (841, 1189)), ('A1', (594, 841)), ('A2', (420, 594)), ('A3', (297, 420)), ('A4', (210, 297)),
+    ('A5', (148, 210)), ('letter', (215.9, 279.4)), ('legal', (215.9, 355.6)), ('tabloid', (279.4, 431.8))])
+ATLAS_MARGIN_MM = 12
+
 # ----------------------------------------------------------------------
 # Define the providers and the layer available by each provider in an ordered dict!
 #    Individual layers can override the following parameters: 'tileservers', 'extension', 'zoom_levels'
@@ -123,6 +178,9 @@ PROVIDERS = OrderedDict([
         # correct URL and not the URL itself!
         # That means that the tile_servers must be exec'ed and the function
         # dynGetTileUrl has to be called in order to get the correct URL.
+        # If the code also defines a 'dynTileMirrors' list, dynGetTileUrl must accept
+        # a 'mirror' keyword argument (one of the dynTileMirrors) and the downloader
+        # will pick the mirror for each request based on the health of the mirrors.
         'tile_servers': ["""
 def eqt(z, x, y):
     NUM_CHAR = [ '0', '1', '2', '3' ]
@@ -136,10 +194,12 @@ def eqt(z, x, y):
 
     return "".join(tn)
 
-def dynGetTileUrl(z, x, y, download_counter):
-    alts = [0, 1, 2, 3]
-    alt = download_counter % len(alts)
-    return "http://{layer}{}.ortho.tiles.virtualearth.net/tiles/{layer}{}.{ext}?g=45".format(alt, eqt(z, x, y))
+dynTileMirrors = [0, 1, 2, 3]
+
+def dynGetTileUrl(z, x, y, download_counter, mirror=None):
+    if mirror is None:
+        mirror = dynTileMirrors[download_counter % len(dynTileMirrors)]
+    return "http://{layer}{}.ortho.tiles.virtualearth.net/tiles/{layer}{}.{ext}?g=45".format(mirror, eqt(z, x, y))
         """],
         'extension': 'png',
         'zoom_levels': '1-19',
@@ -236,20 +296,23 @@ def dynGetTileUrl(z, x, y, download_counter):
         'url': 'https://www.varsom.no',
         'dyn_tile_url': True,
         'tile_servers': ["""
-def dynGetTileUrl(z, x, y, download_counter):
-    # Seems like some of the NVE download servers can't offer all the tiles (or takes too long
-    # to server them), but often choosing a different server serves the tile immediately.
-    # To get the chance to pick a different server for a given tile, apply a randint to the
-    # download_counter.
-    server = ((download_counter + random.randint(0, 3)) % 3) + 2
-    server = "" if server == 1 else server
-
-    # Valid servers are:
-    # gis.nve.no <- This one is the most terrible. Avoid it!
-    # gis2.nve.no
-    # gis3.nve.no
-    # gis4.nve.no
-    url = 'https://gis{}.nve.no/arcgis/rest/services/wmts/KastWMTS/MapServer/export?'.format(server)
+# Valid servers are:
+# gis.nve.no <- This one is the most terrible. Avoid it!
+# gis2.nve.no
+# gis3.nve.no
+# gis4.nve.no
+#
+# Seems like some of the NVE download servers can't offer all the tiles (or takes too long
+# to server them), but often choosing a different server serves the tile immediately.
+# The downloader keeps track of the health of each mirror, sends more requests to the
+# fastest ones and retries a failed tile immediately on a different mirror.
+dynTileMirrors = ['gis2.nve.no', 'gis3.nve.no', 'gis4.nve.no']
+
+def dynGetTileUrl(z, x, y, download_counter, mirror=None):
+    if mirror is None:
+        mirror = dynTileMirrors[(download_counter + random.randint(0, 3)) % len(dynTileMirrors)]
+
+    url = 'https://{}/arcgis/rest/services/wmts/KastWMTS/MapServer/export?'.format(mirror)
     # User mercantile to find the bounding box
     bbox = mercantile.bounds(x, y, z)
     params = {
@@ -571,11 +634,37 @@ def get_physical_cores():
                 else:
                     line_no += 2
 
+    # Some systems (e.g. virtual machines and ARM boards) do not report the
+    # physical ids in /proc/cpuinfo.
+    if not total_cores:
+        total_cores = multiprocessing.cpu_count()
+
     return total_cores
 
 # ----------------------------------------------------------------------
 
 
+def get_available_memory():
+    """
+    Returns the memory in bytes that is available for new processes without swapping
+    (MemAvailable in /proc/meminfo), or None if it cannot be found.
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+# ----------------------------------------------------------------------
+
+
 def instantiate_threadpool(threadpool_name, threads, worker, args):
     """
     Instantiates a threadpool with 'threads' number 'worker' threads
@@ -594,273 +683,2766 @@ def instantiate_threadpool(threadpool_name, threads, worker, args):
 # ----------------------------------------------------------------------
 
 
-class quick_regexp(object):
+def partial_path(path):
     """
-    Quick regular expression class, which can be used directly in if() statements in a perl-like fashion.
+    Returns the path of the hidden temporary file that is used while 'path' is
+    being written. The temporary file is always in the same folder as 'path',
+    so that it can be atomically renamed to 'path' with os.replace().
+    """
+    return os.path.join(os.path.dirname(path), '.{}.part'.format(os.path.basename(path)))
 
-    #### Sample code ####
-    r = quick_regexp()
-    if(r.search('pattern (test) (123)', string)):
-        print(r.groups[0]) # Prints 'test'
-        print(r.groups[1]) # Prints '123'
+# ----------------------------------------------------------------------
+
+
+def tile_relative_path(x, y, layout='flat'):
     """
-    # ----------------------------------------------------------------------
+    Returns the path of the tile x/y (without the extension), relative to the folder of its zoom level:
 
-    def __init__(self):
-        self.groups = None
-        self.matched = False
+      'flat':    X/Y
+      'sharded': X // TILE_SHARD_SIZE / X / Y // TILE_SHARD_SIZE / Y
 
-    # ----------------------------------------------------------------------
-    def search(self, pattern, string, flags=0):
-        match = re.search(pattern, string, flags)
-        if match:
-            self.matched = True
-            if match.groups():
-                self.groups = re.search(pattern, string, flags).groups()
-            else:
-                self.groups = True
-        else:
-            self.matched = False
-            self.groups = None
+    With the flat layout, a folder of a column has up to 2^zoom tiles, and the folder of the zoom level
+    up to 2^zoom columns. With the sharded layout, no folder has more than TILE_SHARD_SIZE entries.
+    """
+    if layout == 'sharded':
+        return os.path.join(str(x // TILE_SHARD_SIZE), str(x), str(y // TILE_SHARD_SIZE), str(y))
 
-        return self.matched
+    return os.path.join(str(x), str(y))
 
 # ----------------------------------------------------------------------
 
 
-class executeCommand(object):
+def parse_tile_relative_path(path, layout='flat'):
     """
-    Custom class to execute a shell command and
-    provide to the user, access to the returned
-    values
+    The reverse of tile_relative_path(): Returns the (x, y, extension) of a tile file from its path relative
+    to the folder of its zoom level, or None if the path is not the path of a tile in the given layout.
     """
+    parts = os.path.normpath(path).split(os.sep)
+    name, extension = os.path.splitext(parts[-1])
+    if len(parts) != (4 if layout == 'sharded' else 2) or not extension or not name.isdigit() or \
+            not all(part.isdigit() for part in parts[:-1]):
+        return None
 
-    def __init__(self, args=None, isUtc=True):
-        self._stdout = None
-        self._stderr = None
-        self._returncode = None
-        self._timeStartedExecution = None
-        self._timeFinishedExecution = None
-        self._args = args
-        self.isUtc = isUtc
-        if self._args != None:
-            self.execute()
+    x, y = int(parts[1 if layout == 'sharded' else 0]), int(name)
+    if tile_relative_path(x, y, layout) != os.path.join(*parts[:-1] + [name]):
+        return None
 
-    def execute(self, args=None):
-        if args != None:
-            self._args = args
+    return x, y, extension[1:]
 
-        if self._args != None:
-            if self.isUtc:
-                self._timeStartedExecution = datetime.datetime.now(tz=datetime.UTC)
-            else:
-                self._timeStartedExecution = datetime.datetime.now()
-            p = subprocess.Popen(
-                self._args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            if self.isUtc:
-                self._timeFinishedExecution = datetime.datetime.now(tz=datetime.UTC)
-            else:
-                self._timeFinishedExecution = datetime.datetime.now()
-            self._stdout, self._stderr = p.communicate()
-            self._returncode = p.returncode
-            return 1
-        else:
-            self._stdout = None
-            self._stderr = None
-            self._returncode = None
-            return 0
+# ----------------------------------------------------------------------
 
-    def getStdout(self, getList=True, decode=True):
-        """
-        Get the standard output of the executed command
 
-        getList: If True, return a list of lines.
-                 Otherwise, return the result as one string
-        """
+def png_chunks(data):
+    """
+    Generator that parses the bytes of a PNG file and yields
+    (chunk_type, chunk_data) tuples.
 
-        if getList and not decode:
-            raise BaseException("decode can only be True when getList == True")
+    Raises ValueError if data is not a PNG file.
+    """
+    if not data.startswith(PNG_SIGNATURE):
+        raise ValueError("Not a PNG file")
 
-        if getList:
-            return self._stdout.decode('utf-8').split('\n')
+    pos = len(PNG_SIGNATURE)
+    while pos + 12 <= len(data):
+        length = struct.unpack('>I', data[pos:pos + 4])[0]
+        chunk_type = data[pos + 4:pos + 8]
+        yield chunk_type, data[pos + 8:pos + 8 + length]
+        pos += length + 12
 
-        if decode:
-            return self._stdout.decode('utf-8')
-        else:
-            return self._stdout
+# ----------------------------------------------------------------------
 
-    def getStderr(self, getList=True, decode=True):
-        """
-        Get the error output of the executed command
 
-        getList: If True, return a list of lines.
-                 Otherwise, return the result as one string
-        """
+def detect_image_format(data):
+    """
+    Returns the image format ('png', 'jpg', 'gif' or 'webp') of the given image
+    bytes (only the first 12 bytes are needed), or None if the format is unknown.
+    """
+    if data.startswith(PNG_SIGNATURE):
+        return 'png'
+    elif data.startswith(b'\xff\xd8\xff'):
+        return 'jpg'
+    elif data.startswith(b'GIF87a') or data.startswith(b'GIF89a'):
+        return 'gif'
+    elif data.startswith(b'RIFF') and data[8:12] == b'WEBP':
+        return 'webp'
 
-        if getList and not decode:
-            raise BaseException("decode can only be True when getList == True")
+    return None
 
-        if getList:
-            return self._stderr.decode('utf-8').split('\n')
+# ----------------------------------------------------------------------
 
-        if decode:
-            return self._stderr.decode('utf-8')
-        else:
-            return self._stderr
 
-    def getReturnCode(self):
-        """
-        Get the exit/return status of the command
-        """
-        return self._returncode
+def verify_image_file(path):
+    """
+    Cheap integrity check of an image file that doesn't need to decode the image.
 
-    def getTimeStartedExecution(self, inMicroseconds=False):
-        """
-        Get the time when the execution started
-        """
-        if isinstance(self._timeStartedExecution, datetime.datetime):
-            if inMicroseconds:
-                return int(str(calendar.timegm(self._timeStartedExecution.timetuple())) +
-                           str(self._timeStartedExecution.strftime("%f")))
-        return self._timeStartedExecution
+    PNG files must have valid CRCs in all their chunks and end with an IEND chunk.
+    JPEG files must end with an EOI marker. Other formats are only checked for
+    their signature.
 
-    def getTimeFinishedExecution(self, inMicroseconds=False):
-        """
-        Get the time when the execution finished
-        """
-        if isinstance(self._timeFinishedExecution, datetime.datetime):
-            if inMicroseconds:
-                return int(str(calendar.timegm(self._timeFinishedExecution.timetuple())) +
-                           str(self._timeFinishedExecution.strftime("%f")))
-        return self._timeFinishedExecution
+    Returns True if the file looks complete, False otherwise.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    image_format = detect_image_format(data[:12])
+    if image_format == 'png':
+        pos = len(PNG_SIGNATURE)
+        while pos + 12 <= len(data):
+            length = struct.unpack('>I', data[pos:pos + 4])[0]
+            chunk = data[pos + 4:pos + 8 + length]
+            crc = data[pos + 8 + length:pos + 12 + length]
+            if len(crc) != 4 or struct.unpack('>I', crc)[0] != zlib.crc32(chunk) & 0xffffffff:
+                return False
+            if chunk[:4] == b'IEND':
+                return True
+            pos += length + 12
+        return False
+    elif image_format == 'jpg':
+        return data.rstrip(b'\x00\r\n ')[-2:] == b'\xff\xd9'
+
+    return image_format is not None
 
 # ----------------------------------------------------------------------
 
-########################################
-###### Configure logging behavior ######
-########################################
-# No need to change anything here
 
+def jpeg_frame_info(path):
+    """
+    Parses the markers of the JPEG file 'path' up to the start of the scan (the entropy coded
+    data is not read) and returns a dictionary with the 'width' and 'height' of the image, the
+    'mcu_width' and 'mcu_height' of its MCUs in pixels, and a 'signature' of its components,
+    sampling factors and quantization tables: JPEG files with the same signature can be joined
+    losslessly in the DCT domain.
 
-def _configureLogging(loglevel):
+    Returns None if 'path' is not a JPEG file.
     """
-    Configures the default logger.
+    with open(path, 'rb') as f:
+        if f.read(2) != b'\xff\xd8':
+            return None
+
+        info = None
+        tables = []
+        while True:
+            marker = f.read(2)
+            if len(marker) < 2 or marker[0] != 0xff:
+                return None
+            # Fill bytes before a marker
+            while marker[1] == 0xff:
+                marker = marker[1:] + f.read(1)
+            if 0xd0 <= marker[1] <= 0xd7 or marker[1] == 0x01:
+                continue
+
+            length = f.read(2)
+            if len(length) < 2:
+                return None
+            segment = f.read(struct.unpack('>H', length)[0] - 2)
+
+            if marker[1] == 0xdb:  # DQT
+                tables.append(segment)
+            elif marker[1] in (0xc0, 0xc1, 0xc2, 0xc3, 0xc5, 0xc6, 0xc7, 0xc9, 0xca, 0xcb, 0xcd, 0xce, 0xcf):  # SOFn
+                height, width, components = struct.unpack('>HHB', segment[1:6])
+                sampling = [(segment[6 + 3 * i], segment[7 + 3 * i], segment[8 + 3 * i]) for i in range(components)]
+                info = {
+                    'width': width,
+                    'height': height,
+                    'mcu_width': 8 * max(hv >> 4 for _, hv, _ in sampling),
+                    'mcu_height': 8 * max(hv & 0x0f for _, hv, _ in sampling),
+                    'signature': (marker[1], tuple(sampling)),
+                }
+            elif marker[1] == 0xda:  # SOS
+                if info is not None:
+                    info['signature'] += (tuple(sorted(tables)), )
+                return info
 
-    If the log level is set to NOTSET (0), the
-    logging is disabled
+# ----------------------------------------------------------------------
 
-    # More info here: https://docs.python.org/2/howto/logging.html
+
+def jpegtran(input_path, output_path, *options):
     """
-    numeric_log_level = getattr(logging, loglevel.upper(), None)
-    try:
-        if not isinstance(numeric_log_level, int):
-            raise ValueError()
-    except ValueError:
-        error_and_exit('Invalid log level: %s\n'
-                       '\tLog level must be set to one of the following:\n'
-                       '\t   CRITICAL <- Least verbose\n'
-                       '\t   ERROR\n'
-                       '\t   WARNING\n'
-                       '\t   INFO\n'
-                       '\t   DEBUG    <- Most verbose' % loglevel)
+    Runs the jpegtran command line utility (libjpeg-turbo >= 2.1 or IJG libjpeg >= 9) with
+    the given options on input_path, and writes the result in output_path.
+    Raises RuntimeError if jpegtran fails.
+    """
+    cmd = executeCommand(['jpegtran', '-copy', 'none'] + list(options) + ['-outfile', output_path, input_path])
+    if cmd.getReturnCode() != 0:
+        raise RuntimeError("jpegtran {} failed: {}".format(' '.join(options), cmd.getStderr(getList=False).strip()))
 
-    defaultLogger = logging.getLogger('default')
+# ----------------------------------------------------------------------
 
-    # If numeric_log_level == 0 (NOTSET), disable logging.
-    if not numeric_log_level:
-        numeric_log_level = 1000
-    defaultLogger.setLevel(numeric_log_level)
 
-    logFormatter = logging.Formatter()
+def png_chunk(chunk_type, chunk_data):
+    """
+    Returns the bytes of a complete PNG chunk (length, type, data and crc)
+    """
+    return struct.pack('>I', len(chunk_data)) + chunk_type + chunk_data + \
+        struct.pack('>I', zlib.crc32(chunk_type + chunk_data) & 0xffffffff)
 
-    defaultHandler = logging.StreamHandler()
-    defaultHandler.setFormatter(logFormatter)
+# ----------------------------------------------------------------------
 
-    defaultLogger.addHandler(defaultHandler)
 
-#######################################################
-###### Add command line options in this function ######
-#######################################################
-# Add the user defined command line arguments in this function
+def recompress_png(path, level=9):
+    """
+    Losslessly re-deflates the image data of the PNG file 'path' with the
+    given zlib compression level. The scanline filters that were chosen by the
+    original encoder are kept, so there is no need to decode the image.
 
+    The file is only replaced if the zlib header says that it was not already
+    compressed with the maximum level and the new file is actually smaller.
 
-class SmartFormatter(argparse.HelpFormatter):
+    Returns True if the file was replaced, False otherwise.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    chunks = list(png_chunks(data))
+    idat = b''.join(c[1] for c in chunks if c[0] == b'IDAT')
+    # The two most significant bits of the second byte of the zlib header (FLEVEL)
+    # are set to 3 when the stream was compressed with the slowest/best compression.
+    if len(idat) < 2 or (idat[1] >> 6) == 3:
+        return False
+
+    new_idat = zlib.compress(zlib.decompress(idat), level)
+    if len(new_idat) >= len(idat):
+        return False
+
+    new_data = [PNG_SIGNATURE]
+    idat_written = False
+    for chunk_type, chunk_data in chunks:
+        if chunk_type == b'IDAT':
+            if not idat_written:
+                new_data.append(png_chunk(b'IDAT', new_idat))
+                idat_written = True
+        else:
+            new_data.append(png_chunk(chunk_type, chunk_data))
+
+    tmp_path = partial_path(path)
+    with open(tmp_path, 'wb') as f:
+        f.write(b''.join(new_data))
+    os.replace(tmp_path, path)
+
+    return True
 
-    def _split_lines(self, text, width):
-        # this is the RawTextHelpFormatter._split_lines
-        if text.startswith('R|'):
-            return text[2:].splitlines()
-        return argparse.HelpFormatter._split_lines(self, text, width)
 # ----------------------------------------------------------------------
 
 
-def _command_Line_Options():
+def convert_tile_to_webp(path):
     """
-    Define the accepted command line arguments in this function
+    Re-encodes the tile 'path' to a lossless WebP file with the same name and the
+    .webp extension, and removes the original file.
 
-    Read the documentation of argparse for more advanced command line
-    argument parsing examples
-    http://docs.python.org/2/library/argparse.html
+    Returns the path of the WebP tile.
     """
-    parser = argparse.ArgumentParser(
-        description='OSM Tile Stitcher' + " version " + __version__, formatter_class=SmartFormatter)
-    parser.add_argument("-v", "--version",
-                        action="version", default=argparse.SUPPRESS,
-                        version=__version__,
-                        help="show program's version number and exit")
+    webp_path = '{}.webp'.format(os.path.splitext(path)[0])
+    tmp_path = partial_path(webp_path)
 
-    loggingGroupOpts = parser.add_argument_group(
-        'Logging Options', 'List of optional logging options')
-    loggingGroupOpts.add_argument("-q", "--quiet",
-                                  action="store_true",
-                                  default=False,
-                                  dest="isQuiet",
-                                  help="Disable logging in the console. Nothing will be printed.")
-    loggingGroupOpts.add_argument("--log-level",
-                                  action="store",
-                                  default="INFO",
-                                  dest="loglevel",
-                                  metavar="LOG_LEVEL",
-                                  help="LOG_LEVEL might be set to: CRITICAL, ERROR, WARNING, INFO, DEBUG. (Default: INFO)")
+    img = gmImage(path)
+    img.magick('WEBP')
+    img.defineValue('webp', 'lossless', 'true')
+    img.write('webp:{}'.format(tmp_path))
 
-    parser.add_argument("-p", "--project-folder",
-                        action="store",
-                        default='maps_project',
-                        dest="project_folder",
-                        help="Choose a project name. The downloaded data and stitching operations will all be made under this folder.\n"
-                        "Default project folder: 'maps_project'")
-    parser.add_argument("-z", "--zoom-level",
-                        action="store",
-                        dest="zoom_level",
-                        required=True,
-                        help="The tile zoom level for download. Accepts an integer or a range like '1-10' or '1,4,7-9', for downloading multiple zoom levels for the given coordinates.")
-    parser.add_argument("-w", "--long1",
-                        action="store",
-                        type=float,
-                        dest="long1",
-                        metavar="W_DEGREES",
-                        required=True,
-                        help="The western (W) longtitude of the bounding box for tile downloading. Accepted values: -180 to 179.999.")
-    parser.add_argument("-e", "--long2",
-                        action="store",
-                        type=float,
-                        dest="long2",
-                        metavar="E_DEGREES",
-                        required=True,
-                        help="The eastern (E) longtitude of the bounding box for tile downloading. Accepted values: -180 to 179.999.")
-    parser.add_argument("-n", "--lat1",
-                        action="store",
-                        type=float,
-                        dest="lat1",
-                        metavar="N_DEGREES",
-                        required=True,
-                        help="The northern (N) latitude of the bounding box for tile downloading. Accepted values: -85.05112 to 85.05113.")
-    parser.add_argument("-s", "--lat2",
-                        action="store",
-                        type=float,
+    os.replace(tmp_path, webp_path)
+    os.remove(path)
+
+    return webp_path
+
+# ----------------------------------------------------------------------
+
+
+def image_to_pixels(img):
+    """
+    Returns the pixels of the graphicsmagick Image object 'img' as a
+    (rows, columns, 4) numpy array of 8 bit RGBA values.
+    """
+    img.matte(True)
+    img.depth(8)
+    img.magick('RGBA')
+    blob = pgmagick.Blob()
+    img.write(blob)
+
+    return np.frombuffer(blob.data, dtype=np.uint8).reshape(img.rows(), img.columns(), 4)
+
+# ----------------------------------------------------------------------
+
+
+def pixels_to_image(pixels):
+    """
+    Returns a graphicsmagick Image object from a (rows, columns, 4) numpy array
+    of 8 bit RGBA values.
+    """
+    rows, columns = pixels.shape[:2]
+    blob = pgmagick.Blob(np.ascontiguousarray(pixels, dtype=np.uint8).tobytes())
+
+    return gmImage(blob, pgmagick.Geometry(columns, rows), 8, 'RGBA')
+
+# ----------------------------------------------------------------------
+
+
+def read_image_pixels(path):
+    """
+    Decodes the image file 'path' and returns its pixels as a (rows, columns, 4)
+    numpy array of 8 bit RGBA values.
+    """
+    return image_to_pixels(gmImage(path))
+
+# ----------------------------------------------------------------------
+
+
+def assemble_tiles(list_of_files, x_tiles, y_tiles, tile_width, tile_height, x_res, y_res, crop_left, crop_top, canvas=None,
+                   tile_cache=None, uniform_tiles=None):
+    """
+    Stitches tiles in an RGBA numpy canvas of x_res x y_res pixels.
+
+    list_of_files: The paths of x_tiles * y_tiles tiles, row by row (the same order that montage expects).
+    crop_left, crop_top: The pixels of the montage of all the tiles that are left out at the left and the top of the
+                         canvas. The canvas contains the pixels crop_left to crop_left + x_res - 1 and crop_top to
+                         crop_top + y_res - 1 of the montage of all the tiles.
+    canvas: An optional preallocated (y_res, x_res, 4) uint8 array to assemble the tiles in.
+    tile_cache: An optional decoded_tile_cache. The tiles that are cut by the edges of the canvas are shared with
+                the neighbouring stitches, so they are read through the cache.
+    uniform_tiles: An optional {path: (r, g, b, a)} dictionary of the tiles that have a single color. Their area
+                   in the canvas is filled with the color instead of decoding the tile.
+
+    Each tile is decoded exactly once and only the part of the tile that falls inside the canvas is copied.
+    Tiles that are completely outside the canvas are not decoded at all. Missing tiles are left transparent.
+
+    Returns the canvas.
+    """
+    x_res, y_res, crop_left, crop_top = int(x_res), int(y_res), int(crop_left), int(crop_top)
+    if canvas is None:
+        canvas = np.zeros((y_res, x_res, 4), dtype=np.uint8)
+
+    for i, path in enumerate(list_of_files):
+        # The position of the tile in the canvas
+        left = (i % x_tiles) * tile_width - crop_left
+        top = (i // x_tiles) * tile_height - crop_top
+
+        x0, y0 = max(left, 0), max(top, 0)
+        x1, y1 = min(left + tile_width, x_res), min(top + tile_height, y_res)
+        if x1 <= x0 or y1 <= y0:
+            continue
+
+        if uniform_tiles and path in uniform_tiles:
+            canvas[y0:y1, x0:x1] = uniform_tiles[path]
+            continue
+
+        if path is None or not os.path.isfile(path):
+            LOG.warning("Tile '{}' is missing. Its area in the stitch will be transparent.".format(path))
+            continue
+
+        if tile_cache is not None and (x0 > left or y0 > top or x1 < left + tile_width or y1 < top + tile_height):
+            tile = tile_cache.get(path)
+        else:
+            tile = read_image_pixels(path)
+        if tile.shape[0] != tile_height or tile.shape[1] != tile_width:
+            raise ValueError("Tile '{}' is {}x{} pixels, but {}x{} pixels were expected.".format(
+                path, tile.shape[1], tile.shape[0], tile_width, tile_height))
+
+        canvas[y0:y1, x0:x1] = tile[y0 - top:y1 - top, x0 - left:x1 - left]
+
+    return canvas
+
+# ----------------------------------------------------------------------
+
+
+def assemble_tiles_scaled(list_of_files, x_tiles, y_tiles, tile_width, tile_height, x_res, y_res, crop_left, crop_top,
+                          scale, x_offset, y_offset, tile_cache=None, uniform_tiles=None):
+    """
+    Stitches tiles in an RGBA numpy canvas of x_res x y_res pixels, like assemble_tiles(), but every tile is
+    scaled by 'scale' (a Fraction <= 1) as it is placed: each pixel of the canvas is the average of the source
+    pixels that fall in it (box filter, see scaled_pixel()). Only the sums of the canvas pixels are kept while
+    the tiles are placed, so the memory is proportional to the output pixels and not to the source pixels.
+
+    x_offset, y_offset: The output pixel of the stitched area where the canvas starts.
+    crop_left, crop_top: The source pixels of the montage of all the tiles before first_source_pixel(x_offset)
+                         and first_source_pixel(y_offset).
+
+    Returns the canvas.
+    """
+    x_res, y_res = int(x_res), int(y_res)
+    # The column/row of the canvas of every column/row of the montage of the tiles
+    columns = scaled_pixel(first_source_pixel(x_offset, scale) - crop_left + np.arange(x_tiles * tile_width), scale) - x_offset
+    rows = scaled_pixel(first_source_pixel(y_offset, scale) - crop_top + np.arange(y_tiles * tile_height), scale) - y_offset
+    column_counts = np.bincount(columns[(columns >= 0) & (columns < x_res)], minlength=x_res)
+    row_counts = np.bincount(rows[(rows >= 0) & (rows < y_res)], minlength=y_res)
+    sums = np.zeros((y_res, x_res, 4), dtype=np.uint32)
+
+    for i, path in enumerate(list_of_files):
+        left = (i % x_tiles) * tile_width
+        top = (i // x_tiles) * tile_height
+        tile_columns = columns[left:left + tile_width]
+        tile_rows = rows[top:top + tile_height]
+        inside_columns = np.flatnonzero((tile_columns >= 0) & (tile_columns < x_res))
+        inside_rows = np.flatnonzero((tile_rows >= 0) & (tile_rows < y_res))
+        if not len(inside_columns) or not len(inside_rows):
+            continue
+        c0, c1 = inside_columns[0], inside_columns[-1] + 1
+        r0, r1 = inside_rows[0], inside_rows[-1] + 1
+        tile_columns, tile_rows = tile_columns[c0:c1], tile_rows[r0:r1]
+        target = sums[tile_rows[0]:tile_rows[-1] + 1, tile_columns[0]:tile_columns[-1] + 1]
+
+        if uniform_tiles and path in uniform_tiles:
+            pixels = np.outer(np.bincount(tile_rows - tile_rows[0]), np.bincount(tile_columns - tile_columns[0]))
+            target += pixels[:, :, np.newaxis].astype(np.uint32) * np.array(uniform_tiles[path], dtype=np.uint32)
+            continue
+
+        if path is None or not os.path.isfile(path):
+            LOG.warning("Tile '{}' is missing. Its area in the stitch will be transparent.".format(path))
+            continue
+
+        if tile_cache is not None and (c0 > 0 or r0 > 0 or c1 < tile_width or r1 < tile_height):
+            tile = tile_cache.get(path)
+        else:
+            tile = read_image_pixels(path)
+        if tile.shape[0] != tile_height or tile.shape[1] != tile_width:
+            raise ValueError("Tile '{}' is {}x{} pixels, but {}x{} pixels were expected.".format(
+                path, tile.shape[1], tile.shape[0], tile_width, tile_height))
+
+        # The columns/rows of the canvas are sorted, so sum the runs of pixels that fall in the same canvas pixel.
+        column_starts = np.concatenate(([0], np.flatnonzero(np.diff(tile_columns)) + 1))
+        row_starts = np.concatenate(([0], np.flatnonzero(np.diff(tile_rows)) + 1))
+        target += np.add.reduceat(np.add.reduceat(tile[r0:r1, c0:c1], column_starts, axis=1, dtype=np.uint32),
+                                  row_starts, axis=0)
+
+    counts = np.maximum(np.outer(row_counts, column_counts), 1)[:, :, np.newaxis].astype(np.uint32)
+    return ((sums + counts // 2) // counts).astype(np.uint8)
+
+# ----------------------------------------------------------------------
+
+
+def init_stitch_process(memory_limit, tile_cache_bytes, log_level):
+    """
+    Initializer of the stitching worker processes.
+
+    memory_limit: The address space limit (RLIMIT_AS) of the process in bytes, so that a stitch that needs
+                  more memory than expected fails with a MemoryError in its own process, instead of getting
+                  the whole machine (or a random process) killed by the OOM killer. None for no limit.
+    tile_cache_bytes: The size of the decoded tile cache of the process (0 disables the cache). The pools
+                      split the cache size of --tile-cache-size between their worker processes.
+    """
+    global PROCESS_TILE_CACHE
+
+    # Ctrl+C is handled by the main process.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    if not LOG.handlers:
+        LOG.setLevel(log_level)
+        LOG.addHandler(logging.StreamHandler())
+
+    if memory_limit:
+        try:
+            import resource
+            resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+        except (ImportError, ValueError, OSError) as e:
+            LOG.debug("Could not limit the memory of the stitching process: {}".format(e))
+
+    PROCESS_TILE_CACHE = decoded_tile_cache(tile_cache_bytes) if tile_cache_bytes else None
+
+# ----------------------------------------------------------------------
+
+
+def run_counting_tile_cache(function, *args):
+    """
+    Runs function(*args) in a stitching worker process. Returns (result, counters): the result of the function,
+    and the (hits, misses, evictions) of the decoded tile cache of the process during the call (None if the
+    process has no tile cache), so that the main process can sum up the tile caches of all the workers.
+    """
+    if PROCESS_TILE_CACHE is None:
+        return function(*args), None
+
+    before = PROCESS_TILE_CACHE.counters()
+    result = function(*args)
+
+    return result, tuple(after - start for after, start in zip(PROCESS_TILE_CACHE.counters(), before))
+
+# ----------------------------------------------------------------------
+
+
+def assemble_tiles_in_memmap(canvas_path, shape, y0, y1, list_of_files, x_tiles, tile_width, tile_height,
+                             crop_left, crop_top, uniform_tiles=None):
+    """
+    Assemble a row of tiles in the rows y0 to y1 - 1 of the memory mapped canvas file 'canvas_path'
+    of the given shape. Used to assemble the rows of tiles of a memmap stitch in worker processes:
+    every process maps the same file, so the rows are written straight in the shared canvas.
+    """
+    canvas = np.memmap(canvas_path, dtype=np.uint8, mode='r+', shape=shape)
+    assemble_tiles(list_of_files, x_tiles, 1, tile_width, tile_height, shape[1], y1 - y0, crop_left, crop_top,
+                   canvas=canvas[y0:y1], tile_cache=PROCESS_TILE_CACHE, uniform_tiles=uniform_tiles)
+    canvas.flush()
+
+# ----------------------------------------------------------------------
+
+
+def uniform_color(pixels):
+    """
+    Returns the (r, g, b, a) color of the (rows, columns, 4) uint8 numpy array pixels
+    if all the pixels have the same color, or None otherwise.
+    """
+    packed = np.ascontiguousarray(pixels).view(np.uint32)
+    if (packed == packed.flat[0]).all():
+        return tuple(int(c) for c in pixels[0, 0])
+
+    return None
+
+# ----------------------------------------------------------------------
+
+
+def check_uniform_tiles(unchecked, tile_cache=None):
+    """
+    Decodes the candidate tiles {path: (size, mtime)} of uniform_tile_index.lookup() and checks them for a
+    single color. The tiles are decoded through the tile_cache (if any), so a stitcher finds the tiles that
+    are not uniform already decoded.
+
+    Returns the list of (path, size, mtime, color) entries for uniform_tile_index.record(), where color is
+    the packed RGBA color of the tile, or None if the tile is not uniform.
+    """
+    entries = []
+    for path, (size, mtime) in unchecked.items():
+        try:
+            pixels = tile_cache.get(path) if tile_cache is not None else read_image_pixels(path)
+        except RuntimeError:
+            continue
+        rgba = uniform_color(pixels)
+        entries.append((path, size, mtime, None if rgba is None else struct.unpack('>I', bytes(rgba))[0]))
+
+    return entries
+
+# ----------------------------------------------------------------------
+
+
+def uniform_tile_colors(entries):
+    """
+    Returns the {path: (r, g, b, a)} dictionary of the uniform tiles of the entries of check_uniform_tiles().
+    """
+    return {entry[0]: tuple(struct.pack('>I', entry[3])) for entry in entries if entry[3] is not None}
+
+# ----------------------------------------------------------------------
+
+
+def run_checking_uniform_tiles(function, uniform_tiles, unchecked, *args):
+    """
+    Runs function(*args, uniform_tiles=...) in a pyramid or atlas worker process, after the candidate tiles
+    'unchecked' are checked for a single color (see check_uniform_tiles()). The uniform tiles that are found
+    are added to the uniform_tiles of the call.
+
+    Returns (result, entries): the result of the function and the entries of check_uniform_tiles(), so that
+    the main process records them in its uniform_tile_index.
+    """
+    entries = check_uniform_tiles(unchecked, PROCESS_TILE_CACHE)
+    if entries:
+        uniform_tiles = dict(uniform_tiles)
+        uniform_tiles.update(uniform_tile_colors(entries))
+
+    return function(*args, uniform_tiles=uniform_tiles), entries
+
+# ----------------------------------------------------------------------
+
+
+def downsample_2x(pixels):
+    """
+    Halves the resolution of a (rows, columns, channels) uint8 numpy array by averaging
+    every 2x2 block of pixels. Odd dimensions are padded by repeating the last row/column.
+    """
+    rows, columns = pixels.shape[:2]
+    if rows % 2 or columns % 2:
+        pixels = np.pad(pixels, ((0, rows % 2), (0, columns % 2), (0, 0)), mode='edge')
+
+    p = pixels.astype(np.uint16)
+    return ((p[0::2, 0::2] + p[1::2, 0::2] + p[0::2, 1::2] + p[1::2, 1::2] + 2) // 4).astype(np.uint8)
+
+# ----------------------------------------------------------------------
+
+
+def resize_nearest(pixels, width, height):
+    """
+    Resizes a (rows, columns, channels) numpy array to width x height pixels by picking the
+    nearest pixel (no interpolation). Used to upsample small previews to their final size.
+    """
+    rows, columns = pixels.shape[:2]
+    return pixels[((np.arange(height) * 2 + 1) * rows) // (2 * height)][:, ((np.arange(width) * 2 + 1) * columns) // (2 * width)]
+
+# ----------------------------------------------------------------------
+
+
+def thumbnail_size(x_res, y_res, thumb_x_res=144, thumb_y_res=144):
+    """
+    Returns the (width, height) of the thumbnail of a x_res x y_res image. The thumbnail
+    keeps the aspect ratio of the image and fits in thumb_x_res x thumb_y_res pixels, but it is
+    never larger than the image.
+    """
+    scale = min(float(thumb_x_res) / x_res, float(thumb_y_res) / y_res, 1.0)
+
+    return max(1, int(round(x_res * scale))), max(1, int(round(y_res * scale)))
+
+# ----------------------------------------------------------------------
+
+
+def stitch_layout_sizes(total_tiles, tile_size, max_dimension, layout):
+    """
+    Split total_tiles tiles of tile_size pixels (along one axis) in stitches of at most
+    max_dimension pixels, and return the list with the size of every stitch in pixels.
+
+    layout:
+      'exact':        All the stitches have the same size, which divides the total resolution exactly.
+                      The stitch boundaries usually fall in the middle of tiles.
+      'tile-aligned': The stitches start and end at tile boundaries, so no tile is decoded twice.
+                      The sizes of the stitches differ at most by one tile.
+      'remainder':    As many stitches of max_dimension pixels as possible, and one smaller stitch
+                      with the remaining pixels. This results in the fewest stitches.
+    """
+    total_resolution = total_tiles * tile_size
+    if total_resolution <= max_dimension:
+        return [total_resolution]
+
+    if layout == 'tile-aligned':
+        max_tiles = max(1, max_dimension // tile_size)
+        stitches = -(-total_tiles // max_tiles)
+        tiles, extra = divmod(total_tiles, stitches)
+        return [(tiles + 1) * tile_size] * extra + [tiles * tile_size] * (stitches - extra)
+    elif layout == 'remainder':
+        stitches, remaining = divmod(total_resolution, max_dimension)
+        return [max_dimension] * stitches + ([remaining] if remaining else [])
+
+    resolution_per_stitch = total_resolution
+    divide_by = 1
+    while resolution_per_stitch > max_dimension:
+        # If we have an accurate division without any remainder,
+        if total_resolution % divide_by == 0:
+            # If the accurately divided number does not result in a resolution less than
+            # max_dimension, increase the divisor and try again.
+            if total_resolution / divide_by > max_dimension:
+                divide_by += 1
+            else:
+                # Otherwise use this value for the resolution and keep this divisor
+                resolution_per_stitch = total_resolution // divide_by
+        else:
+            # Otherwise, increase the divisor
+            divide_by += 1
+
+    return [resolution_per_stitch] * divide_by
+
+# ----------------------------------------------------------------------
+
+
+def stitch_tile_span(offset, size, tile_size):
+    """
+    Returns (first_tile, crop, tiles) for a stitch of 'size' pixels that starts 'offset' pixels
+    after the first tile of the stitched area (along one axis): the index of the first tile of the
+    stitch relative to the first tile of the area, the pixels that are cropped from the first
+    tile, and the number of tiles that the stitch spans.
+    """
+    first_tile, crop = divmod(int(offset), tile_size)
+
+    return first_tile, crop, -(-(crop + int(size)) // tile_size)
+
+# ----------------------------------------------------------------------
+
+
+def scaled_pixel(source_pixel, scale):
+    """
+    Returns the output pixel that a source pixel falls in, when the stitched area is scaled by 'scale'
+    (a Fraction <= 1). Both pixels are relative to the first pixel of the stitched area, along one axis.
+    Every source pixel falls in exactly one output pixel: the one that contains its center.
+    Works with numpy arrays of source pixels as well.
+    """
+    return ((2 * source_pixel + 1) * scale.numerator) // (2 * scale.denominator)
+
+# ----------------------------------------------------------------------
+
+
+def first_source_pixel(output_pixel, scale):
+    """
+    Returns the first source pixel that falls in the output pixel (see scaled_pixel()).
+    The source pixels of the output pixel are first_source_pixel(output_pixel) to
+    first_source_pixel(output_pixel + 1) - 1.
+    """
+    return -(-2 * output_pixel * scale.denominator // scale.numerator) // 2
+
+# ----------------------------------------------------------------------
+
+
+def paper_output_scale(zoom, latitude, dpi, paper_scale):
+    """
+    Returns the scale factor of the stitches of a zoom level, so that they are printed at a map scale of
+    1:paper_scale when they are printed at 'dpi' dots per inch. The meters per pixel of the zoom level
+    are calculated at the given latitude, the same way as the MMB1 value of the OziExplorer map files
+    (see generate_OZI_map_file()).
+    """
+    meters_per_pixel = 40075017 * math.cos(latitude / 180.0 * math.pi) / 2**(zoom + 8)
+
+    return meters_per_pixel * dpi / (0.0254 * paper_scale)
+
+# ----------------------------------------------------------------------
+
+
+def stitch_bands(path):
+    """
+    Returns how the red, green, blue and alpha channels of the stitch 'path' are stored in its bands (as GDAL
+    reads them), for the GDAL virtual rasters: a list of 4 (band, color_table_component) tuples, where the
+    color_table_component is not None for indexed color pngs. The alpha is None if the stitch is opaque.
+    """
+    with open(path, 'rb') as f:
+        head = f.read(26)
+    if not head.startswith(PNG_SIGNATURE):
+        # jpg stitches
+        return [(1, None), (2, None), (3, None), None]
+
+    color_type = head[25]
+    if color_type == 3:
+        return [(1, 1), (1, 2), (1, 3), (1, 4)]
+    if color_type in (0, 4):
+        # Grayscale, with alpha in the second band.
+        return [(1, None), (1, None), (1, None), (2, None) if color_type == 4 else None]
+
+    return [(1, None), (2, None), (3, None), (4, None) if color_type == 6 else None]
+
+# ----------------------------------------------------------------------
+
+
+def stitch_layout_cost(horizontal_resolutions, vertical_resolutions, tile_width, tile_height):
+    """
+    Returns a dictionary with the cost of a stitch layout:
+      stitches:          The number of stitches.
+      decoded_pixels:    The pixels of all the tiles that are decoded for all the stitches.
+      redundant_pixels:  The decoded pixels that are cropped away (tiles that are decoded for more than one stitch).
+      max_stitch_bytes:  The memory of the largest (RGBA) stitch.
+      cost:              decoded megapixels + STITCH_OVERHEAD_MPIXELS for every stitch. Lower is better.
+    """
+    def tiles_along(resolutions, tile_size):
+        tiles, offset = 0, 0
+        for size in resolutions:
+            tiles += stitch_tile_span(offset, size, tile_size)[2]
+            offset += size
+        return tiles
+
+    # The tiles of a stitch are its horizontal tiles times its vertical tiles, so the decoded
+    # tiles of all the stitches are the product of the decoded tiles along each axis.
+    decoded_pixels = tiles_along(horizontal_resolutions, tile_width) * tile_width * \
+        tiles_along(vertical_resolutions, tile_height) * tile_height
+    stitches = len(horizontal_resolutions) * len(vertical_resolutions)
+
+    return {
+        'stitches': stitches,
+        'decoded_pixels': decoded_pixels,
+        'redundant_pixels': decoded_pixels - sum(horizontal_resolutions) * sum(vertical_resolutions),
+        'max_stitch_bytes': max(horizontal_resolutions) * max(vertical_resolutions) * 4,
+        'cost': decoded_pixels / 1000000.0 + STITCH_OVERHEAD_MPIXELS * stitches
+    }
+
+# ----------------------------------------------------------------------
+
+
+class decoded_tile_cache(object):
+    """
+    A thread safe LRU cache of decoded tiles (numpy arrays), that holds at most max_bytes of pixels.
+
+    When the stitch boundaries are not tile aligned, the boundary tiles are needed by two (or four)
+    neighbouring stitches. The stitches are built in raster order, so a boundary tile is still in the
+    cache when the neighbouring stitch needs it and it is decoded only once. If a thread asks for a
+    tile that another thread is currently decoding, it waits for that decode instead of repeating it.
+
+    #### Sample code ####
+    cache = decoded_tile_cache(256 * 1024 * 1024)
+    pixels = cache.get('/path/to/tile.png')
+    print(cache.summary())
+    """
+    # ----------------------------------------------------------------------
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._bytes = 0
+        self._tiles = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    # ----------------------------------------------------------------------
+    def _lookup(self, path):
+        tile = self._tiles.get(path)
+        if tile is not None:
+            self._tiles.move_to_end(path)
+            self.hits += 1
+        return tile
+
+    # ----------------------------------------------------------------------
+    def get(self, path):
+        """
+        Returns the (read-only) decoded pixels of the tile 'path', decoding the tile if it is not cached.
+        """
+        with self._lock:
+            tile = self._lookup(path)
+            if tile is not None:
+                return tile
+
+            loading = self._loading.get(path)
+            if loading is None:
+                self.misses += 1
+                loading = self._loading[path] = threading.Event()
+                decode = True
+            else:
+                decode = False
+
+        if not decode:
+            loading.wait()
+            with self._lock:
+                tile = self._lookup(path)
+                if tile is not None:
+                    return tile
+                # The decode of the other thread failed, or the tile has already been evicted.
+                self.misses += 1
+            return read_image_pixels(path)
+
+        try:
+            tile = read_image_pixels(path)
+            tile.flags.writeable = False
+            with self._lock:
+                if tile.nbytes <= self.max_bytes:
+                    self._tiles[path] = tile
+                    self._bytes += tile.nbytes
+                    while self._bytes > self.max_bytes:
+                        self._bytes -= self._tiles.popitem(last=False)[1].nbytes
+                        self.evictions += 1
+        finally:
+            with self._lock:
+                del self._loading[path]
+            loading.set()
+
+        return tile
+
+    # ----------------------------------------------------------------------
+    def counters(self):
+        """
+        Returns the (hits, misses, evictions) counters of the cache.
+        """
+        with self._lock:
+            return self.hits, self.misses, self.evictions
+
+    # ----------------------------------------------------------------------
+    def summary(self):
+        """
+        Returns a printable summary of the cache counters.
+        """
+        return "{}, {:.1f} MB cached".format(tile_cache_summary(*self.counters()), self._bytes / 1048576.0)
+
+# ----------------------------------------------------------------------
+
+
+def tile_cache_summary(hits, misses, evictions):
+    """
+    Returns a printable summary of the counters of a decoded_tile_cache (or of the sums of the counters of
+    the caches of the stitching worker processes).
+    """
+    requests = hits + misses
+    return "{} hits, {} misses ({:.1f}% hit rate), {} evictions".format(
+        hits, misses, 100.0 * hits / requests if requests else 0.0, evictions)
+
+# ----------------------------------------------------------------------
+
+
+class tile_prefetcher(object):
+    """
+    Reads the tiles of the upcoming stitches ahead of the stitching workers with a pool of io_depth
+    reader threads, so that the workers find the tiles in the page cache of the operating system instead
+    of waiting for random reads of small files (slow on spinning disks and network storage).
+
+    Every tile is first announced with posix_fadvise(POSIX_FADV_WILLNEED) (where available), which starts
+    an asynchronous readahead on local file systems, and then read through and discarded, which also works
+    on network file systems that ignore the advice. The throughput is measured over the time that at least
+    one reader is busy, and every stitch is checked for how many of its tiles were read before it started.
+
+    #### Sample code ####
+    prefetcher = tile_prefetcher(8)
+    reads = prefetcher.prefetch(list_of_files)
+    ...
+    prefetcher.started(reads)
+    print(prefetcher.summary())
+    prefetcher.close()
+    """
+    # ----------------------------------------------------------------------
+
+    def __init__(self, io_depth):
+        self.io_depth = io_depth
+        self.files_read = 0
+        self.bytes_read = 0
+        self.busy_seconds = 0.0
+        self.ready = 0
+        self.late = 0
+        self._active = 0
+        self._busySince = None
+        self._recent = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=io_depth,
+                                                               thread_name_prefix='Prefetch-Thread')
+
+    # ----------------------------------------------------------------------
+    def _read(self, path):
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            # The tile is missing. The stitcher handles it.
+            return
+
+        with self._lock:
+            if not self._active:
+                self._busySince = time.monotonic()
+            self._active += 1
+        size = 0
+        try:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            while True:
+                chunk = os.read(fd, DOWNLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+        except OSError as e:
+            LOG.debug("Could not prefetch tile '{}': {}".format(path, e))
+        finally:
+            os.close(fd)
+            with self._lock:
+                self._active -= 1
+                self.files_read += 1
+                self.bytes_read += size
+                if not self._active:
+                    self.busy_seconds += time.monotonic() - self._busySince
+
+    # ----------------------------------------------------------------------
+    def prefetch(self, list_of_files):
+        """
+        Start reading the tiles of list_of_files in the background (the tiles that were prefetched recently
+        are not read again). Returns the futures of the reads, to be passed to started().
+        """
+        reads = []
+        for path in list_of_files:
+            future = self._recent.get(path)
+            if future is None:
+                future = self._recent[path] = self._executor.submit(self._read, path)
+                if len(self._recent) > PREFETCH_RECENT_TILES:
+                    self._recent.popitem(last=False)
+            else:
+                self._recent.move_to_end(path)
+            reads.append(future)
+
+        return reads
+
+    # ----------------------------------------------------------------------
+    def started(self, reads):
+        """
+        Count how many of the prefetched tiles of a stitch were read before the stitch started.
+        """
+        done = sum(1 for future in reads if future.done())
+        with self._lock:
+            self.ready += done
+            self.late += len(reads) - done
+
+    # ----------------------------------------------------------------------
+    def close(self):
+        """
+        Stop the reader threads. The reads that haven't started yet are cancelled.
+        """
+        for future in self._recent.values():
+            future.cancel()
+        self._executor.shutdown()
+        self._recent = OrderedDict()
+
+    # ----------------------------------------------------------------------
+    def summary(self):
+        """
+        Returns a printable summary of the prefetch counters.
+        """
+        with self._lock:
+            busy_seconds = self.busy_seconds
+        tiles = self.ready + self.late
+        return "{} tiles ({:.1f} MB) read ahead at {:.1f} MB/s with {} readers, {:.1f}% of the tiles were read " \
+            "before their stitch started".format(
+                self.files_read, self.bytes_read / 1048576.0,
+                self.bytes_read / 1048576.0 / busy_seconds if busy_seconds else 0.0, self.io_depth,
+                100.0 * self.ready / tiles if tiles else 0.0)
+
+# ----------------------------------------------------------------------
+
+
+class thumbnail_accumulator(object):
+    """
+    Builds the thumbnail of a x_res x y_res RGBA image from bands of rows of the image, in any order,
+    by averaging all the pixels that fall in every pixel of the thumbnail (box filter). Only the sums
+    of the thumbnail pixels are kept in memory, so the image never has to exist as a whole.
+
+    #### Sample code ####
+    thumb = thumbnail_accumulator(x_res, y_res)
+    for y0, band in bands:       # (rows, x_res, 4) uint8 numpy arrays that start at row y0
+        thumb.add_rows(y0, band)
+    pixels_to_image(thumb.pixels()).write('thumb.png')
+    """
+    # ----------------------------------------------------------------------
+
+    def __init__(self, x_res, y_res, thumb_x_res=144, thumb_y_res=144):
+        self.width, self.height = thumbnail_size(x_res, y_res, thumb_x_res, thumb_y_res)
+        # The first column of the image that falls in every column of the thumbnail,
+        # and the row of the thumbnail that every row of the image falls in.
+        self._first_columns = (np.arange(self.width) * x_res) // self.width
+        first_rows = (np.arange(self.height) * y_res) // self.height
+        self._thumb_rows = np.searchsorted(first_rows, np.arange(y_res), side='right') - 1
+        column_counts = np.diff(np.append(self._first_columns, x_res))
+        row_counts = np.diff(np.append(first_rows, y_res))
+        self._counts = np.outer(row_counts, column_counts)[:, :, np.newaxis]
+        self._sums = np.zeros((self.height, self.width, 4), dtype=np.uint64)
+
+    # ----------------------------------------------------------------------
+    def add_rows(self, y0, rows):
+        """
+        Add the (number_of_rows, x_res, 4) rows of the image that start at row y0.
+        """
+        thumb_rows = self._thumb_rows[y0:y0 + rows.shape[0]]
+        column_sums = np.add.reduceat(rows, self._first_columns, axis=1, dtype=np.uint64)
+        # The rows of the image are sorted, so sum the runs of rows that fall in the same thumbnail row.
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(thumb_rows)) + 1))
+        self._sums[thumb_rows[starts]] += np.add.reduceat(column_sums, starts, axis=0)
+
+    # ----------------------------------------------------------------------
+    def pixels(self):
+        """
+        Returns the thumbnail as a (height, width, 4) uint8 numpy array.
+        """
+        return ((self._sums + self._counts // 2) // self._counts).astype(np.uint8)
+
+# ----------------------------------------------------------------------
+
+
+def render_index_images(thumbnails, columns, rows, index_file=None, labeled_index_file=None, label_size=16):
+    """
+    Renders the index images of the stitches in one pass: the thumbnails (paths, row by row) are placed
+    in a grid of columns x rows cells with a white background and a 1 pixel border (like
+    'gm montage -geometry +1+1'), and the labeled index has the file name of every thumbnail at the
+    bottom of its cell.
+
+    The index images are composed and written one row of cells at a time, and both of them share
+    the composed row of cells, so the memory usage is bounded by one row of cells. index_file or
+    labeled_index_file can be None, to skip one of the two images.
+    """
+    sizes = []
+    for path in thumbnails:
+        img = gmImage()
+        img.ping(path)
+        sizes.append((img.columns(), img.rows()))
+    cell_width = max(w for w, h in sizes) + 2
+    cell_height = max(h for w, h in sizes) + 2
+
+    writers = [png_stream_writer(f, columns * cell_width, rows * cell_height)
+               for f in (index_file, labeled_index_file) if f is not None]
+
+    try:
+        for row in range(rows):
+            band = np.full((cell_height, columns * cell_width, 4), 255, dtype=np.uint8)
+            cells = thumbnails[row * columns:(row + 1) * columns]
+
+            for column, path in enumerate(cells):
+                thumb = read_image_pixels(path).astype(np.uint32)
+                w, h = sizes[row * columns + column]
+                x = column * cell_width + (cell_width - w) // 2
+                y = (cell_height - h) // 2
+                # Flatten the thumbnail on the white background.
+                alpha = thumb[:, :, 3:]
+                band[y:y + h, x:x + w, :3] = (thumb[:, :, :3] * alpha + 255 * (255 - alpha) + 127) // 255
+
+            if index_file is not None:
+                writers[0].write_rows(band)
+
+            if labeled_index_file is not None:
+                img = pixels_to_image(band)
+                labels = pgmagick.DrawableList()
+                labels.append(pgmagick.DrawableFillColor(pgmagick.Color('red')))
+                labels.append(pgmagick.DrawableStrokeColor(pgmagick.Color('red')))
+                labels.append(pgmagick.DrawablePointSize(label_size))
+                img.fontPointsize(label_size)
+                fontmetric = pgmagick.TypeMetric()
+                for column, path in enumerate(cells):
+                    label = os.path.basename(path)
+                    img.fontTypeMetrics(label, fontmetric)
+                    labels.append(pgmagick.DrawableText(column * cell_width + (cell_width - fontmetric.textWidth()) / 2,
+                                                        cell_height - 7, label))
+                img.draw(labels)
+                writers[-1].write_rows(image_to_pixels(img))
+
+        for writer in writers:
+            writer.close()
+    except (RuntimeError, ValueError):
+        for writer in writers:
+            writer.abort()
+        raise
+
+# ----------------------------------------------------------------------
+
+
+def write_image_pixels(path, pixels, pad_to=None):
+    """
+    Writes the (rows, columns, 4) uint8 numpy array pixels in the png, jpg or webp file 'path' (based on its extension).
+    The file is written in a temporary file next to 'path' and atomically renamed to 'path'.
+
+    pad_to: If given, the image is padded with transparent pixels (black for jpg) to pad_to x pad_to pixels.
+    """
+    if pad_to is not None and pixels.shape[:2] != (pad_to, pad_to):
+        padded = np.zeros((pad_to, pad_to, 4), dtype=np.uint8)
+        padded[:pixels.shape[0], :pixels.shape[1]] = pixels
+        pixels = padded
+
+    if path.endswith('.png'):
+        writer = png_stream_writer(path, pixels.shape[1], pixels.shape[0])
+        writer.write_rows(pixels)
+        writer.close()
+    else:
+        tmp_path = partial_path(path)
+        img = pixels_to_image(pixels)
+        img.magick('WEBP' if path.endswith('.webp') else 'JPEG')
+        img.write(tmp_path)
+        os.replace(tmp_path, path)
+
+# ----------------------------------------------------------------------
+
+
+def pyramid_base_tile(path, list_of_files, x_tiles, y_tiles, tile_width, tile_height, width, height, crop_left, crop_top,
+                      pad_to=None, uniform_tiles=None):
+    """
+    Writes a width x height tile of the full resolution level of an image pyramid, assembled from the
+    source tiles (see assemble_tiles() for the arguments). Runs in a pyramid worker process.
+    """
+    pixels = assemble_tiles(list_of_files, x_tiles, y_tiles, tile_width, tile_height, width, height, crop_left, crop_top,
+                            tile_cache=PROCESS_TILE_CACHE, uniform_tiles=uniform_tiles)
+    write_image_pixels(path, pixels, pad_to)
+
+# ----------------------------------------------------------------------
+
+
+def pyramid_parent_tile(path, children, region_width, region_height, tile_size, pad_to=None):
+    """
+    Writes a tile of an image pyramid level by halving the resolution of the (up to) 2x2 tiles of the next level
+    that it covers. Runs in a pyramid worker process.
+
+    children: The paths of the 2x2 tiles of the next level, row by row (None where there is no tile).
+    region_width, region_height: The size of the region of the next level that is covered by the children.
+                                 The tile is (region_width + 1) // 2 x (region_height + 1) // 2 pixels.
+    """
+    region = np.zeros((region_height, region_width, 4), dtype=np.uint8)
+    for i, child in enumerate(children):
+        if child is None or not os.path.isfile(child):
+            continue
+        x0, y0 = (i % 2) * tile_size, (i // 2) * tile_size
+        x1, y1 = min(x0 + tile_size, region_width), min(y0 + tile_size, region_height)
+        # Padded tiles (xyz pyramids) are cropped to the region.
+        region[y0:y1, x0:x1] = read_image_pixels(child)[:y1 - y0, :x1 - x0]
+
+    write_image_pixels(path, downsample_2x(region), pad_to)
+
+# ----------------------------------------------------------------------
+
+
+def atlas_sheet_offsets(total, size, overlap):
+    """
+    Returns (offsets, size) of the atlas sheets along one axis: the first pixel of every sheet in an area of
+    'total' pixels, for sheets of 'size' pixels that overlap by 'overlap' pixels. The last sheet is moved back
+    to end at the edge of the area (so it overlaps more), and a single sheet is cropped to a smaller area.
+    """
+    if total <= size:
+        return [0], total
+
+    step = size - overlap
+    sheets = -(-(total - overlap) // step)
+
+    return [min(i * step, total - size) for i in range(sheets)], size
+
+# ----------------------------------------------------------------------
+
+
+def render_atlas_sheet(path, list_of_files, x_tiles, y_tiles, tile_width, tile_height, width, height, crop_left, crop_top,
+                       scaling, zoom, corners, margin_px, dpi, uniform_tiles=None):
+    """
+    Assembles a width x height part of the map from the source tiles (see assemble_tiles() and, if scaling is
+    not None, assemble_tiles_scaled()), decorates it for print (see decorate_map_for_print()) with a margin of
+    margin_px pixels, and writes the sheet in 'path', with its resolution set to dpi. corners are the (N, S, W, E)
+    degrees of the map of the sheet. Runs in an atlas worker process.
+    """
+    if scaling is None:
+        pixels = assemble_tiles(list_of_files, x_tiles, y_tiles, tile_width, tile_height, width, height, crop_left,
+                                crop_top, tile_cache=PROCESS_TILE_CACHE, uniform_tiles=uniform_tiles)
+        scale = 1
+    else:
+        scale, x_offset, y_offset = scaling
+        pixels = assemble_tiles_scaled(list_of_files, x_tiles, y_tiles, tile_width, tile_height, width, height,
+                                       crop_left, crop_top, scale, x_offset, y_offset, tile_cache=PROCESS_TILE_CACHE,
+                                       uniform_tiles=uniform_tiles)
+
+    canvas = decorate_map_for_print(pixels_to_image(pixels), zoom, *corners, scale=scale, canvas_margin_px=margin_px)
+    canvas.resolutionUnits(pgmagick.ResolutionType.PixelsPerInchResolution)
+    canvas.density(pgmagick.Geometry(dpi, dpi))
+
+    tmp_path = partial_path(path)
+    canvas.write('{}:{}'.format('PNG' if path.endswith('.png') else 'JPEG', tmp_path))
+    os.replace(tmp_path, path)
+
+# ----------------------------------------------------------------------
+
+
+def overlay_tile(base_path, overlay_path, destination_path, opacity=1.0):
+    """
+    Composes the overlay tile over the base tile (alpha compositing, with the alpha of the overlay multiplied
+    by opacity) and writes the result in destination_path. Runs in an overlay worker process.
+    """
+    base = read_image_pixels(base_path).astype(np.float32) / 255
+    overlay = read_image_pixels(overlay_path).astype(np.float32) / 255
+    if base.shape != overlay.shape:
+        raise ValueError("The overlay tile '{}' is {}x{} pixels, but the base tile is {}x{} pixels.".format(
+            overlay_path, overlay.shape[1], overlay.shape[0], base.shape[1], base.shape[0]))
+
+    overlay_alpha = overlay[:, :, 3:] * opacity
+    base_alpha = base[:, :, 3:] * (1 - overlay_alpha)
+    alpha = overlay_alpha + base_alpha
+    composed = np.empty_like(base)
+    composed[:, :, :3] = (overlay[:, :, :3] * overlay_alpha + base[:, :, :3] * base_alpha) / np.maximum(alpha, 1e-6)
+    composed[:, :, 3:] = alpha
+
+    write_image_pixels(destination_path, np.clip(np.rint(composed * 255), 0, 255).astype(np.uint8))
+
+# ----------------------------------------------------------------------
+
+
+class quick_regexp(object):
+    """
+    Quick regular expression class, which can be used directly in if() statements in a perl-like fashion.
+
+    #### Sample code ####
+    r = quick_regexp()
+    if(r.search('pattern (test) (123)', string)):
+        print(r.groups[0]) # Prints 'test'
+        print(r.groups[1]) # Prints '123'
+    """
+    # ----------------------------------------------------------------------
+
+    def __init__(self):
+        self.groups = None
+        self.matched = False
+
+    # ----------------------------------------------------------------------
+    def search(self, pattern, string, flags=0):
+        match = re.search(pattern, string, flags)
+        if match:
+            self.matched = True
+            if match.groups():
+                self.groups = re.search(pattern, string, flags).groups()
+            else:
+                self.groups = True
+        else:
+            self.matched = False
+            self.groups = None
+
+        return self.matched
+
+# ----------------------------------------------------------------------
+
+
+class executeCommand(object):
+    """
+    Custom class to execute a shell command and
+    provide to the user, access to the returned
+    values
+    """
+
+    def __init__(self, args=None, isUtc=True):
+        self._stdout = None
+        self._stderr = None
+        self._returncode = None
+        self._timeStartedExecution = None
+        self._timeFinishedExecution = None
+        self._args = args
+        self.isUtc = isUtc
+        if self._args != None:
+            self.execute()
+
+    def execute(self, args=None):
+        if args != None:
+            self._args = args
+
+        if self._args != None:
+            if self.isUtc:
+                self._timeStartedExecution = datetime.datetime.now(tz=datetime.UTC)
+            else:
+                self._timeStartedExecution = datetime.datetime.now()
+            p = subprocess.Popen(
+                self._args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            if self.isUtc:
+                self._timeFinishedExecution = datetime.datetime.now(tz=datetime.UTC)
+            else:
+                self._timeFinishedExecution = datetime.datetime.now()
+            self._stdout, self._stderr = p.communicate()
+            self._returncode = p.returncode
+            return 1
+        else:
+            self._stdout = None
+            self._stderr = None
+            self._returncode = None
+            return 0
+
+    def getStdout(self, getList=True, decode=True):
+        """
+        Get the standard output of the executed command
+
+        getList: If True, return a list of lines.
+                 Otherwise, return the result as one string
+        """
+
+        if getList and not decode:
+            raise BaseException("decode can only be True when getList == True")
+
+        if getList:
+            return self._stdout.decode('utf-8').split('\n')
+
+        if decode:
+            return self._stdout.decode('utf-8')
+        else:
+            return self._stdout
+
+    def getStderr(self, getList=True, decode=True):
+        """
+        Get the error output of the executed command
+
+        getList: If True, return a list of lines.
+                 Otherwise, return the result as one string
+        """
+
+        if getList and not decode:
+            raise BaseException("decode can only be True when getList == True")
+
+        if getList:
+            return self._stderr.decode('utf-8').split('\n')
+
+        if decode:
+            return self._stderr.decode('utf-8')
+        else:
+            return self._stderr
+
+    def getReturnCode(self):
+        """
+        Get the exit/return status of the command
+        """
+        return self._returncode
+
+    def getTimeStartedExecution(self, inMicroseconds=False):
+        """
+        Get the time when the execution started
+        """
+        if isinstance(self._timeStartedExecution, datetime.datetime):
+            if inMicroseconds:
+                return int(str(calendar.timegm(self._timeStartedExecution.timetuple())) +
+                           str(self._timeStartedExecution.strftime("%f")))
+        return self._timeStartedExecution
+
+    def getTimeFinishedExecution(self, inMicroseconds=False):
+        """
+        Get the time when the execution finished
+        """
+        if isinstance(self._timeFinishedExecution, datetime.datetime):
+            if inMicroseconds:
+                return int(str(calendar.timegm(self._timeFinishedExecution.timetuple())) +
+                           str(self._timeFinishedExecution.strftime("%f")))
+        return self._timeFinishedExecution
+
+# ----------------------------------------------------------------------
+
+
+class png_stream_writer(object):
+    """
+    Writes a PNG file row by row, without ever holding the complete image in memory.
+
+    The rows are filtered with the PNG 'Up' filter (vectorized with numpy) and
+    deflated incrementally. The file is written in a temporary file next to 'path'
+    and atomically renamed to 'path' when close() is called.
+
+    If a palette ((colors, 4) uint8 numpy array of RGBA colors) is given, the image is written as an
+    indexed color PNG (PLTE and tRNS chunks), and the rows are the (rows, width, 1) palette indices.
+
+    If threads > 1, the filtered rows are split in blocks that are deflated in parallel by a
+    pool of threads (zlib releases the GIL while it compresses), the same way as pigz does:
+    every block is a raw deflate stream that is primed with the last 32KB of the previous
+    block as its dictionary and ends with a sync flush on a byte boundary, so the blocks
+    are concatenated in one valid zlib stream, and the adler32 checksum of the whole stream
+    is calculated on the fly.
+
+    #### Sample code ####
+    writer = png_stream_writer('out.png', width, height, threads=4)
+    for band in bands:           # (rows, width, 4) uint8 numpy arrays
+        writer.write_rows(band)
+    writer.close()
+    """
+    # Compressed data is written in IDAT chunks of (at least) this size
+    IDAT_SIZE = 1024 * 1024
+    # The size of the uncompressed blocks that are deflated in parallel
+    BLOCK_SIZE = 1024 * 1024
+    # The size of the deflate window (the dictionary of every block)
+    WINDOW_SIZE = 32 * 1024
+
+    # ----------------------------------------------------------------------
+    def __init__(self, path, width, height, channels=4, level=6, threads=1, palette=None):
+        if palette is not None:
+            channels = 1
+        self.path = path
+        self.width = width
+        self.height = height
+        self.channels = channels
+        self.level = level
+        self.rows_written = 0
+        self._tmp_path = partial_path(path)
+        self._file = open(self._tmp_path, 'wb')
+        self._pending = []
+        self._pending_size = 0
+        self._previous_row = np.zeros((width * channels, ), dtype=np.uint8)
+
+        if threads > 1:
+            self._compressor = None
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+            self._max_blocks_in_flight = 2 * threads
+            self._blocks = []
+            self._unsubmitted = []
+            self._unsubmitted_size = 0
+            self._dictionary = b''
+            self._adler32 = zlib.adler32(b'')
+        else:
+            self._compressor = zlib.compressobj(level)
+            self._executor = None
+
+        # PNG color types: 0 = grayscale, 2 = RGB, 3 = indexed color, 4 = grayscale + alpha, 6 = RGBA
+        color_type = 3 if palette is not None else {1: 0, 2: 4, 3: 2, 4: 6}[channels]
+        self._file.write(PNG_SIGNATURE)
+        self._file.write(png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, color_type, 0, 0, 0)))
+        if palette is not None:
+            palette = np.asarray(palette, dtype=np.uint8)
+            self._file.write(png_chunk(b'PLTE', palette[:, :3].tobytes()))
+            # The alpha values of the palette, up to the last color that isn't opaque
+            transparent = np.flatnonzero(palette[:, 3] != 255)
+            if len(transparent):
+                self._file.write(png_chunk(b'tRNS', palette[:transparent[-1] + 1, 3].tobytes()))
+        if self._executor is not None:
+            # The zlib header of the stream (the same header that zlib writes for this level)
+            self._write_compressed(zlib.compress(b'', level)[:2])
+
+    # ----------------------------------------------------------------------
+    def _deflate_block(self, data, dictionary, last):
+        """
+        Deflate one block of the parallel stream in a raw deflate stream.
+        """
+        if dictionary:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary)
+        else:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+        return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+    # ----------------------------------------------------------------------
+    def _submit_block(self, data, last=False):
+        """
+        Hand a block to the thread pool, and write the compressed blocks that are ready, in order.
+        At most 2 blocks per thread are in flight, to bound the memory usage.
+        """
+        self._blocks.append(self._executor.submit(self._deflate_block, data, self._dictionary, last))
+        self._dictionary = data[-self.WINDOW_SIZE:]
+        self._adler32 = zlib.adler32(data, self._adler32)
+
+        while self._blocks and (len(self._blocks) > self._max_blocks_in_flight or last or self._blocks[0].done()):
+            self._write_compressed(self._blocks.pop(0).result())
+
+    # ----------------------------------------------------------------------
+    def _compress(self, data):
+        """
+        Compress the filtered rows with the zlib stream or with the parallel block stream.
+        """
+        if self._executor is None:
+            self._write_compressed(self._compressor.compress(data))
+            return
+
+        self._unsubmitted.append(data)
+        self._unsubmitted_size += len(data)
+        if self._unsubmitted_size >= self.BLOCK_SIZE:
+            data = b''.join(self._unsubmitted)
+            full = len(data) - len(data) % self.BLOCK_SIZE
+            for offset in range(0, full, self.BLOCK_SIZE):
+                self._submit_block(data[offset:offset + self.BLOCK_SIZE])
+            self._unsubmitted = [data[full:]]
+            self._unsubmitted_size = len(data) - full
+
+    # ----------------------------------------------------------------------
+    def _write_compressed(self, data, flush=False):
+        if data:
+            self._pending.append(data)
+            self._pending_size += len(data)
+        if self._pending_size >= self.IDAT_SIZE or (flush and self._pending_size):
+            self._file.write(png_chunk(b'IDAT', b''.join(self._pending)))
+            self._pending = []
+            self._pending_size = 0
+
+    # ----------------------------------------------------------------------
+    def write_rows(self, rows):
+        """
+        Append rows to the image. rows is a (number_of_rows, width, channels) uint8 numpy array.
+        """
+        rows = rows.reshape(rows.shape[0], self.width * self.channels)
+        if self.rows_written + rows.shape[0] > self.height:
+            raise ValueError("Too many rows for a {}x{} image".format(self.width, self.height))
+
+        filtered = np.empty((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+        filtered[:, 0] = 2  # The 'Up' filter type
+        filtered[0, 1:] = rows[0] - self._previous_row
+        filtered[1:, 1:] = rows[1:] - rows[:-1]
+        self._previous_row = rows[-1].copy()
+
+        self._compress(filtered.tobytes())
+        self.rows_written += rows.shape[0]
+
+    # ----------------------------------------------------------------------
+    def close(self):
+        """
+        Finish the PNG file and rename it to its final path.
+        """
+        if self.rows_written != self.height:
+            self.abort()
+            raise ValueError("Only {} out of {} rows were written in '{}'".format(self.rows_written, self.height, self.path))
+
+        if self._executor is None:
+            self._write_compressed(self._compressor.flush(), flush=True)
+        else:
+            self._submit_block(b''.join(self._unsubmitted), last=True)
+            self._executor.shutdown()
+            self._write_compressed(struct.pack('>I', self._adler32 & 0xffffffff), flush=True)
+        self._file.write(png_chunk(b'IEND', b''))
+        self._file.close()
+        os.replace(self._tmp_path, self.path)
+
+    # ----------------------------------------------------------------------
+    def abort(self):
+        """
+        Remove the partially written file.
+        """
+        if self._executor is not None:
+            self._executor.shutdown()
+        self._file.close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+# ----------------------------------------------------------------------
+
+
+def nearest_palette_colors(colors, palette, chunk=8192):
+    """
+    Returns the index of the nearest color of the palette ((k, 4) array) for every color of the (n, 4)
+    array 'colors' (squared euclidean RGBA distance). The distances are calculated in chunks of colors,
+    to bound the memory usage.
+    """
+    colors = np.asarray(colors, dtype=np.int32)
+    palette = np.asarray(palette, dtype=np.int32)
+    indices = np.empty(len(colors), dtype=np.intp)
+    for i in range(0, len(colors), chunk):
+        differences = colors[i:i + chunk, np.newaxis, :] - palette[np.newaxis, :, :]
+        indices[i:i + chunk] = np.einsum('ijk,ijk->ij', differences, differences).argmin(axis=1)
+
+    return indices
+
+# ----------------------------------------------------------------------
+
+
+def median_cut(colors, weights, max_colors):
+    """
+    Returns a palette of at most max_colors colors ((k, 4) float array) for the (n, 4) array of distinct
+    colors with the given weights (pixel counts), with the median cut algorithm: the box of colors with
+    the largest (channel range * pixels) is split at the weighted median of that channel, until there
+    are max_colors boxes. Every color of the palette is the weighted mean of a box.
+    """
+    colors = np.asarray(colors, dtype=np.float64)
+    weights = np.asarray(weights, dtype=np.float64)
+
+    def box(indices):
+        ranges = colors[indices].max(axis=0) - colors[indices].min(axis=0)
+        channel = int(ranges.argmax())
+        return [ranges[channel] * weights[indices].sum() if len(indices) > 1 else -1, indices, channel]
+
+    boxes = [box(np.arange(len(colors)))]
+    while len(boxes) < max_colors:
+        largest = max(range(len(boxes)), key=lambda i: boxes[i][0])
+        score, indices, channel = boxes[largest]
+        if score <= 0:
+            break
+        indices = indices[np.argsort(colors[indices, channel], kind='stable')]
+        cumulative = np.cumsum(weights[indices])
+        cut = min(max(int(np.searchsorted(cumulative, cumulative[-1] / 2.0)) + 1, 1), len(indices) - 1)
+        boxes[largest] = box(indices[:cut])
+        boxes.append(box(indices[cut:]))
+
+    return np.array([np.average(colors[indices], axis=0, weights=weights[indices]) for _, indices, _ in boxes])
+
+# ----------------------------------------------------------------------
+
+
+class palette_quantizer(object):
+    """
+    Reduces the colors of an RGBA image to a palette of at most max_colors colors, for indexed color PNG
+    stitches. Maps with few colors are several times smaller (and faster to load) as indexed color PNGs.
+
+    The histogram of the colors of the image is collected band by band with add_rows(). build() then
+    chooses the palette: the exact colors if the image has at most max_colors colors, otherwise the colors
+    of a weighted median cut that are refined with a few k-means (Lloyd) iterations. Everything works on
+    the distinct colors of the image, not on its pixels. build() returns False (the image should be written
+    in true color) if the image has more than MAX_UNIQUE_COLORS distinct colors (e.g. aerial imagery), or if
+    the root mean square error of the palette is larger than max_error.
+
+    indices() maps the bands of the image to the palette. With dither, an ordered (Bayer) dither is added
+    to the colors before they are mapped, to avoid banding in color gradients.
+
+    #### Sample code ####
+    quantizer = palette_quantizer(256)
+    for band in bands:
+        quantizer.add_rows(band)
+    if quantizer.build():
+        writer = png_stream_writer('out.png', width, height, palette=quantizer.palette)
+        for y0, band in bands:
+            writer.write_rows(quantizer.indices(band, y0)[:, :, np.newaxis])
+    """
+    # Images with more distinct colors are never quantized
+    MAX_UNIQUE_COLORS = 1 << 18
+    # The k-means iterations after the median cut
+    KMEANS_ITERATIONS = 3
+    # The 8x8 Bayer matrix of the ordered dither
+    BAYER = np.array([[0, 32, 8, 40, 2, 34, 10, 42], [48, 16, 56, 24, 50, 18, 58, 26],
+                      [12, 44, 4, 36, 14, 46, 6, 38], [60, 28, 52, 20, 62, 30, 54, 22],
+                      [3, 35, 11, 43, 1, 33, 9, 41], [51, 19, 59, 27, 49, 17, 57, 25],
+                      [15, 47, 7, 39, 13, 45, 5, 37], [63, 31, 55, 23, 61, 29, 53, 21]])
+
+    # ----------------------------------------------------------------------
+    def __init__(self, max_colors=256, dither=False, max_error=6.0):
+        self.max_colors = max_colors
+        self.dither = dither
+        self.max_error = max_error
+        self.palette = None
+        self.error = None
+        self._colors = np.empty((0, ), dtype=np.uint32)
+        self._counts = np.empty((0, ), dtype=np.float64)
+        self._too_many_colors = False
+
+    # ----------------------------------------------------------------------
+    @staticmethod
+    def _pack(rows):
+        return np.ascontiguousarray(rows, dtype=np.uint8).reshape(-1, 4).view(np.uint32).ravel()
+
+    # ----------------------------------------------------------------------
+    def add_rows(self, rows):
+        """
+        Add the (number_of_rows, width, 4) rows of the image to the histogram of the colors.
+        Returns False if the image has too many colors to be quantized (the rest of the rows can be skipped).
+        """
+        if self._too_many_colors:
+            return False
+
+        colors, counts = np.unique(self._pack(rows), return_counts=True)
+        colors, inverse = np.unique(np.concatenate((self._colors, colors)), return_inverse=True)
+        self._counts = np.bincount(inverse, weights=np.concatenate((self._counts, counts)), minlength=len(colors))
+        self._colors = colors
+        if len(colors) > self.MAX_UNIQUE_COLORS:
+            self._too_many_colors = True
+            self._colors = self._counts = None
+
+        return not self._too_many_colors
+
+    # ----------------------------------------------------------------------
+    def build(self):
+        """
+        Choose the palette of the image. Returns True if the image can be written with the palette.
+        """
+        if self._too_many_colors or not len(self._colors):
+            return False
+
+        colors = self._colors.view(np.uint8).reshape(-1, 4)
+        if len(colors) <= self.max_colors:
+            # The palette has the exact colors of the image.
+            self.palette = colors.copy()
+            self._color_indices = np.arange(len(colors))
+            self.error = 0.0
+            return True
+
+        palette = median_cut(colors, self._counts, self.max_colors)
+        for _ in range(self.KMEANS_ITERATIONS):
+            labels = nearest_palette_colors(colors, np.rint(palette))
+            totals = np.bincount(labels, weights=self._counts, minlength=len(palette))
+            used = totals > 0
+            for channel in range(4):
+                sums = np.bincount(labels, weights=self._counts * colors[:, channel], minlength=len(palette))
+                palette[used, channel] = sums[used] / totals[used]
+
+        self.palette = np.clip(np.rint(palette), 0, 255).astype(np.uint8)
+        self._color_indices = nearest_palette_colors(colors, self.palette)
+        differences = colors.astype(np.float64) - self.palette[self._color_indices]
+        self.error = math.sqrt((self._counts * (differences ** 2).sum(axis=1)).sum() / (4 * self._counts.sum()))
+        if self.error > self.max_error:
+            return False
+
+        # The ordered dither spreads the colors by about the error of the palette.
+        self._dither_amplitude = min(max(2 * self.error, 4.0), 32.0)
+        return True
+
+    # ----------------------------------------------------------------------
+    def indices(self, rows, y0=0):
+        """
+        Returns the (number_of_rows, width) uint8 palette indices of the rows of the image that start at row y0.
+        """
+        if not self.dither or self.error == 0:
+            return self._color_indices[np.searchsorted(self._colors, self._pack(rows))].astype(np.uint8).reshape(
+                rows.shape[:2])
+
+        height, width = rows.shape[:2]
+        threshold = (self.BAYER[(np.arange(y0, y0 + height) % 8)[:, np.newaxis], np.arange(width) % 8] + 0.5) / 64 - 0.5
+        dithered = rows.astype(np.float32)
+        # The alpha channel isn't dithered, to keep the transparent areas transparent.
+        dithered[:, :, :3] += (threshold * self._dither_amplitude)[:, :, np.newaxis]
+        colors, inverse = np.unique(self._pack(np.clip(np.rint(dithered), 0, 255)), return_inverse=True)
+
+        return nearest_palette_colors(colors.view(np.uint8).reshape(-1, 4), self.palette)[inverse].astype(
+            np.uint8).reshape(height, width)
+
+# ----------------------------------------------------------------------
+
+
+class geotiff_writer(object):
+    """
+    Writes an RGBA image row by row in a tiled, deflate compressed BigTIFF with the
+    Cloud Optimized GeoTIFF (COG) layout, without ever holding the complete image in memory:
+
+     * The image is split in block_size x block_size blocks, and the blocks of every band of
+       block_size rows are compressed in parallel by a pool of 'threads' threads (zlib releases
+       the GIL while it compresses).
+     * The internal overviews (reduced resolution images) are built while the rows are written,
+       by averaging 2x2 pixels of the previous level, until the image fits in one block.
+     * All the IFDs are written at the beginning of the file, followed by the blocks of the
+       smallest overview first and the full resolution image last.
+
+    Since the compressed size of the blocks is not known in advance, the compressed blocks of
+    every level are spooled in temporary files next to 'path', and the final file is assembled
+    and atomically renamed to 'path' when close() is called.
+
+    geotransform: (x of the left edge, y of the top edge, pixel width, pixel height) in the
+                  units of the epsg coordinate system. If given, the GeoTIFF tags are written.
+
+    #### Sample code ####
+    writer = geotiff_writer('out.tif', width, height, threads=4, geotransform=(x, y, 2.38, 2.38))
+    for band in bands:           # (rows, width, 4) uint8 numpy arrays
+        writer.write_rows(band)
+    writer.close()
+    """
+    # The TIFF field types that are used: (type, struct format)
+    SHORT = (3, 'H')
+    LONG = (4, 'I')
+    DOUBLE = (12, 'd')
+    LONG8 = (16, 'Q')
+
+    # ----------------------------------------------------------------------
+    def __init__(self, path, width, height, block_size=512, level=6, threads=1, geotransform=None, epsg=3857):
+        self.path = path
+        self.block_size = block_size
+        self.level = level
+        self.geotransform = geotransform
+        self.epsg = epsg
+        self.channels = 4
+        self._tmp_path = partial_path(path)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, threads))
+
+        # levels[0] is the full resolution image, and levels[1:] the overviews
+        self._levels = []
+        while True:
+            self._levels.append({
+                'width': width,
+                'height': height,
+                'pending': [],
+                'pending_rows': 0,
+                'rows_written': 0,
+                'byte_counts': [],
+                'spool': open('{}.{}'.format(self._tmp_path, len(self._levels)), 'w+b')
+            })
+            if max(width, height) <= block_size:
+                break
+            width, height = (width + 1) // 2, (height + 1) // 2
+
+    # ----------------------------------------------------------------------
+    @staticmethod
+    def buffer_size(width, block_size=512):
+        """
+        Returns the (approximate) memory in bytes that the writer needs for an image that is 'width' pixels wide.
+        Every level keeps up to block_size rows (and a concatenated copy of them) until they are compressed, and
+        the overviews add up to half of the full resolution rows, so it grows with the width of the image but not
+        with its height.
+        """
+        return 4 * block_size * width * 4
+
+    # ----------------------------------------------------------------------
+    def _compress_block(self, block):
+        """
+        Pad a block to block_size x block_size pixels, apply the horizontal
+        differencing predictor and deflate it.
+        """
+        tile = np.zeros((self.block_size, self.block_size, self.channels), dtype=np.uint8)
+        tile[:block.shape[0], :block.shape[1]] = block
+
+        predicted = tile.copy()
+        predicted[:, 1:] = tile[:, 1:] - tile[:, :-1]
+
+        return zlib.compress(predicted.tobytes(), self.level)
+
+    # ----------------------------------------------------------------------
+    def _write_band(self, index, band):
+        level = self._levels[index]
+        level['rows_written'] += band.shape[0]
+        if level['rows_written'] > level['height']:
+            raise ValueError("Too many rows for a {}x{} image".format(level['width'], level['height']))
+
+        blocks = [band[:, x:x + self.block_size] for x in range(0, level['width'], self.block_size)]
+        for data in self._executor.map(self._compress_block, blocks):
+            level['spool'].write(data)
+            level['byte_counts'].append(len(data))
+
+        if index + 1 < len(self._levels):
+            self._add_rows(index + 1, downsample_2x(band))
+
+    # ----------------------------------------------------------------------
+    def _add_rows(self, index, rows):
+        level = self._levels[index]
+        level['pending'].append(rows)
+        level['pending_rows'] += rows.shape[0]
+
+        while level['pending_rows'] >= self.block_size:
+            pending = np.concatenate(level['pending'])
+            level['pending'] = [pending[self.block_size:]]
+            level['pending_rows'] -= self.block_size
+            self._write_band(index, pending[:self.block_size])
+
+    # ----------------------------------------------------------------------
+    def write_rows(self, rows):
+        """
+        Append rows to the image. rows is a (number_of_rows, width, 4) uint8 numpy array.
+        """
+        self._add_rows(0, rows)
+
+    # ----------------------------------------------------------------------
+    def _ifd(self, index, ifd_offset, next_ifd_offset, tile_offsets):
+        """
+        Returns the IFD of the level 'index', followed by the values that do not fit in the IFD entries.
+        """
+        level = self._levels[index]
+        entries = [
+            (254, self.LONG, [0 if index == 0 else 1]),  # NewSubfileType: 1 for the reduced resolution images
+            (256, self.LONG, [level['width']]),  # ImageWidth
+            (257, self.LONG, [level['height']]),  # ImageLength
+            (258, self.SHORT, [8] * self.channels),  # BitsPerSample
+            (259, self.SHORT, [8]),  # Compression: deflate
+            (262, self.SHORT, [2]),  # PhotometricInterpretation: RGB
+            (277, self.SHORT, [self.channels]),  # SamplesPerPixel
+            (284, self.SHORT, [1]),  # PlanarConfiguration: contiguous
+            (317, self.SHORT, [2]),  # Predictor: horizontal differencing
+            (322, self.LONG, [self.block_size]),  # TileWidth
+            (323, self.LONG, [self.block_size]),  # TileLength
+            (324, self.LONG8, tile_offsets),  # TileOffsets
+            (325, self.LONG8, level['byte_counts']),  # TileByteCounts
+            (338, self.SHORT, [2]),  # ExtraSamples: unassociated alpha
+            (339, self.SHORT, [1] * self.channels),  # SampleFormat: unsigned integer
+        ]
+        if index == 0 and self.geotransform is not None:
+            left, top, pixel_width, pixel_height = self.geotransform
+            entries.extend([
+                (33550, self.DOUBLE, [pixel_width, pixel_height, 0.0]),  # ModelPixelScaleTag
+                (33922, self.DOUBLE, [0.0, 0.0, 0.0, left, top, 0.0]),  # ModelTiepointTag
+                # GeoKeyDirectoryTag: GTModelType = projected, GTRasterType = PixelIsArea,
+                # ProjectedCSType = epsg, ProjLinearUnits = meters
+                (34735, self.SHORT, [1, 1, 0, 4,
+                                     1024, 0, 1, 1,
+                                     1025, 0, 1, 1,
+                                     3072, 0, 1, self.epsg,
+                                     3076, 0, 1, 9001]),
+            ])
+
+        ifd = struct.pack('<Q', len(entries))
+        extra = b''
+        extra_offset = ifd_offset + 8 + 20 * len(entries) + 8
+        for tag, (field_type, fmt), values in entries:
+            data = struct.pack('<{}{}'.format(len(values), fmt), *values)
+            if len(data) <= 8:
+                ifd += struct.pack('<HHQ', tag, field_type, len(values)) + data.ljust(8, b'\0')
+            else:
+                ifd += struct.pack('<HHQQ', tag, field_type, len(values), extra_offset + len(extra))
+                extra += data
+        ifd += struct.pack('<Q', next_ifd_offset)
+
+        return ifd + extra
+
+    # ----------------------------------------------------------------------
+    def close(self):
+        """
+        Write the remaining rows, assemble the final file and rename it to its final path.
+        """
+        try:
+            # Flushing a level adds its last rows to the next level, so flush them in order.
+            for index, level in enumerate(self._levels):
+                if level['pending_rows']:
+                    pending = np.concatenate(level['pending'])
+                    level['pending'], level['pending_rows'] = [], 0
+                    self._write_band(index, pending)
+
+            if self._levels[0]['rows_written'] != self._levels[0]['height']:
+                raise ValueError("Only {} out of {} rows were written in '{}'".format(
+                    self._levels[0]['rows_written'], self._levels[0]['height'], self.path))
+
+            # The size of the IFDs doesn't depend on the values of the offsets, so
+            # calculate where the data starts with dummy offsets first.
+            header_size = 16
+            ifd_sizes = [len(self._ifd(i, 0, 0, [0] * len(l['byte_counts']))) for i, l in enumerate(self._levels)]
+            ifd_offsets = [header_size + sum(ifd_sizes[:i]) for i in range(len(self._levels))]
+
+            # The data of the smallest overview comes first and the data of the full resolution image last.
+            tile_offsets = [None] * len(self._levels)
+            data_offset = header_size + sum(ifd_sizes)
+            for index in reversed(range(len(self._levels))):
+                offsets = []
+                for byte_count in self._levels[index]['byte_counts']:
+                    offsets.append(data_offset)
+                    data_offset += byte_count
+                tile_offsets[index] = offsets
+
+            with open(self._tmp_path, 'wb') as f:
+                # BigTIFF header: little endian, version 43, 8 byte offsets
+                f.write(struct.pack('<2sHHHQ', b'II', 43, 8, 0, header_size))
+                for index in range(len(self._levels)):
+                    next_ifd_offset = ifd_offsets[index + 1] if index + 1 < len(self._levels) else 0
+                    f.write(self._ifd(index, ifd_offsets[index], next_ifd_offset, tile_offsets[index]))
+                for index in reversed(range(len(self._levels))):
+                    spool = self._levels[index]['spool']
+                    spool.seek(0)
+                    shutil.copyfileobj(spool, f, 16 * 1024 * 1024)
+        except Exception:
+            self.abort()
+            raise
+
+        self._cleanup()
+        os.replace(self._tmp_path, self.path)
+
+    # ----------------------------------------------------------------------
+    def _cleanup(self):
+        self._executor.shutdown()
+        for level in self._levels:
+            level['spool'].close()
+            if os.path.exists(level['spool'].name):
+                os.remove(level['spool'].name)
+
+    # ----------------------------------------------------------------------
+    def abort(self):
+        """
+        Remove the partially written files.
+        """
+        self._cleanup()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+# ----------------------------------------------------------------------
+
+
+class mirror_health_tracker(object):
+    """
+    Keeps track of the health of a list of mirror tile servers and picks the mirror
+    that should serve the next request.
+
+    For every mirror, an exponentially weighted moving average (EWMA) of the response
+    latency and of the error rate is kept. The mirrors are picked randomly, weighted
+    by (1 - error_rate) / latency, so that the fastest mirrors get most of the traffic.
+
+    Each mirror has a circuit breaker: after 'max_failures' consecutive failures the
+    circuit opens and the mirror doesn't get any requests for 'cooldown' seconds. After
+    the cooldown, a single probe request is allowed (half-open circuit). If the probe
+    succeeds the circuit closes again, otherwise the cooldown is doubled.
+
+    The class is thread safe.
+    """
+    # ----------------------------------------------------------------------
+
+    def __init__(self, mirrors, alpha=0.2, max_failures=3, cooldown=30.0):
+        self.mirrors = list(mirrors)
+        self.alpha = alpha
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._stats = []
+        for mirror in self.mirrors:
+            self._stats.append({
+                'latency': 1.0,          # EWMA of the latency in seconds
+                'error_rate': 0.0,       # EWMA of the failures (0.0 - 1.0)
+                'requests': 0,
+                'failures': 0,
+                'consecutive_failures': 0,
+                'open_until': 0.0,       # The circuit is open until this time
+                'current_cooldown': cooldown,
+                'probing': False         # A probe request is in flight for a half-open circuit
+            })
+
+    # ----------------------------------------------------------------------
+    def choose(self, exclude=()):
+        """
+        Returns the index of the mirror that should be used for the next request.
+        Mirror indexes in 'exclude' (e.g. mirrors that already failed for the current
+        tile) are not picked, unless there is no other mirror left.
+        """
+        with self._lock:
+            now = time.time()
+            candidates = [i for i in range(len(self.mirrors)) if i not in exclude]
+            if not candidates:
+                candidates = list(range(len(self.mirrors)))
+
+            available = []
+            for i in candidates:
+                stats = self._stats[i]
+                if stats['open_until'] <= now and not stats['probing']:
+                    available.append(i)
+
+            if not available:
+                # All the circuits are open. Use the mirror that will recover first.
+                return min(candidates, key=lambda i: self._stats[i]['open_until'])
+
+            weights = [(1.0 - self._stats[i]['error_rate'] + 0.01) / max(self._stats[i]['latency'], 0.001)
+                       for i in available]
+            chosen = random.choices(available, weights=weights)[0]
+
+            # If the circuit of the chosen mirror was open and the cooldown has passed, this is a probe.
+            if self._stats[chosen]['consecutive_failures'] >= self.max_failures:
+                self._stats[chosen]['probing'] = True
+
+            return chosen
+
+    # ----------------------------------------------------------------------
+    def report_success(self, index, latency):
+        """
+        Report a successful request to the mirror 'index' that took 'latency' seconds
+        """
+        with self._lock:
+            stats = self._stats[index]
+            stats['requests'] += 1
+            stats['latency'] = (1 - self.alpha) * stats['latency'] + self.alpha * latency
+            stats['error_rate'] = (1 - self.alpha) * stats['error_rate']
+            stats['consecutive_failures'] = 0
+            stats['open_until'] = 0.0
+            stats['current_cooldown'] = self.cooldown
+            stats['probing'] = False
+
+    # ----------------------------------------------------------------------
+    def report_failure(self, index):
+        """
+        Report a failed request (connection error, timeout or server error) to the mirror 'index'
+        """
+        with self._lock:
+            stats = self._stats[index]
+            stats['requests'] += 1
+            stats['failures'] += 1
+            stats['error_rate'] = (1 - self.alpha) * stats['error_rate'] + self.alpha
+            stats['consecutive_failures'] += 1
+            if stats['consecutive_failures'] >= self.max_failures:
+                if stats['probing']:
+                    # The probe of a half-open circuit failed. Back off for longer.
+                    stats['current_cooldown'] = min(stats['current_cooldown'] * 2, 3600)
+                else:
+                    LOG.debug("Circuit opened for mirror '{}'".format(self.mirrors[index]))
+                stats['open_until'] = time.time() + stats['current_cooldown']
+            stats['probing'] = False
+
+    # ----------------------------------------------------------------------
+    def report_neutral(self, index):
+        """
+        Report a finished request to the mirror 'index' that says nothing about the health of
+        the mirror (e.g. the tile doesn't exist). A probe of a half-open circuit is finished
+        by it, so that the next request can probe the mirror again.
+        """
+        with self._lock:
+            stats = self._stats[index]
+            stats['requests'] += 1
+            stats['probing'] = False
+
+    # ----------------------------------------------------------------------
+    def summary(self):
+        """
+        Returns a list of strings with the statistics of each mirror
+        """
+        with self._lock:
+            lines = []
+            for mirror, stats in zip(self.mirrors, self._stats):
+                # Do not print the complete URLs of the tile servers (they may contain access tokens)
+                mirror = urllib.parse.urlsplit(str(mirror)).netloc or str(mirror)
+                lines.append("{}: {} requests, {} failures, latency {:.3f}s, error rate {:.1f}%{}".format(
+                    mirror, stats['requests'], stats['failures'], stats['latency'], stats['error_rate'] * 100,
+                    ' (circuit open)' if stats['open_until'] > time.time() else ''))
+            return lines
+
+# ----------------------------------------------------------------------
+
+
+class tile_lease_table(object):
+    """
+    A table of download work units that is shared by several download workers (possibly
+    on different hosts) through an SQLite database on a shared (network) filesystem.
+
+    Each work unit is a rectangle of tiles. A worker claims a unit by taking a lease on it
+    for 'lease_timeout' seconds, downloads the tiles, and marks the unit as done. While
+    the unit is being downloaded, the worker has to renew the lease. If a worker crashes,
+    its lease expires and the unit can be claimed by another worker. A unit with tiles
+    that could not be downloaded is released for a later attempt, and after 'max_attempts'
+    attempts it is marked as failed.
+
+    All the state changes are done in "BEGIN IMMEDIATE" transactions, so that two workers
+    can never claim the same unit at the same time.
+    """
+    # ----------------------------------------------------------------------
+
+    def __init__(self, db_path, lease_timeout=600, max_attempts=5):
+        self.db_path = db_path
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+
+        with self._transaction() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS work_units ("
+                         "id INTEGER PRIMARY KEY, "
+                         "tile_west INTEGER NOT NULL, tile_east INTEGER NOT NULL, "
+                         "tile_north INTEGER NOT NULL, tile_south INTEGER NOT NULL, "
+                         "state TEXT NOT NULL DEFAULT 'pending', "
+                         "worker TEXT, lease_expires REAL, "
+                         "attempts INTEGER NOT NULL DEFAULT 0, failed_tiles INTEGER NOT NULL DEFAULT 0)")
+            # The tile range and the unit size the work units were created for
+            conn.execute("CREATE TABLE IF NOT EXISTS work_layout ("
+                         "tile_west INTEGER NOT NULL, tile_east INTEGER NOT NULL, "
+                         "tile_north INTEGER NOT NULL, tile_south INTEGER NOT NULL, "
+                         "unit_size INTEGER NOT NULL)")
+
+    # ----------------------------------------------------------------------
+    @contextlib.contextmanager
+    def _transaction(self):
+        """
+        Context manager that yields a connection in an immediate (write locked) transaction
+        and commits it when the block exits, or rolls it back if an exception is raised.
+        """
+        conn = sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.close()
+
+    # ----------------------------------------------------------------------
+    def create_units(self, tile_west, tile_east, tile_north, tile_south, unit_size=16, reset=None):
+        """
+        Split the tile range in units of (at most) unit_size x unit_size tiles.
+        Nothing is done if the units have already been created (by another worker) for the same
+        tile range and unit size. Units that were created for a different tile range or unit size
+        (by an earlier run) are replaced.
+
+        reset: None, 'failed' or 'all'. 'failed' puts the failed units back in the pending state
+               with their attempts cleared, so that a new run retries them. 'all' does the same for
+               the units that are done as well, so that all their tiles are checked again.
+
+        Returns the total number of work units.
+        """
+        layout = (tile_west, tile_east, tile_north, tile_south, unit_size)
+        with self._transaction() as conn:
+            if conn.execute("SELECT * FROM work_layout").fetchone() != layout:
+                if conn.execute("SELECT COUNT(*) FROM work_units").fetchone()[0]:
+                    LOG.info("The tile range or the work unit size changed. Creating the work units again.")
+                conn.execute("DELETE FROM work_units")
+                conn.execute("DELETE FROM work_layout")
+                conn.execute("INSERT INTO work_layout VALUES (?, ?, ?, ?, ?)", layout)
+
+                units = []
+                for x in range(tile_west, tile_east + 1, unit_size):
+                    for y in range(tile_north, tile_south + 1, unit_size):
+                        units.append((x, min(x + unit_size - 1, tile_east),
+                                      y, min(y + unit_size - 1, tile_south)))
+                conn.executemany("INSERT INTO work_units (tile_west, tile_east, tile_north, tile_south) "
+                                 "VALUES (?, ?, ?, ?)", units)
+            elif reset is not None:
+                states = ('failed', 'done') if reset == 'all' else ('failed', )
+                conn.execute("UPDATE work_units SET state = 'pending', worker = NULL, lease_expires = NULL, "
+                             "attempts = 0, failed_tiles = 0 WHERE state IN ({})".format(
+                                 ', '.join('?' * len(states))), states)
+
+            total = conn.execute("SELECT COUNT(*) FROM work_units").fetchone()[0]
+
+        return total
+
+    # ----------------------------------------------------------------------
+    def claim(self, worker_id):
+        """
+        Claim a pending work unit, or a unit with an expired lease.
+
+        Returns a (unit_id, tile_west, tile_east, tile_north, tile_south) tuple, or None
+        if there is no unit that can be claimed at the moment.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute("SELECT id, tile_west, tile_east, tile_north, tile_south FROM work_units "
+                               "WHERE state = 'pending' OR (state = 'leased' AND lease_expires < ?) "
+                               "ORDER BY attempts, id LIMIT 1", (now, )).fetchone()
+            if row is not None:
+                conn.execute("UPDATE work_units SET state = 'leased', worker = ?, lease_expires = ?, "
+                             "attempts = attempts + 1 WHERE id = ?", (worker_id, now + self.lease_timeout, row[0]))
+
+        return row
+
+    # ----------------------------------------------------------------------
+    def renew(self, unit_id, worker_id):
+        """
+        Extend the lease of a unit. Returns False if the lease has been lost
+        (it expired and another worker claimed the unit).
+        """
+        with self._transaction() as conn:
+            cur = conn.execute("UPDATE work_units SET lease_expires = ? WHERE id = ? AND worker = ? AND state = 'leased'",
+                               (time.time() + self.lease_timeout, unit_id, worker_id))
+            return cur.rowcount == 1
+
+    # ----------------------------------------------------------------------
+    def complete(self, unit_id, worker_id, failed_tiles=0):
+        """
+        Mark a unit as done. If some of the tiles of the unit failed, the unit is put
+        back in the pending state so that it is retried later (by any worker), unless
+        it has already been attempted max_attempts times.
+        """
+        with self._transaction() as conn:
+            conn.execute("UPDATE work_units SET "
+                         "state = CASE WHEN ? = 0 THEN 'done' WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                         "lease_expires = NULL, failed_tiles = ? WHERE id = ? AND worker = ?",
+                         (failed_tiles, self.max_attempts, failed_tiles, unit_id, worker_id))
+
+    # ----------------------------------------------------------------------
+    def progress(self):
+        """
+        Returns a dictionary with the number of units per state
+        """
+        with self._transaction() as conn:
+            counts = dict(conn.execute("SELECT state, COUNT(*) FROM work_units GROUP BY state").fetchall())
+
+        for state in ('pending', 'leased', 'done', 'failed'):
+            counts.setdefault(state, 0)
+
+        return counts
+
+# ----------------------------------------------------------------------
+
+
+class stitch_manifest(object):
+    """
+    Records the input tiles of every stitch in an SQLite database, so that the stitches are rebuilt only
+    when their tiles change (e.g. when a project is refreshed with newer tiles).
+
+    The inputs of a stitch are the (path, size, mtime, digest) of its tiles (size and mtime are None for
+    missing tiles), together with the parameters of the stitch (its dimensions and crop offsets). A stitch
+    is up to date if its parameters and the size and mtime of all of its tiles are the same as when it
+    was built. If hash_tiles is True, the SHA-1 digest of the tiles is recorded as well, and a tile whose
+    mtime changed is hashed and compared to the recorded digest, so tiles that were downloaded again with
+    the same content don't trigger a rebuild.
+
+    The inputs are read before a stitch is built and recorded after it was built successfully, so a tile
+    that changes while its stitch is being built makes the stitch stale for the next run.
+    """
+    # ----------------------------------------------------------------------
+
+    def __init__(self, db_path, hash_tiles=False):
+        self.db_path = db_path
+        self.hash_tiles = hash_tiles
+
+        with self._connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS stitches ("
+                         "stitch TEXT PRIMARY KEY, params TEXT NOT NULL, inputs TEXT NOT NULL)")
+
+    # ----------------------------------------------------------------------
+    @contextlib.contextmanager
+    def _connection(self):
+        """
+        Context manager that yields a connection in a transaction, and commits it
+        when the block exits (or rolls it back if an exception is raised).
+        """
+        conn = sqlite3.connect(self.db_path, timeout=60)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    # ----------------------------------------------------------------------
+    @staticmethod
+    def _digest(path):
+        """
+        Returns the SHA-1 hex digest of the file 'path'.
+        """
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+                sha1.update(chunk)
+
+        return sha1.hexdigest()
+
+    # ----------------------------------------------------------------------
+    def inputs(self, list_of_files, previous_inputs=None):
+        """
+        Returns the current [path, size, mtime, digest] of the files of list_of_files. The digests are
+        only computed if hash_tiles is True, and they are reused from previous_inputs for the files
+        that didn't change.
+        """
+        previous = {entry[0]: entry for entry in previous_inputs or []}
+        inputs = []
+        for path in list_of_files:
+            try:
+                st = os.stat(path)
+                size, mtime = st.st_size, st.st_mtime_ns
+            except OSError:
+                inputs.append([path, None, None, None])
+                continue
+
+            digest = None
+            if self.hash_tiles:
+                entry = previous.get(path)
+                if entry is not None and entry[1] == size and entry[2] == mtime and entry[3] is not None:
+                    digest = entry[3]
+                else:
+                    digest = self._digest(path)
+            inputs.append([path, size, mtime, digest])
+
+        return inputs
+
+    # ----------------------------------------------------------------------
+    def check(self, stitch, params, list_of_files):
+        """
+        Check if the stitch is up to date.
+
+        Returns a (up_to_date, inputs) tuple, where inputs are the current inputs of the stitch that have
+        to be recorded after the stitch is rebuilt. If the stitch has never been recorded (e.g. it was built
+        by an older version of this script), up_to_date is None.
+        """
+        with self._connection() as conn:
+            row = conn.execute("SELECT params, inputs FROM stitches WHERE stitch = ?", (stitch, )).fetchone()
+
+        if row is None:
+            return None, self.inputs(list_of_files)
+
+        recorded = json.loads(row[1])
+        inputs = self.inputs(list_of_files, recorded)
+        if row[0] != params or len(recorded) != len(inputs):
+            return False, inputs
+
+        up_to_date = True
+        for old, new in zip(recorded, inputs):
+            if old[:3] == new[:3]:
+                continue
+            if (self.hash_tiles and old[0] == new[0] and new[3] is not None and old[3] == new[3]):
+                # The tile was written again with the same content.
+                continue
+            up_to_date = False
+            break
+
+        if up_to_date and recorded != inputs:
+            # Remember the new mtimes of the tiles with the same content, to avoid hashing them again.
+            self.record(stitch, params, inputs)
+
+        return up_to_date, inputs
+
+    # ----------------------------------------------------------------------
+    def record(self, stitch, params, inputs):
+        """
+        Record the inputs of a stitch that was built successfully.
+        """
+        with self._connection() as conn:
+            conn.execute("INSERT OR REPLACE INTO stitches (stitch, params, inputs) VALUES (?, ?, ?)",
+                         (stitch, params, json.dumps(inputs)))
+
+    # ----------------------------------------------------------------------
+    def rename_inputs(self, renamed):
+        """
+        Replace the paths of the recorded inputs with the new paths of the {old_path: new_path} dictionary
+        'renamed' (the size and the mtime of a file don't change when it is moved), so the stitches stay
+        up to date when the tiles are moved to a different layout.
+        """
+        with self._connection() as conn:
+            rows = conn.execute("SELECT stitch, inputs FROM stitches").fetchall()
+            for stitch, inputs in rows:
+                inputs = json.loads(inputs)
+                for entry in inputs:
+                    entry[0] = renamed.get(entry[0], entry[0])
+                conn.execute("UPDATE stitches SET inputs = ? WHERE stitch = ?", (json.dumps(inputs), stitch))
+
+# ----------------------------------------------------------------------
+
+
+class uniform_tile_index(object):
+    """
+    Keeps track of the tiles that have a single solid color, in an SQLite database, so that the stitchers
+    fill their area with the color instead of decoding them.
+
+    Only the tiles up to UNIFORM_TILE_MAX_BYTES are candidates (uniform tiles compress to almost nothing).
+    A candidate is decoded once and checked for a single pixel value, and the result (the color, or NULL
+    if the tile is not uniform) is recorded together with the size and the mtime of the tile, so the tile
+    is not decoded again until it changes.
+
+    The stitching, pyramid and atlas workers check the candidates themselves (see lookup() and
+    check_uniform_tiles()) and the results are recorded with record(), so the thread that dispatches
+    the work only stats the tiles.
+    """
+    # ----------------------------------------------------------------------
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._new_entries = []
+        self._lock = threading.Lock()
+
+        conn = sqlite3.connect(self.db_path, timeout=60)
+        try:
+            with conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS tiles ("
+                             "path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime INTEGER NOT NULL, color INTEGER)")
+            self._entries = {path: (size, mtime, color)
+                             for path, size, mtime, color in conn.execute("SELECT path, size, mtime, color FROM tiles")}
+        finally:
+            conn.close()
+
+    # ----------------------------------------------------------------------
+    def lookup(self, list_of_files):
+        """
+        Returns (colors, unchecked) for the tiles of list_of_files without decoding any tile: the
+        {path: (r, g, b, a)} dictionary of the tiles that are known to have a single color, and the
+        {path: (size, mtime)} dictionary of the candidates that have not been checked since they changed.
+        """
+        colors = {}
+        unchecked = OrderedDict()
+        for path in list_of_files:
+            if path is None or path in colors or path in unchecked:
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if st.st_size > UNIFORM_TILE_MAX_BYTES:
+                continue
+
+            with self._lock:
+                entry = self._entries.get(path)
+            if entry is None or entry[0] != st.st_size or entry[1] != st.st_mtime_ns:
+                unchecked[path] = (st.st_size, st.st_mtime_ns)
+            elif entry[2] is not None:
+                colors[path] = tuple(struct.pack('>I', entry[2]))
+
+        return colors, unchecked
+
+    # ----------------------------------------------------------------------
+    def record(self, entries):
+        """
+        Record the (path, size, mtime, color) entries of check_uniform_tiles(). Safe to call from any thread.
+        """
+        with self._lock:
+            for entry in entries:
+                self._entries[entry[0]] = entry[1:]
+                self._new_entries.append(entry)
+
+    # ----------------------------------------------------------------------
+    def colors(self, list_of_files, tile_cache=None):
+        """
+        Returns a {path: (r, g, b, a)} dictionary with the uniform tiles of list_of_files. The unchecked
+        candidates are checked (decoded through the tile_cache, if any) in the calling thread.
+        """
+        colors, unchecked = self.lookup(list_of_files)
+        entries = check_uniform_tiles(unchecked, tile_cache)
+        self.record(entries)
+        colors.update(uniform_tile_colors(entries))
+
+        return colors
+
+    # ----------------------------------------------------------------------
+    def flush(self):
+        """
+        Record the tiles that were checked since the last flush.
+        """
+        with self._lock:
+            new_entries, self._new_entries = self._new_entries, []
+        if not new_entries:
+            return
+
+        conn = sqlite3.connect(self.db_path, timeout=60)
+        try:
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO tiles (path, size, mtime, color) VALUES (?, ?, ?, ?)",
+                                 new_entries)
+        finally:
+            conn.close()
+
+    # ----------------------------------------------------------------------
+    def rename(self, renamed):
+        """
+        Replace the paths of the recorded tiles with the new paths of the {old_path: new_path} dictionary
+        'renamed', so the tiles are not decoded again after they are moved to a different layout.
+        """
+        self.flush()
+        self._entries = {renamed.get(path, path): entry for path, entry in self._entries.items()}
+
+        conn = sqlite3.connect(self.db_path, timeout=60)
+        try:
+            with conn:
+                conn.execute("DELETE FROM tiles")
+                conn.executemany("INSERT INTO tiles (path, size, mtime, color) VALUES (?, ?, ?, ?)",
+                                 [(path, ) + entry for path, entry in self._entries.items()])
+        finally:
+            conn.close()
+
+# ----------------------------------------------------------------------
+
+
+class stitch_index(object):
+    """
+    A spatial index of the stitches of all the zoom levels of a project, in an SQLite database, to find the
+    stitches that cover a point or a bounding box without opening their calibration files.
+
+    The bounds of the stitches (in degrees) are kept in an SQLite R*Tree (or in a plain table, if the SQLite
+    library was built without the R*Tree module), together with their edges in web mercator (EPSG:3857)
+    meters, so that the pixel coordinates of a point in a stitch are calculated with a linear interpolation.
+    The stitches of a zoom level are replaced every time the zoom level is calibrated.
+
+    #### Sample code ####
+    index = stitch_index('/path/to/project/stitched_maps/.stitch-index.sqlite')
+    for match in index.query(61.05, 9.15):
+        print(match['stitch'], match['x'], match['y'])
+    """
+    # ----------------------------------------------------------------------
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+
+        with self._connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS stitches ("
+                         "id INTEGER PRIMARY KEY, zoom INTEGER NOT NULL, stitch_row INTEGER NOT NULL, "
+                         "stitch_column INTEGER NOT NULL, path TEXT NOT NULL, width INTEGER NOT NULL, height INTEGER NOT NULL, "
+                         "north REAL NOT NULL, south REAL NOT NULL, west REAL NOT NULL, east REAL NOT NULL, "
+                         "left_m REAL NOT NULL, top_m REAL NOT NULL, right_m REAL NOT NULL, bottom_m REAL NOT NULL)")
+            try:
+                conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS stitch_bounds USING rtree(id, west, east, south, north)")
+            except sqlite3.OperationalError:
+                conn.execute("CREATE TABLE IF NOT EXISTS stitch_bounds ("
+                             "id INTEGER PRIMARY KEY, west REAL, east REAL, south REAL, north REAL)")
+
+    # ----------------------------------------------------------------------
+    @contextlib.contextmanager
+    def _connection(self):
+        """
+        Context manager that yields a connection in a transaction, and commits it
+        when the block exits (or rolls it back if an exception is raised).
+        """
+        conn = sqlite3.connect(self.db_path, timeout=60)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    # ----------------------------------------------------------------------
+    def replace_zoom(self, zoom, stitches):
+        """
+        Replace the stitches of the zoom level with 'stitches', a list of (row, column, path, width, height,
+        (north, south, west, east), (left, top, right, bottom)) tuples, with the bounds of every stitch in
+        degrees and in web mercator meters. The paths are relative to the project folder.
+        """
+        with self._connection() as conn:
+            conn.execute("DELETE FROM stitch_bounds WHERE id IN (SELECT id FROM stitches WHERE zoom = ?)", (zoom, ))
+            conn.execute("DELETE FROM stitches WHERE zoom = ?", (zoom, ))
+            for row, column, path, width, height, degrees, meters in stitches:
+                stitch_id = conn.execute(
+                    "INSERT INTO stitches (zoom, stitch_row, stitch_column, path, width, height, north, south, west, east, "
+                    "left_m, top_m, right_m, bottom_m) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (zoom, row, column, path, width, height) + tuple(degrees) + tuple(meters)).lastrowid
+                north, south, west, east = degrees
+                conn.execute("INSERT INTO stitch_bounds (id, west, east, south, north) VALUES (?, ?, ?, ?, ?)",
+                             (stitch_id, west, east, south, north))
+
+    # ----------------------------------------------------------------------
+    def query(self, north, west, south=None, east=None, zooms=None):
+        """
+        Returns the stitches that cover the point north/west (if south and east are None) or that intersect
+        the bounding box north/south/west/east (in degrees), most detailed zoom level first, optionally only
+        for the given zoom levels. Every stitch is returned as a dictionary with its 'zoom', 'stitch' (the path
+        relative to the project folder), 'row', 'column', 'width' and 'height', and the pixel coordinates
+        of the point ('x', 'y') or of the part of the bounding box that is in the stitch ('x0', 'y0', 'x1', 'y1',
+        the right and bottom pixels excluded).
+        """
+        if south is None or east is None:
+            south, east = north, west
+        sql = ("SELECT s.zoom, s.path, s.stitch_row, s.stitch_column, s.width, s.height, "
+               "s.left_m, s.top_m, s.right_m, s.bottom_m FROM stitch_bounds b JOIN stitches s ON s.id = b.id "
+               "WHERE b.west <= ? AND b.east >= ? AND b.south <= ? AND b.north >= ? "
+               "AND s.west <= ? AND s.east >= ? AND s.south <= ? AND s.north >= ?")
+        params = [east, west, north, south] * 2
+        if zooms:
+            sql += " AND s.zoom IN ({})".format(', '.join('?' * len(zooms)))
+            params += list(zooms)
+        sql += " ORDER BY s.zoom DESC, s.stitch_row, s.stitch_column"
+
+        with self._connection() as conn:
+            rows = conn.execute(sql, params).fetchall()
+
+        left, top = mercantile.xy(west, north)
+        right, bottom = mercantile.xy(east, south)
+        matches = []
+        for zoom, path, row, column, width, height, left_m, top_m, right_m, bottom_m in rows:
+            def to_pixels(x, y):
+                return ((x - left_m) / (right_m - left_m) * width, (top_m - y) / (top_m - bottom_m) * height)
+
+            match = OrderedDict([('zoom', zoom), ('stitch', path), ('row', row), ('column', column),
+                                 ('width', width), ('height', height)])
+            if (north, west) == (south, east):
+                x, y = to_pixels(left, top)
+                match['x'] = min(max(int(math.floor(x)), 0), width - 1)
+                match['y'] = min(max(int(math.floor(y)), 0), height - 1)
+            else:
+                x0, y0 = to_pixels(left, top)
+                x1, y1 = to_pixels(right, bottom)
+                match['x0'] = min(max(int(math.floor(x0)), 0), width)
+                match['y0'] = min(max(int(math.floor(y0)), 0), height)
+                match['x1'] = min(max(int(math.ceil(x1)), 0), width)
+                match['y1'] = min(max(int(math.ceil(y1)), 0), height)
+            matches.append(match)
+
+        return matches
+
+# ----------------------------------------------------------------------
+
+########################################
+###### Configure logging behavior ######
+########################################
+# No need to change anything here
+
+
+def _configureLogging(loglevel):
+    """
+    Configures the default logger.
+
+    If the log level is set to NOTSET (0), the
+    logging is disabled
+
+    # More info here: https://docs.python.org/2/howto/logging.html
+    """
+    numeric_log_level = getattr(logging, loglevel.upper(), None)
+    try:
+        if not isinstance(numeric_log_level, int):
+            raise ValueError()
+    except ValueError:
+        error_and_exit('Invalid log level: %s\n'
+                       '\tLog level must be set to one of the following:\n'
+                       '\t   CRITICAL <- Least verbose\n'
+                       '\t   ERROR\n'
+                       '\t   WARNING\n'
+                       '\t   INFO\n'
+                       '\t   DEBUG    <- Most verbose' % loglevel)
+
+    defaultLogger = logging.getLogger('default')
+
+    # If numeric_log_level == 0 (NOTSET), disable logging.
+    if not numeric_log_level:
+        numeric_log_level = 1000
+    defaultLogger.setLevel(numeric_log_level)
+
+    logFormatter = logging.Formatter()
+
+    defaultHandler = logging.StreamHandler()
+    defaultHandler.setFormatter(logFormatter)
+
+    defaultLogger.addHandler(defaultHandler)
+
+#######################################################
+###### Add command line options in this function ######
+#######################################################
+# Add the user defined command line arguments in this function
+
+
+class SmartFormatter(argparse.HelpFormatter):
+
+    def _split_lines(self, text, width):
+        # this is the RawTextHelpFormatter._split_lines
+        if text.startswith('R|'):
+            return text[2:].splitlines()
+        return argparse.HelpFormatter._split_lines(self, text, width)
+# ----------------------------------------------------------------------
+
+
+def _command_Line_Options():
+    """
+    Define the accepted command line arguments in this function
+
+    Read the documentation of argparse for more advanced command line
+    argument parsing examples
+    http://docs.python.org/2/library/argparse.html
+    """
+    # The area and the zoom levels are not needed to query the stitch index of a project.
+    query_parser = argparse.ArgumentParser(add_help=False)
+    query_parser.add_argument("--query")
+    is_query = query_parser.parse_known_args()[0].query is not None
+
+    parser = argparse.ArgumentParser(
+        description='OSM Tile Stitcher' + " version " + __version__, formatter_class=SmartFormatter)
+    parser.add_argument("-v", "--version",
+                        action="version", default=argparse.SUPPRESS,
+                        version=__version__,
+                        help="show program's version number and exit")
+
+    loggingGroupOpts = parser.add_argument_group(
+        'Logging Options', 'List of optional logging options')
+    loggingGroupOpts.add_argument("-q", "--quiet",
+                                  action="store_true",
+                                  default=False,
+                                  dest="isQuiet",
+                                  help="Disable logging in the console. Nothing will be printed.")
+    loggingGroupOpts.add_argument("--log-level",
+                                  action="store",
+                                  default="INFO",
+                                  dest="loglevel",
+                                  metavar="LOG_LEVEL",
+                                  help="LOG_LEVEL might be set to: CRITICAL, ERROR, WARNING, INFO, DEBUG. (Default: INFO)")
+
+    parser.add_argument("-p", "--project-folder",
+                        action="store",
+                        default='maps_project',
+                        dest="project_folder",
+                        help="Choose a project name. The downloaded data and stitching operations will all be made under this folder.\n"
+                        "Default project folder: 'maps_project'")
+    parser.add_argument("-z", "--zoom-level",
+                        action="store",
+                        dest="zoom_level",
+                        required=not is_query,
+                        help="The tile zoom level for download. Accepts an integer or a range like '1-10' or '1,4,7-9', for downloading multiple zoom levels for the given coordinates.")
+    parser.add_argument("-w", "--long1",
+                        action="store",
+                        type=float,
+                        dest="long1",
+                        metavar="W_DEGREES",
+                        required=not is_query,
+                        help="The western (W) longtitude of the bounding box for tile downloading. Accepted values: -180 to 179.999.")
+    parser.add_argument("-e", "--long2",
+                        action="store",
+                        type=float,
+                        dest="long2",
+                        metavar="E_DEGREES",
+                        required=not is_query,
+                        help="The eastern (E) longtitude of the bounding box for tile downloading. Accepted values: -180 to 179.999.")
+    parser.add_argument("-n", "--lat1",
+                        action="store",
+                        type=float,
+                        dest="lat1",
+                        metavar="N_DEGREES",
+                        required=not is_query,
+                        help="The northern (N) latitude of the bounding box for tile downloading. Accepted values: -85.05112 to 85.05113.")
+    parser.add_argument("-s", "--lat2",
+                        action="store",
+                        type=float,
                         dest="lat2",
                         metavar="S_DEGREES",
-                        required=True,
+                        required=not is_query,
                         help="The southern (S) latitude of the bounding box for tile downloading. Accepted values: -85.05112 to 85.05113.")
     parser.add_argument("-o", "--custom-osm-server",
                         action="store",
@@ -894,6 +3476,30 @@ def _command_Line_Options():
                         "     'original' <- This is the default and it will\n"
                         "                   just save the tiles in the format\n"
                         "                   provided by the provider.")
+    parser.add_argument("--optimize-tiles",
+                        action="store",
+                        dest="tile_storage",
+                        choices=["original", "png", "webp"],
+                        default="original",
+                        metavar="STORAGE",
+                        help="R|Re-encode the downloaded tiles in the background to\n"
+                        "save disk space and read I/O when stitching.\n"
+                        "  Available choices:\n"
+                        "     'original' <- This is the default. The tiles are\n"
+                        "                   stored as they are downloaded.\n"
+                        "     'png'      <- Losslessly re-deflate PNG tiles with\n"
+                        "                   the maximum compression level.\n"
+                        "     'webp'     <- Re-encode non-JPEG tiles to lossless\n"
+                        "                   WebP (needs graphicsmagick with WebP\n"
+                        "                   support).")
+    parser.add_argument("--optimizer-threads",
+                        action="store",
+                        type=int,
+                        default=1,
+                        metavar="OPT_THREADS",
+                        dest="optimizer_threads",
+                        help="Number of low priority background threads that re-encode the tiles when --optimize-tiles is used."
+                        " Default number of optimizer threads: 1")
     parser.add_argument("--save-stitched-tile-format",
                         action="store",
                         dest="stitched_tile_format",
@@ -904,6 +3510,99 @@ def _command_Line_Options():
                         "  Available choices:\n"
                         "     'png' (default)\n"
                         "     'jpg'\n")
+    parser.add_argument("--stitch-engine",
+                        action="store",
+                        dest="stitch_engine",
+                        choices=["native", "streaming", "memmap", "jpegtran", "montage"],
+                        default="native",
+                        metavar="ENGINE",
+                        help="R|The engine that is used to stitch the tiles.\n"
+                        "  Available choices:\n"
+                        "     'native'    <- This is the default. The tiles are\n"
+                        "                    decoded once in an in-memory canvas\n"
+                        "                    and the stitch is encoded once.\n"
+                        "     'streaming' <- The stitch is assembled and written\n"
+                        "                    one row of tiles at a time, so the\n"
+                        "                    memory usage does not depend on the\n"
+                        "                    size of the stitch. Use it for very\n"
+                        "                    large stitches (e.g. with a large -m).\n"
+                        "                    Only for png stitches.\n"
+                        "     'memmap'    <- Each stitch is assembled in a memory\n"
+                        "                    mapped file in the project folder by\n"
+                        "                    all the stitching threads in parallel\n"
+                        "                    (one row of tiles per thread), and\n"
+                        "                    encoded from the mapped file. Use it to\n"
+                        "                    stitch very large stitches with all\n"
+                        "                    the cores. Needs free disk space for\n"
+                        "                    the raw RGBA pixels of the stitches.\n"
+                        "     'jpegtran'  <- JPEG tiles are joined losslessly in the\n"
+                        "                    DCT domain with jpegtran (no decoding,\n"
+                        "                    no generation loss). Only for jpg\n"
+                        "                    stitches. Stitches whose crop offsets\n"
+                        "                    are not aligned to the JPEG blocks\n"
+                        "                    fall back to 'native'; use it with\n"
+                        "                    --stitch-layout tile-aligned.\n"
+                        "     'montage'   <- Use the gm/imagemagick montage\n"
+                        "                    command line utility.")
+    parser.add_argument("--stitch-layout",
+                        action="store",
+                        dest="stitch_layout",
+                        choices=STITCH_LAYOUTS + ["auto"],
+                        default="exact",
+                        metavar="LAYOUT",
+                        help="R|How the stitched area is split in stitches that are\n"
+                        "not larger than the max resolution (-m).\n"
+                        "  Available choices:\n"
+                        "     'exact'        <- This is the default. All the stitches\n"
+                        "                       have the same size.\n"
+                        "     'tile-aligned' <- The stitches start and end at tile\n"
+                        "                       boundaries, so no tile is decoded\n"
+                        "                       twice. The stitch sizes differ at\n"
+                        "                       most by one tile.\n"
+                        "     'remainder'    <- Stitches of the max resolution and a\n"
+                        "                       smaller stitch with the remaining\n"
+                        "                       pixels (the fewest stitches).\n"
+                        "     'auto'         <- Choose the layout with the lowest cost.\n"
+                        "Use --plan to compare the layouts.")
+    parser.add_argument("--tile-cache-size",
+                        action="store",
+                        type=int,
+                        default=256,
+                        metavar="MB",
+                        dest="tile_cache_mb",
+                        help="The stitching threads share a cache of MB megabytes of decoded tiles, so that the tiles on the"
+                        " boundaries of neighbouring stitches are decoded only once. Use 0 to disable the cache."
+                        " With --stitch-executor process, the MB are split between the worker processes."
+                        " It is not used by the montage stitch engine. Default: 256")
+    parser.add_argument("--prefetch-depth",
+                        action="store",
+                        type=int,
+                        default=0,
+                        metavar="READERS",
+                        dest="prefetch_depth",
+                        help="Read the tiles of the next {} stitches ahead of the stitching workers with READERS"
+                        " parallel readers, so that the workers don't wait for the disk. Useful for projects on"
+                        " spinning disks or network storage (e.g. 8-32 readers). The read throughput is reported"
+                        " after the stitching. Default: 0 (no prefetching)".format(PREFETCH_STITCHES_AHEAD))
+    parser.add_argument("--plan",
+                        action="store_true",
+                        dest="plan",
+                        help="Show the stitch layouts and their cost (stitches, decoded pixels, largest stitch)"
+                        " for each zoom level, and exit without downloading or stitching anything.")
+    parser.add_argument("--preview",
+                        action="store",
+                        nargs='?',
+                        const='auto',
+                        default=None,
+                        type=int,
+                        metavar="LEVELS",
+                        dest="preview",
+                        help="Generate a quick-look preview of the stitches of each zoom level from the tiles of the zoom"
+                        " level that is LEVELS levels lower (downloaded if needed), and exit without downloading or"
+                        " stitching the tiles of the zoom level itself. The previews, their OziExplorer calibration files"
+                        " and the index images (with the layout of the final stitches) are saved in the folder 'preview'"
+                        " of the project folder. Without LEVELS, the lowest zoom level where the largest stitch is at"
+                        " least 512 pixels is used.")
     parser.add_argument("-r", "--retry-failed",
                         action="store_true",
                         dest="retry_failed",
@@ -919,6 +3618,44 @@ def _command_Line_Options():
                         " is always a good idea to NOT skip the downloading. Keep in mind that the"
                         " downloading function will not re-download already downloaded (cached) tiles,"
                         " so you can always resume downloads.")
+    parser.add_argument("--skip-download-verification",
+                        action="store_false",
+                        dest="verify_downloads",
+                        help="Do not verify the size and the integrity (PNG CRCs, JPEG end marker) of the downloaded tiles"
+                        " before they are saved.")
+    parser.add_argument("--deep-verify-tiles",
+                        action="store_true",
+                        dest="deep_verify_tiles",
+                        help="Fully decode the already downloaded tiles when resuming a download in order to verify them."
+                        " Tiles are saved atomically, so this is only needed for projects downloaded with older versions"
+                        " of this script.")
+    parser.add_argument("--coordinator",
+                        action="store_true",
+                        dest="coordinator",
+                        help="Distributed download: split the tiles in work units in a lease table in the project folder,"
+                        " download units together with the --worker processes that share the same project folder (e.g. on"
+                        " a network filesystem), and continue with stitching when all the units have been downloaded.")
+    parser.add_argument("--worker",
+                        action="store_true",
+                        dest="worker",
+                        help="Distributed download: claim and download work units from the lease table in the project folder"
+                        " and exit when there are no units left. Workers do not stitch or calibrate. Start several workers"
+                        " on the same or on different hosts with exactly the same arguments.")
+    parser.add_argument("--work-unit-size",
+                        action="store",
+                        type=int,
+                        default=16,
+                        metavar="TILES",
+                        dest="work_unit_size",
+                        help="Distributed download: each work unit is a square of TILES x TILES tiles. Default: 16")
+    parser.add_argument("--lease-timeout",
+                        action="store",
+                        type=int,
+                        default=600,
+                        metavar="SECONDS",
+                        dest="lease_timeout",
+                        help="Distributed download: a work unit of a worker that has not renewed its lease for SECONDS"
+                        " (e.g. because it crashed) is handed to another worker. Default: 600")
     parser.add_argument("-k", "--skip-stitching",
                         action="store_true",
                         dest="skip_stitching",
@@ -927,6 +3664,62 @@ def _command_Line_Options():
                         action="store_true",
                         dest="only_calibrate",
                         help="When this option is enabled, the script will not download or stitch any tiles. Only OziExplorer calibration files will be generated.")
+    parser.add_argument("--geotiff",
+                        action="store_true",
+                        dest="geotiff",
+                        help="Stitch all the tiles of each zoom level in one tiled and compressed BigTIFF with internal"
+                        " overviews (Cloud Optimized GeoTIFF layout), georeferenced in EPSG:3857."
+                        " The file is saved as 'stitched_maps/ZOOM.tif' in the project folder.")
+    parser.add_argument("--pyramid",
+                        action="store",
+                        dest="pyramid",
+                        choices=["dzi", "xyz"],
+                        default=None,
+                        metavar="LAYOUT",
+                        help="R|Export all the tiles of each zoom level as one image pyramid\n"
+                        "for web viewers (e.g. OpenSeadragon, Leaflet), in the folder\n"
+                        "'pyramid' of the project folder. Only the pyramid tiles whose\n"
+                        "source tiles have changed are built again on a rerun.\n"
+                        "  Available choices:\n"
+                        "     'dzi': Deep Zoom Image ('ZOOM.dzi' and 'ZOOM_files/')\n"
+                        "     'xyz': 'ZOOM/Z/X/Y.EXT' tiles, with the whole image in\n"
+                        "            Z = 0")
+    parser.add_argument("--pyramid-tile-size",
+                        action="store",
+                        type=int,
+                        default=512,
+                        metavar="PIXELS",
+                        dest="pyramid_tile_size",
+                        help="The width and height of the tiles of the pyramid (see --pyramid). Default: 512")
+    parser.add_argument("--atlas",
+                        action="store",
+                        choices=list(PAPER_SIZES.keys()),
+                        default=None,
+                        metavar="PAPER",
+                        dest="atlas",
+                        help="R|Cut the map of each zoom level in sheets of the PAPER\n"
+                        "size for print at --dpi, without shrinking it (use\n"
+                        "--paper-scale or --output-scale to choose the map\n"
+                        "scale). The sheets are rendered in parallel from the\n"
+                        "tiles, with a grid, a compass, a scale ruler and an\n"
+                        "OziExplorer calibration file, in the folder 'atlas'\n"
+                        "of the project folder. Paper sizes:\n" +
+                        '\n'.join(["   * {} ({}x{} mm)".format(p, *PAPER_SIZES[p]) for p in PAPER_SIZES]))
+    parser.add_argument("--atlas-orientation",
+                        action="store",
+                        choices=['auto', 'portrait', 'landscape'],
+                        default='auto',
+                        dest="atlas_orientation",
+                        help="The orientation of the atlas sheets (see --atlas). 'auto' chooses the orientation with"
+                        " the fewest sheets. Default: auto")
+    parser.add_argument("--atlas-overlap",
+                        action="store",
+                        type=float,
+                        default=10,
+                        metavar="MM",
+                        dest="atlas_overlap",
+                        help="The overlap of the maps of neighbouring atlas sheets in millimeters (see --atlas)."
+                        " Default: 10")
     parser.add_argument("--prepare-printout-maps",
                         action="store_true",
                         dest="printout",
@@ -953,12 +3746,158 @@ def _command_Line_Options():
     parser.add_argument("--stitching-threads",
                         action="store",
                         type=int,
-                        default=get_physical_cores(),
+                        default=None,
                         metavar="STITCH_THREADS",
                         dest="stitching_threads",
-                        help="The stitching of the tiles is threaded."
-                        " This option defines the number of concurrent stitching threads. Default number of sitching"
-                        " threads corresponds to the number of available cores in your system: {}".format(get_physical_cores()))
+                        help="The stitching of the tiles is parallelized."
+                        " This option defines the number of concurrent stitching workers. By default, the number of"
+                        " physical cores in your system ({}) is used, but not more workers than the available memory"
+                        " can hold for the size of the stitches.".format(get_physical_cores()))
+    parser.add_argument("--encoder-threads",
+                        action="store",
+                        type=int,
+                        default=None,
+                        metavar="ENCODER_THREADS",
+                        dest="encoder_threads",
+                        help="The number of threads that compress every PNG stitch in parallel (not used by the"
+                        " montage stitch engine). By default, the physical cores are shared by the stitching"
+                        " workers, so that every stitch is compressed by several cores when there are fewer"
+                        " stitches than cores.")
+    parser.add_argument("--stitch-executor",
+                        action="store",
+                        dest="stitch_executor",
+                        choices=["process", "thread"],
+                        default="process",
+                        metavar="EXECUTOR",
+                        help="R|How the stitching workers run.\n"
+                        "  Available choices:\n"
+                        "     'process' <- This is the default. The stitches are\n"
+                        "                  stitched in worker processes, which are\n"
+                        "                  recycled after a number of stitches and\n"
+                        "                  have a memory limit each.\n"
+                        "     'thread'  <- The stitches are stitched in threads.\n"
+                        "The montage stitch engine always uses threads.")
+    parser.add_argument("--skip-uniform-stitches",
+                        action="store_true",
+                        dest="skip_uniform_stitches",
+                        help="Tiles with a single solid color (sea, empty overlay tiles) are never decoded when"
+                        " stitching. With this option, stitches that consist only of tiles with the same color are"
+                        " not written at all (only their thumbnail for the index images), and no paper friendly"
+                        " maps are prepared for them.")
+    parser.add_argument("--output-scale",
+                        action="store",
+                        type=float,
+                        default=1.0,
+                        metavar="FACTOR",
+                        dest="output_scale",
+                        help="Scale the stitches by FACTOR (1/1024 <= FACTOR <= 1) while the tiles are stitched, e.g. 0.7 for"
+                        " stitches with 70%% of the resolution of the zoom level. The memory and the time of the"
+                        " stitching are proportional to the scaled stitches. The calibration files and the scale"
+                        " ruler of the paper friendly maps match the scaled stitches. Default: 1")
+    parser.add_argument("--paper-scale",
+                        action="store",
+                        type=int,
+                        default=None,
+                        metavar="DENOMINATOR",
+                        dest="paper_scale",
+                        help="Scale the stitches so that they are printed at a map scale of 1:DENOMINATOR at --dpi dots"
+                        " per inch (in the middle of the area). The zoom level must be detailed enough for this map"
+                        " scale. Cannot be used with --output-scale.")
+    parser.add_argument("--dpi",
+                        action="store",
+                        type=int,
+                        default=300,
+                        metavar="DPI",
+                        dest="dpi",
+                        help="The printing resolution for --paper-scale, in dots per inch. Default: 300")
+    parser.add_argument("--quantize-colors",
+                        action="store",
+                        type=int,
+                        default=0,
+                        metavar="COLORS",
+                        dest="quantize_colors",
+                        help="Write the png stitches as indexed color pngs with a palette of at most COLORS (2-256)"
+                        " colors, which are several times smaller for maps with few colors. The palette is chosen"
+                        " with median cut and k-means. Stitches with too many colors for a palette (e.g. aerial"
+                        " imagery, see --quantize-max-error) are written in true color. Only the native and the"
+                        " memmap stitch engines quantize the stitches. Default: 0 (true color)")
+    parser.add_argument("--dither",
+                        action="store_true",
+                        dest="dither",
+                        help="Add an ordered dither to the stitches before they are quantized (see --quantize-colors),"
+                        " to avoid banding in color gradients.")
+    parser.add_argument("--quantize-max-error",
+                        action="store",
+                        type=float,
+                        default=6.0,
+                        metavar="RMSE",
+                        dest="quantize_max_error",
+                        help="Stitches whose palette has a root mean square error (per channel, 0-255) larger than RMSE"
+                        " are written in true color (see --quantize-colors). Default: 6")
+    parser.add_argument("--tile-layout",
+                        action="store",
+                        choices=TILE_LAYOUTS,
+                        default=None,
+                        dest="tile_layout",
+                        help="R|The folder layout of the downloaded tiles of new\n"
+                        "zoom levels:\n"
+                        "   * flat: ZOOM/X/Y.EXT\n"
+                        "   * sharded: ZOOM/X/256/X/Y/256/Y.EXT (where X/256 and\n"
+                        "     Y/256 are integer divisions), so that no folder\n"
+                        "     has more than 256 entries, for zoom levels with\n"
+                        "     millions of tiles.\n"
+                        "The layout is recorded in the zoom-N.conf file of the\n"
+                        "zoom level, and the existing zoom levels keep their\n"
+                        "layout (see --migrate-tile-layout). Default: flat")
+    parser.add_argument("--migrate-tile-layout",
+                        action="store",
+                        choices=TILE_LAYOUTS,
+                        default=None,
+                        dest="migrate_tile_layout",
+                        help="Move the downloaded tiles of the zoom levels of an existing project to the given layout"
+                        " (see --tile-layout), and exit. The stitches are not stitched again because of the migration.")
+    parser.add_argument("--overlay-project",
+                        action="store",
+                        default=None,
+                        metavar="OVERLAY_PROJECT_FOLDER",
+                        dest="overlay_project",
+                        help="Compose the downloaded tiles of the project (the base layer) with the tiles of the"
+                        " OVERLAY_PROJECT_FOLDER project (e.g. hiking paths), which must have been downloaded for the"
+                        " same area and zoom levels, save the composed tiles in --overlay-destination, and exit. The"
+                        " destination project can then be stitched like any other project (with --skip-downloading)."
+                        " This replaces the overlay-tiles.sh script.")
+    parser.add_argument("--overlay-destination",
+                        action="store",
+                        default=None,
+                        metavar="DESTINATION_PROJECT_FOLDER",
+                        dest="overlay_destination",
+                        help="The project folder of the composed tiles (see --overlay-project).")
+    parser.add_argument("--overlay-opacity",
+                        action="store",
+                        type=float,
+                        default=1.0,
+                        metavar="OPACITY",
+                        dest="overlay_opacity",
+                        help="The opacity of the overlay layer (see --overlay-project), from 0 (fully transparent) to"
+                        " 1 (opaque as downloaded). Default: 1")
+    parser.add_argument("--query",
+                        action="store",
+                        default=None,
+                        metavar="LAT,LON|N,S,W,E",
+                        dest="query",
+                        help="Print the stitches of the project that cover the point LAT,LON (or intersect the bounding"
+                        " box N,S,W,E), most detailed zoom level first, with the pixel coordinates of the point (or of the"
+                        " bounding box) in each stitch, as one JSON object per line, and exit. Use -z to query only some"
+                        " zoom levels. The stitches are indexed when they are calibrated. Use --query=LAT,LON if the"
+                        " first coordinate is negative.")
+    parser.add_argument("--hash-tiles",
+                        action="store_true",
+                        dest="hash_tiles",
+                        help="The tiles of every stitch are recorded (size and modification time), so that only the"
+                        " stitches with changed tiles are stitched again, together with their thumbnails, the index"
+                        " images and the paper friendly maps. With this option, the SHA-1 hashes of the tiles are"
+                        " recorded too, so that tiles that were downloaded again with the same content don't cause"
+                        " a stitch to be stitched again.")
     parser.add_argument("-t", "--tile-server-provider",
                         action="store",
                         dest="tile_server_provider",
@@ -1025,6 +3964,37 @@ def expand_zoom_levels(zoom_levels):
 # ----------------------------------------------------------------------
 
 
+def query_stitch_index(options):
+    """
+    Print the stitches of the project that match the --query point or bounding box (see stitch_index.query()),
+    one JSON object per line.
+    """
+    coordinates = split_strip(options.query)
+    if len(coordinates) not in (2, 4) or not all(is_number(c) for c in coordinates):
+        error_and_exit("The query should be a point 'LAT,LON' or a bounding box 'N,S,W,E' in degrees.")
+    coordinates = [float(c) for c in coordinates]
+
+    index_path = os.path.join(os.path.abspath(options.project_folder), 'stitched_maps', '.stitch-index.sqlite')
+    if not os.path.isfile(index_path):
+        error_and_exit("The project '{}' has no stitch index. The stitches are indexed when they are calibrated.".format(
+            options.project_folder))
+
+    zooms = expand_zoom_levels(options.zoom_level) if options.zoom_level else None
+    if len(coordinates) == 2:
+        matches = stitch_index(index_path).query(coordinates[0], coordinates[1], zooms=zooms)
+    else:
+        north, south, west, east = coordinates
+        matches = stitch_index(index_path).query(max(north, south), min(west, east), min(north, south),
+                                                 max(west, east), zooms=zooms)
+
+    for match in matches:
+        print_(json.dumps(match))
+    if not matches:
+        LOG.warning("No stitch of the project covers {}.".format(options.query))
+
+# ----------------------------------------------------------------------
+
+
 def validate_arguments(options):
     """
     Validate and prepare the command line arguments.
@@ -1034,12 +4004,68 @@ def validate_arguments(options):
     # Check if the project dir exists. If no, try to create it.
     options.project_folder = os.path.abspath(options.project_folder)
 
-    if not os.path.isdir(options.project_folder):
-        os.mkdir(options.project_folder)
+    os.makedirs(options.project_folder, exist_ok=True)
 
     # Validate and expand the given zoom level(s)
     options.zoom_level = expand_zoom_levels(options.zoom_level)
 
+    if options.coordinator and options.worker:
+        error_and_exit("A process can be either a --coordinator or a --worker, not both.")
+
+    if options.prefetch_depth < 0:
+        error_and_exit("The prefetch depth should be 0 (no prefetching) or a positive number of readers.")
+
+    if options.work_unit_size < 1:
+        error_and_exit("The work unit size should be at least 1 tile.")
+
+    if not 1.0 / OUTPUT_SCALE_DENOMINATOR <= options.output_scale <= 1:
+        error_and_exit("The output scale should be at least 1/{} and at most 1.".format(OUTPUT_SCALE_DENOMINATOR))
+
+    if options.paper_scale is not None:
+        if options.output_scale != 1:
+            error_and_exit("The --paper-scale and --output-scale options cannot be used together.")
+        if options.paper_scale < 1 or options.dpi < 1:
+            error_and_exit("The paper scale and the DPI should be positive numbers.")
+
+    if options.quantize_colors:
+        if not 2 <= options.quantize_colors <= 256:
+            error_and_exit("The palette of the quantized stitches should have 2 to 256 colors.")
+        if options.stitched_tile_format != 'png':
+            error_and_exit("Only png stitches can be quantized.")
+        if options.stitch_engine not in ('native', 'memmap'):
+            error_and_exit("Only the native and the memmap stitch engines can quantize the stitches.")
+
+    if options.overlay_project or options.overlay_destination:
+        if not options.overlay_project or not options.overlay_destination:
+            error_and_exit("Both --overlay-project and --overlay-destination are required to overlay the tiles.")
+        options.overlay_project = os.path.abspath(options.overlay_project)
+        options.overlay_destination = os.path.abspath(options.overlay_destination)
+        if not os.path.isdir(options.overlay_project):
+            error_and_exit("The overlay project '{}' is not a directory.".format(options.overlay_project))
+        if options.overlay_destination in (options.project_folder, options.overlay_project):
+            error_and_exit("The overlay destination should be different than the project folder and the overlay project.")
+        if not 0 <= options.overlay_opacity <= 1:
+            error_and_exit("The overlay opacity should be between 0 and 1.")
+
+    if options.preview not in (None, 'auto') and options.preview < 1:
+        error_and_exit("The preview should be at least 1 zoom level lower than the zoom level.")
+
+    if options.atlas_overlap < 0:
+        error_and_exit("The overlap of the atlas sheets should not be negative.")
+
+    if options.pyramid_tile_size < 16:
+        error_and_exit("The tile size of the pyramid should be at least 16 pixels.")
+
+    if options.stitch_engine == 'streaming' and options.stitched_tile_format != 'png':
+        error_and_exit("The streaming stitch engine can only save png stitches.")
+
+    if options.stitch_engine == 'jpegtran':
+        if options.stitched_tile_format != 'jpg':
+            error_and_exit("The jpegtran stitch engine can only save jpg stitches.")
+        if which('jpegtran') is None:
+            error_and_exit('The command `jpegtran` (provided by libjpeg-turbo or libjpeg) could not be found in your $PATH\n'
+                           'Please install it before you use the jpegtran stitch engine.')
+
     # Validate the coordinates (we do not need to check if the coordinates are valid numbers. Argparse is already doing this for us)
     if (options.long1 < -180 or options.long1 > 179.999) or (options.long2 < -180 or options.long2 > 179.999):
         error_and_exit(
@@ -1199,7 +4225,9 @@ def read_zoom_config(zoom, options):
             config = configparser.ConfigParser()
             config.read(zoom_conf)
 
-            if config.has_section(main_config_section):
+            # The zoom levels that were only downloaded for a preview have a configuration file with
+            # just the layout of their tiles (see stitch_osm_tiles.download_tiles()).
+            if config.has_section(main_config_section) and config.has_option(main_config_section, 'zoom'):
                 for key, val in options.items():
                     # val.values().pop() returns either 0 or 1, indicating if we
                     # care to check this option.
@@ -1260,6 +4288,70 @@ def write_zoom_config(zoom_conf, options, section_to_write):
 
         config.write(cfgfile)
 
+# ----------------------------------------------------------------------
+
+
+def read_tile_layout(project_folder, zoom):
+    """
+    Returns the layout of the tiles of the zoom level of the project (see TILE_LAYOUTS), as it is recorded
+    in its zoom configuration file. Projects that were created before the layout was recorded have the
+    'flat' layout. Returns None if the zoom level has no configuration file yet.
+    """
+    zoom_conf = os.path.join(project_folder, 'zoom-{}.conf'.format(zoom))
+    if not os.path.isfile(zoom_conf):
+        return None
+
+    config = configparser.ConfigParser()
+    config.read(zoom_conf)
+    section = "Zoom-{}-Settings".format(zoom)
+    if config.has_option(section, 'tile_layout'):
+        return config.get(section, 'tile_layout')
+
+    return 'flat'
+
+# ----------------------------------------------------------------------
+
+
+def write_tile_layout(project_folder, zoom, layout):
+    """
+    Records the layout of the tiles of the zoom level in its zoom configuration file.
+    """
+    zoom_conf = os.path.join(project_folder, 'zoom-{}.conf'.format(zoom))
+    section = "Zoom-{}-Settings".format(zoom)
+    config = configparser.ConfigParser()
+    config.read(zoom_conf)
+    if not config.has_section(section):
+        config.add_section(section)
+    config.set(section, 'tile_layout', layout)
+    with open(zoom_conf, 'w') as cfgfile:
+        config.write(cfgfile)
+
+# ----------------------------------------------------------------------
+
+
+def replace_export_parameters(conf_path, section, parameters):
+    """
+    Records the {name: value} parameters of an export (e.g. the tile size and the area of a pyramid) in the
+    configuration file conf_path, and returns True if they differ from the parameters that were recorded by
+    the previous export, or if there was no previous export. The outputs of an export with other parameters
+    cannot be reused, even if they are newer than their inputs.
+    """
+    config = configparser.ConfigParser()
+    config.read(conf_path)
+    parameters = OrderedDict((name, str(value)) for name, value in parameters.items())
+    if config.has_section(section) and OrderedDict(config.items(section)) == parameters:
+        return False
+
+    if config.has_section(section):
+        config.remove_section(section)
+    config.add_section(section)
+    for name, value in parameters.items():
+        config.set(section, name, value)
+    with open(conf_path, 'w') as cfgfile:
+        config.write(cfgfile)
+
+    return True
+
 
 ########################################################################
 class stitch_osm_tiles(object):
@@ -1277,7 +4369,24 @@ class stitch_osm_tiles(object):
                  saved_stitched_tile_format='png',
                  max_stitch_dimensions=10000,
                  parallelDownloadThreads=10,
-                 parallelStitchingThreads=1):
+                 parallelStitchingThreads=1,
+                 tile_storage='original',
+                 parallelOptimizerThreads=1,
+                 verify_downloads=True,
+                 deep_verify_tiles=False,
+                 stitch_engine='native',
+                 stitch_layout='exact',
+                 tile_cache_mb=256,
+                 prefetch_depth=0,
+                 stitch_executor='process',
+                 hash_tiles=False,
+                 encoder_threads=None,
+                 skip_uniform_stitches=False,
+                 output_scale=1,
+                 quantize_colors=0,
+                 dither=False,
+                 quantize_max_error=6.0,
+                 tile_layout='flat'):
         """
         zoom: The zoom level where the class will be working with for downloading and stitching.
         project_folder: Project folder defines where the tiles will be downloaded and where the stitches will
@@ -1307,6 +4416,10 @@ class stitch_osm_tiles(object):
                       def dynGetTileUrl(z, x, y, download_counter):
                           return "https://map.eniro.com/geowebcache/service/tms1.0.0/{layer}/{}/{}/{}.{ext}".format(z, x, ((1 << z) - 1 - y))"]
 
+                      If the code also defines a 'dynTileMirrors' list, dynGetTileUrl must accept a 'mirror' keyword
+                      argument, and the mirror of each request is picked based on the health of the mirrors (the same
+                      way as for multiple tile_servers).
+
         saved_tile_format: Different providers provide different tile formats. Mapquest for example, provides
                            jpg, while openstreetmap provides png tiles. The saved_tile_format defines the format
                            that the tiles will be saved locally. This might be needed for different reasons.
@@ -1318,8 +4431,62 @@ class stitch_osm_tiles(object):
         max_stitch_dimensions: The maximum accepted dimensions (in pixels) that the stitched files are
                                allowed to have.
         parallelDownloadThread: How many parallel thread to use when downloading tiles.
-        parallelStitchingThreads: How many stitching threads to use when stitching tiles. You would probably want
-                                  to set this to the number of CPU cores you have available.
+        parallelStitchingThreads: How many stitching threads (or worker processes) to use when stitching tiles.
+                                  If None, the number of physical cores is used, capped by the available memory
+                                  divided by the memory that one stitch needs.
+        tile_storage: Optional storage stage for the downloaded tiles. The tiles are re-encoded by a pool of
+                      low priority background threads while the rest of the tiles are still being downloaded.
+                      Accepted values:
+                         'original': The tiles are stored exactly as they are encoded by graphicsmagick.
+                         'png': PNG tiles are losslessly re-deflated with the maximum zlib compression level.
+                         'webp': Non-JPEG tiles are re-encoded to lossless WebP files (<y>.webp).
+                      The optimized tiles are read transparently by the stitcher and the exporters.
+        parallelOptimizerThreads: How many background threads to use for the tile_storage stage.
+        verify_downloads: If True, the size (Content-Length) and the integrity (PNG CRCs, JPEG EOI marker) of
+                          the downloaded tiles are verified before they are renamed to their final path.
+        deep_verify_tiles: The downloaded tiles are streamed to temporary files and atomically renamed, so the
+                           tiles that already exist when resuming a download are complete. If deep_verify_tiles
+                           is True, the existing tiles are still fully decoded to check their integrity (useful for
+                           projects that were downloaded by older versions of this script).
+        stitch_engine: 'native' stitches the tiles in-process in a numpy canvas (default).
+                       'streaming' stitches and writes one row of tiles at a time (png only), so the memory
+                       usage is bounded by one row of tiles regardless of the size of the stitch.
+                       'memmap' assembles each stitch in a memory mapped file with all the stitching threads
+                       in parallel, and encodes the stitch from the mapped file.
+                       'jpegtran' joins JPEG tiles losslessly in the DCT domain (jpg only), and falls back to
+                       'native' for the stitches that are not aligned to the MCUs of the tiles.
+                       'montage' uses the gm/imagemagick montage command line utility.
+        stitch_layout: How the stitched area is split in stitches of at most max_stitch_dimensions pixels.
+                       One of STITCH_LAYOUTS (see stitch_layout_sizes()), or 'auto' to choose the layout with the
+                       lowest cost (decoded pixels and number of stitches).
+        tile_cache_mb: The size in MB of the cache of decoded tiles that is shared by the stitching threads, so
+                       that the tiles on the stitch boundaries are decoded only once (0 disables the cache). It is
+                       not used by the 'montage' stitch engine. With the 'process' stitch_executor, the size is
+                       split between the worker processes, and each process caches the tiles of its own stitches.
+        prefetch_depth: If not 0, the tiles of the next PREFETCH_STITCHES_AHEAD stitches are read ahead of the
+                        stitching workers by prefetch_depth reader threads (see tile_prefetcher).
+        stitch_executor: 'process' stitches in a pool of worker processes (the in-process stitch engines are
+                         GIL bound in threads), 'thread' stitches in threads. The montage stitch engine always
+                         uses threads.
+        hash_tiles: The inputs of every stitch are recorded in a stitch_manifest, so that only the stitches with
+                    changed tiles are rebuilt. If hash_tiles is True, the SHA-1 digests of the tiles are recorded
+                    too, so tiles that are downloaded again with the same content don't trigger a rebuild.
+        encoder_threads: How many threads deflate every PNG stitch in parallel (native, streaming and memmap
+                         stitch engines). If None, the physical cores are shared by the stitching workers, so
+                         every stitch uses several cores when there are fewer workers than cores.
+        skip_uniform_stitches: The tiles with a single color are never decoded by the stitchers (see
+                               uniform_tile_index). If skip_uniform_stitches is True, the stitches that consist
+                               only of tiles with the same color are not written at all (only their thumbnail).
+        output_scale: The stitches are scaled by this factor (1/1024 - 1) while the tiles are placed, e.g. 0.7 for
+                      stitches with 70% of the resolution of the zoom level. The stitch layout, the calibration
+                      files and the printouts are calculated for the scaled stitches.
+        quantize_colors: If not 0, the png stitches of the native and memmap engines are written as indexed
+                         color pngs with a palette of at most quantize_colors colors (see palette_quantizer),
+                         with an ordered dither if dither is True. The stitches whose palette has a root mean
+                         square error larger than quantize_max_error are written in true color.
+        tile_layout: The layout of the downloaded tiles in the folder of the zoom level (see tile_relative_path()).
+                     The tiles of other zoom levels (e.g. for the thumbnails) are found with the layout that is
+                     recorded in their zoom configuration file.
         """
         self.zoom = zoom
         self.project_folder = project_folder
@@ -1330,6 +4497,26 @@ class stitch_osm_tiles(object):
         self.max_stitch_dimensions = max_stitch_dimensions
         self.parallelDownloadThreads = parallelDownloadThreads
         self.parallelStitchingThreads = parallelStitchingThreads
+        self.tile_storage = tile_storage
+        self.parallelOptimizerThreads = parallelOptimizerThreads
+        self.verify_downloads = verify_downloads
+        self.deep_verify_tiles = deep_verify_tiles
+        self.stitch_engine = stitch_engine
+        self.stitch_layout = stitch_layout
+        self.tile_cache_mb = tile_cache_mb
+        self.prefetch_depth = prefetch_depth
+        self.stitch_executor = stitch_executor
+        self.hash_tiles = hash_tiles
+        self.encoder_threads = encoder_threads
+        self.skip_uniform_stitches = skip_uniform_stitches
+        self.output_scale = Fraction(output_scale).limit_denominator(OUTPUT_SCALE_DENOMINATOR)
+        if not 0 < self.output_scale <= 1:
+            raise ValueError("The output scale should be at least 1/{} and at most 1.".format(OUTPUT_SCALE_DENOMINATOR))
+        self.quantize_colors = quantize_colors
+        self.dither = dither
+        self.quantize_max_error = quantize_max_error
+        self.tile_layout = tile_layout
+        self._tileLayouts = {zoom: tile_layout}
 
         # the _tile_height and _tile_height will be calculated when the first tile is downloaded.
         self._tile_height = None
@@ -1338,25 +4525,147 @@ class stitch_osm_tiles(object):
         self._inDownloadQueue = queue.Queue()
         self._outDownloadQueue = queue.Queue()
         self._inStitchingQueue = queue.Queue()
+        self._bandExecutor = None
+        self._tileCache = None
+        self._stitchProcessPool = None
+        self._stitchProcessPoolLock = threading.Lock()
+        # The sums of the (hits, misses, evictions) of the tile caches of the stitching worker processes.
+        self._processTileCacheCounters = None
+        self._maxStitchDimensions = None
+        self._stitchManifest = None
+        self._tilePrefetcher = None
+        # The stitching workers of the current zoom level (self.parallelStitchingThreads or the default for its stitches)
+        self._stitchingThreads = None
+        self._encoderThreads = encoder_threads or 1
+        self._uniformTiles = None
+        self._inOptimizeQueue = queue.Queue()
+        self._optimizerPoolStarted = False
+        self._downloadPoolStarted = False
+        self._downloadProgressBar = None
+        self._downloadLogFile = None
+        # Set to a unique string when the instance is a distributed download worker.
+        self.worker_id = None
+
+        # Find the mirrors that can serve the tiles, in order to keep track of their health.
+        # For dynamic URLs, the code in tile_servers[0] is exec'ed once, and the mirrors are
+        # the (optional) dynTileMirrors defined by that code.
+        self._dynGetTileUrl = None
+        mirrors = []
+        if tile_servers is not None:
+            if dyn_tile_url:
+                dyn_namespace = dict(globals())
+                exec(tile_servers[0], dyn_namespace)
+                self._dynGetTileUrl = dyn_namespace['dynGetTileUrl']
+                mirrors = dyn_namespace.get('dynTileMirrors', [])
+            else:
+                mirrors = tile_servers
+        self._mirrorHealth = mirror_health_tracker(mirrors) if len(mirrors) > 1 else None
         self._downloadLogFileLock = threading.Lock()
 
     # ----------------------------------------------------------------------
-    def _get_tile_url(self, counter, x, y):
+    def __getstate__(self):
+        """
+        The instance is pickled to stitch in worker processes. Only the configuration is sent to
+        the worker processes: the queues, locks, pools and caches of the main process stay behind.
+        """
+        state = self.__dict__.copy()
+        for key in ('_itemsInProcessing', '_inDownloadQueue', '_outDownloadQueue', '_inStitchingQueue',
+                    '_bandExecutor', '_tileCache', '_stitchProcessPool', '_stitchProcessPoolLock', '_stitchManifest',
+                    '_tilePrefetcher',
+                    '_processTileCacheCounters',
+                    '_uniformTiles',
+                    '_inOptimizeQueue', '_downloadProgressBar', '_downloadLogFile', '_dynGetTileUrl',
+                    '_mirrorHealth', '_downloadLogFileLock'):
+            state[key] = None
+
+        return state
+
+    # ----------------------------------------------------------------------
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # In a stitching worker process, use the tile cache of the process.
+        self._tileCache = PROCESS_TILE_CACHE
+
+    # ----------------------------------------------------------------------
+    def _get_tile_url(self, counter, x, y, mirror=None):
         """
         Return the tile url by replacing the placeholders
+
+        mirror is the index of the mirror (as returned by self._mirrorHealth.choose()) that
+        should serve the tile. If mirror is None, the mirror is picked by the counter.
         """
         if self.dyn_tile_url:
-            # exec(self.tile_servers[0], locals(), locals())
-            exec(self.tile_servers[0], globals())
-            url = dynGetTileUrl(self.zoom, x, y, counter)
+            if mirror is None:
+                url = self._dynGetTileUrl(self.zoom, x, y, counter)
+            else:
+                url = self._dynGetTileUrl(self.zoom, x, y, counter, mirror=self._mirrorHealth.mirrors[mirror])
         else:
-            tile_server = self.tile_servers[counter % len(self.tile_servers)]
+            if mirror is None:
+                tile_server = self.tile_servers[counter % len(self.tile_servers)]
+            else:
+                tile_server = self.tile_servers[mirror]
             url = re.sub('\{x\}', str(x), tile_server)
             url = re.sub('\{y\}', str(y), url)
             url = re.sub('\{z\}', str(self.zoom), url)
 
         return url
 
+    # ----------------------------------------------------------------------
+    def _tile_path(self, x, y, extension=None, zoom=None):
+        """
+        Return the local path where the tile x/y is saved when downloaded.
+        If extension is None, the saved_tile_format is used.
+        If zoom is None, the zoom level of the instance is used.
+        """
+        if extension is None:
+            extension = self.saved_tile_format
+        if zoom is None:
+            zoom = self.zoom
+        layout = self._tileLayouts.get(zoom)
+        if layout is None:
+            layout = read_tile_layout(self.project_folder, zoom)
+            if layout is None:
+                # The zoom level has not been downloaded yet, and its tiles will get the layout of the
+                # instance when they are (see download_tiles()). Don't remember the guess.
+                layout = self.tile_layout
+            else:
+                self._tileLayouts[zoom] = layout
+
+        return '{}.{}'.format(os.path.join(self.project_folder, str(zoom),
+                                           tile_relative_path(x, y, layout)), extension)
+
+    # ----------------------------------------------------------------------
+    def _make_tile_folders(self, x, tile_north, tile_south):
+        """
+        Create the folders of the tiles tile_north to tile_south of the column x, if they don't exist.
+        """
+        for folder in sorted(set(os.path.dirname(self._tile_path(x, y)) for y in range(tile_north, tile_south + 1))):
+            os.makedirs(folder, exist_ok=True)
+
+    # ----------------------------------------------------------------------
+    def _uniform_tile_index(self):
+        """
+        Returns the uniform_tile_index of the tiles of the zoom level.
+        """
+        return uniform_tile_index(os.path.join(self.project_folder, str(self.zoom), '.uniform-tiles.sqlite'))
+
+    # ----------------------------------------------------------------------
+    def _find_tile(self, x, y, zoom=None):
+        """
+        Return the local path of the tile x/y as it is currently stored on disk, or None if
+        the tile has not been downloaded yet.
+
+        Depending on the tile_storage, a tile may have been re-encoded to a different format by
+        the tile optimizer, so every consumer of the downloaded tiles should use this function
+        to locate them.
+        """
+        for extension in (self.saved_tile_format, 'webp'):
+            path = self._tile_path(x, y, extension, zoom)
+            if os.path.isfile(path):
+                return path
+
+        return None
+
     # ----------------------------------------------------------------------
     # X and Y
     #      X goes from 0 (left edge is 180 °W) to 2^zoom − 1 (right edge is 180 °E)
@@ -1391,33 +4700,116 @@ class stitch_osm_tiles(object):
         will return the center of the tile.
         """
         n = 2.0 ** self.zoom
-        lon_deg = xtile / n * 360.0 - 180.0
-        lat_rad = math.atan(math.sinh(math.pi * (1 - 2 * ytile / n)))
-        lat_deg = math.degrees(lat_rad)
+        lon_deg = xtile / n * 360.0 - 180.0
+        lat_rad = math.atan(math.sinh(math.pi * (1 - 2 * ytile / n)))
+        lat_deg = math.degrees(lat_rad)
+
+        return (lat_deg, lon_deg)
+
+    # ----------------------------------------------------------------------
+    # Get the longtitude and latitude per pixel, based on the global pixel scale of the map.
+    # For example, if the zoom level is 0, then only one 256x256 tile compose the complete
+    # map. In this case, a y pixel value of 0 will give a latitude of ~-85deg and a y pixel
+    # value of 256 will give a latitude of +85.
+    # If the zoom is 3, then the whole map is 8x8 tiles, so 2048x2048 pixels. In this case
+    # a y pixel value of 0 will give a latitude of ~-85deg and a y pixel value of 20248 will
+    # give a latitude of +85.
+
+    def pixel2deg(self, xpixel, ypixel, original_tiles_width, original_tiles_height):
+        """
+        Returns the longtitude and latitude of the of the given x/y pixel
+        """
+        n = 2.0 ** self.zoom
+        lon_deg = float(xpixel) / original_tiles_width / n * 360.0 - 180
+
+        num_pixel = math.pi - 2.0 * math.pi * ypixel / original_tiles_height / n
+        lat_deg = 180.0 / math.pi * \
+            math.atan2(0.5 * (math.exp(num_pixel) - math.exp(-num_pixel)), 1)
+
+        return (lat_deg, lon_deg)
+
+    # ----------------------------------------------------------------------
+    # The *_batch functions are the vectorized versions of the functions above. They accept numpy arrays
+    # (or anything that numpy can broadcast, e.g. a column and a row of values for a grid of points) and
+    # return numpy arrays with the broadcast shape.
+    def deg2tilenums_batch(self, lat_deg, lon_deg):
+        """
+        Returns the (xtiles, ytiles) integer arrays of the tiles of the given coordinates in degrees.
+        """
+        lat_deg, lon_deg = np.broadcast_arrays(np.asarray(lat_deg, dtype=np.float64),
+                                               np.asarray(lon_deg, dtype=np.float64))
+        lat_rad = np.radians(lat_deg)
+        n = 2.0 ** self.zoom
+        xtiles = np.trunc((lon_deg + 180.0) / 360.0 * n).astype(np.int64)
+        ytiles = np.trunc((1.0 - np.log(np.tan(lat_rad) + (1 / np.cos(lat_rad))) / np.pi) / 2.0 * n).astype(np.int64)
+
+        return (xtiles, ytiles)
+
+    # ----------------------------------------------------------------------
+    def tilenums2deg_batch(self, xtiles, ytiles):
+        """
+        Returns the (lat_deg, lon_deg) arrays of the NW-corners of the given tiles (see tilenums2deg()).
+        """
+        xtiles, ytiles = np.broadcast_arrays(np.asarray(xtiles, dtype=np.float64),
+                                             np.asarray(ytiles, dtype=np.float64))
+        n = 2.0 ** self.zoom
+        lon_deg = xtiles / n * 360.0 - 180.0
+        lat_deg = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * ytiles / n))))
+
+        return (lat_deg, lon_deg)
+
+    # ----------------------------------------------------------------------
+    def pixel2deg_batch(self, xpixels, ypixels, original_tiles_width, original_tiles_height):
+        """
+        Returns the (lat_deg, lon_deg) arrays of the given x/y pixels of the zoom level (see pixel2deg()).
+        """
+        xpixels, ypixels = np.broadcast_arrays(np.asarray(xpixels, dtype=np.float64),
+                                               np.asarray(ypixels, dtype=np.float64))
+        n = 2.0 ** self.zoom
+        lon_deg = xpixels / original_tiles_width / n * 360.0 - 180
+        lat_deg = np.degrees(np.arctan(np.sinh(np.pi - 2.0 * np.pi * ypixels / original_tiles_height / n)))
 
         return (lat_deg, lon_deg)
 
     # ----------------------------------------------------------------------
-    # Get the longtitude and latitude per pixel, based on the global pixel scale of the map.
-    # For example, if the zoom level is 0, then only one 256x256 tile compose the complete
-    # map. In this case, a y pixel value of 0 will give a latitude of ~-85deg and a y pixel
-    # value of 256 will give a latitude of +85.
-    # If the zoom is 3, then the whole map is 8x8 tiles, so 2048x2048 pixels. In this case
-    # a y pixel value of 0 will give a latitude of ~-85deg and a y pixel value of 20248 will
-    # give a latitude of +85.
-
-    def pixel2deg(self, xpixel, ypixel, original_tiles_width, original_tiles_height):
+    def pixel2meters_batch(self, xpixels, ypixels, original_tiles_width, original_tiles_height):
         """
-        Returns the longtitude and latitude of the of the given x/y pixel
+        Returns the (x, y) arrays of the given x/y pixels of the zoom level in web mercator (EPSG:3857) meters.
+        The web mercator coordinates are linear in the pixels of the tiles.
         """
+        xpixels, ypixels = np.broadcast_arrays(np.asarray(xpixels, dtype=np.float64),
+                                               np.asarray(ypixels, dtype=np.float64))
         n = 2.0 ** self.zoom
-        lon_deg = float(xpixel) / original_tiles_width / n * 360.0 - 180
+        x = (xpixels / original_tiles_width / n - 0.5) * WEB_MERCATOR_EXTENT
+        y = (0.5 - ypixels / original_tiles_height / n) * WEB_MERCATOR_EXTENT
 
-        num_pixel = math.pi - 2.0 * math.pi * ypixel / original_tiles_height / n
-        lat_deg = 180.0 / math.pi * \
-            math.atan2(0.5 * (math.exp(num_pixel) - math.exp(-num_pixel)), 1)
+        return (x, y)
 
-        return (lat_deg, lon_deg)
+    # ----------------------------------------------------------------------
+    def stitch_corners(self, tile_west, tile_north, dimensions):
+        """
+        Returns the (N, S, W, E) degrees of the stitches that are described by 'dimensions' (see
+        _calculate_max_dimensions_per_stitch()), as (rows, columns) arrays that are calculated in one batch.
+        These are the coordinates of the corner pixels that are written in the OziExplorer map files: the
+        pixels are counted from 1 and the last pixel of every stitch is used for its S and E coordinates.
+        """
+        # The stitches may not have the same size (depending on the stitch layout), so each stitch starts at
+        # the sum of the widths/heights of the previous stitches. The pixels of scaled stitches are converted
+        # to the pixels of the zoom level.
+        scale = float(self.output_scale)
+        x_edges = np.concatenate(([0], np.cumsum(dimensions['horizontal_resolutions']))).astype(np.float64)
+        y_edges = np.concatenate(([0], np.cumsum(dimensions['vertical_resolutions']))).astype(np.float64)
+        W_xpixels = tile_west * self._tile_width + 1 + x_edges[:-1] / scale
+        E_xpixels = tile_west * self._tile_width + 1 + (x_edges[1:] - 1) / scale
+        N_ypixels = tile_north * self._tile_height + 1 + y_edges[:-1] / scale
+        S_ypixels = tile_north * self._tile_height + 1 + (y_edges[1:] - 1) / scale
+
+        N, W = self.pixel2deg_batch(W_xpixels[np.newaxis, :], N_ypixels[:, np.newaxis],
+                                    self._tile_width, self._tile_height)
+        S, E = self.pixel2deg_batch(E_xpixels[np.newaxis, :], S_ypixels[:, np.newaxis],
+                                    self._tile_width, self._tile_height)
+
+        return N, S, W, E
 
     # ----------------------------------------------------------------------
     def _convert_degrees_to_OZI_deg(self, degrees, orientation):
@@ -1440,10 +4832,12 @@ class stitch_osm_tiles(object):
 
     # ----------------------------------------------------------------------
 
-    def generate_OZI_map_file(self, filename, extension, width, height, zoom, N, S, W, E):
+    def generate_OZI_map_file(self, filename, extension, width, height, zoom, N, S, W, E, scale=1):
         """
         This function will generate a map calibration file for OziExplorer
 
+        scale: The scale factor of the image, if it has been scaled from the resolution of the zoom level.
+
         # HOW TO CALCULATE MMB1
         # From the official documentation: http://www.oziexplorer3.com/eng/help/map_file_format.html
         #   The scale of the image meters/pixel, its calculated in the left / right image direction.
@@ -1477,7 +4871,7 @@ class stitch_osm_tiles(object):
         """
         latitude_mid_of_tile = S + (N - S) / 2
         MMB1 = 40075017 * \
-            math.cos(float(latitude_mid_of_tile) / 180 * math.pi) / 2**(zoom + 8)
+            math.cos(float(latitude_mid_of_tile) / 180 * math.pi) / 2**(zoom + 8) / float(scale)
 
         N_OZI = self._convert_degrees_to_OZI_deg(N, 'N')
         S_OZI = self._convert_degrees_to_OZI_deg(S, 'S')
@@ -1528,64 +4922,175 @@ IWH,Map Image Width/Height,{16},{17}""".format(
 
     # ----------------------------------------------------------------------
 
+    def _save_streamed_tile(self, resp, download_path):
+        """
+        Streams the body of the (not preloaded) urllib3 response 'resp' in chunks to a temporary
+        file in the same folder as download_path and atomically renames it to download_path when
+        the tile is complete. A tile found at download_path is therefore always a complete file,
+        even if the script was interrupted in the middle of a download.
+
+        If self.verify_downloads is True, the size of the body is checked against the Content-Length
+        header and the PNG chunk CRCs (or the JPEG EOI marker) are verified before the rename.
+
+        If the provider serves the tiles in a different format than the saved_tile_format, the
+        tile is converted with graphicsmagick before the rename.
+
+        Raises ValueError with the type of the error as its message if the tile is not valid.
+        """
+        tmp_path = partial_path(download_path)
+        try:
+            if resp.status != 200:
+                raise ValueError('HTTPStatus{}'.format(resp.status))
+
+            received = 0
+            head = b''
+            with open(tmp_path, 'wb') as f:
+                for chunk in resp.stream(DOWNLOAD_CHUNK_SIZE):
+                    if len(head) < 12:
+                        head += chunk[:12 - len(head)]
+                    f.write(chunk)
+                    received += len(chunk)
+
+            if self.verify_downloads:
+                # When the body is compressed by the server, urllib3 decodes it on the fly and the
+                # received bytes do not match the Content-Length.
+                content_length = resp.headers.get('Content-Length')
+                if content_length is not None and resp.headers.get('Content-Encoding') is None:
+                    if int(content_length) != received:
+                        raise ValueError('IncompleteDownload')
+                if not verify_image_file(tmp_path):
+                    raise ValueError('CorruptedImage')
+
+            image_format = detect_image_format(head)
+            if image_format is None:
+                raise ValueError('NotAnImage')
+
+            saved_format = 'jpg' if self.saved_tile_format == 'jpeg' else self.saved_tile_format
+            if image_format != saved_format:
+                try:
+                    img = gmImage(tmp_path)
+                    img.write('{}:{}'.format(saved_format, tmp_path))
+                except RuntimeError:
+                    raise ValueError('UnknownGraphicsMagicError')
+
+            os.replace(tmp_path, download_path)
+        finally:
+            resp.release_conn()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    # ----------------------------------------------------------------------
+    def _download_tile(self, http, url, download_path):
+        """
+        Downloads the content (should be a tile) of the given url and saves it in the download path.
+
+        Returns a (retval, mirror_failed) tuple. retval is a (None, url, download_path, None) tuple if the file was
+        downloaded succesfully, or a tuple with the error object and a string with the type of the error.
+        mirror_failed is True if the error indicates that the server itself is unhealthy (connection errors,
+        timeouts or server side errors), and not that the specific tile is not valid.
+        """
+        mirror_failed = False
+        try:
+            resp = http.request("GET", url, preload_content=False)
+        except urllib3.exceptions.HTTPError as e:
+            # e.code contains the actual error code
+            retval = (e, url, download_path, 'HTTPError')
+            mirror_failed = True
+        except socket.timeout as e:
+            retval = (e, url, download_path, 'SocketTimeout')
+            mirror_failed = True
+        except socket.error as e:
+            retval = (e, url, download_path, e.strerror)
+            mirror_failed = True
+        except httplib.BadStatusLine as e:
+            retval = (e, url, download_path, e.strerror)
+            mirror_failed = True
+        else:
+            try:
+                self._save_streamed_tile(resp, download_path)
+                retval = (None, url, download_path, None)
+            except ValueError as e:
+                retval = (e, url, download_path, str(e))
+                mirror_failed = str(e).startswith('HTTPStatus5') or str(e) in ('HTTPStatus429', 'IncompleteDownload')
+            except urllib3.exceptions.HTTPError as e:
+                retval = (e, url, download_path,
+                          'HTTPError while reading response')
+                mirror_failed = True
+            except socket.error as e:
+                retval = (e, url, download_path,
+                          'SocketError while reading response')
+                mirror_failed = True
+
+        return retval, mirror_failed
+
+    # ----------------------------------------------------------------------
     def _download_tile_worker(self, inQueue, outQueue):
         """
-        Downloads the content (should be a tile) of the given url.
-        Returns a ([graphicsMagickImageObject, imageblob], None) tuple if the file was downloaded succesfully, or a
-        tuple with the error object and a string with the type of the error.
+        Downloads the tiles that are received from the inQueue and puts the results in the outQueue.
+
+        If more than one mirrors serve the tiles, the mirror for each request is picked by the
+        self._mirrorHealth, and a failed tile is retried immediately on a different mirror until
+        all the mirrors have been tried.
         """
         timeout = urllib3.Timeout(connect=2.0, read=10.0)
         http = urllib3.PoolManager(timeout=timeout)
         try:
             while True:
-                # The data received from the queue is tuple (url, download_path)
-                url, download_path = inQueue.get()
+                # The data received from the queue is tuple (counter, x, y, download_path)
+                counter, x, y, download_path = inQueue.get()
 
-                LOG.debug("{} is DOWNLOADING '{}' -> '{}'".format(
-                    threading.current_thread().name, url, download_path))
+                tried_mirrors = []
+                while True:
+                    mirror = None
+                    if self._mirrorHealth is not None:
+                        mirror = self._mirrorHealth.choose(exclude=tried_mirrors)
+                        tried_mirrors.append(mirror)
 
-                try:
-                    resp = http.request("GET", url)
-                except urllib3.exceptions.HTTPError as e:
-                    # e.code contains the actual error code
-                    retval = (e, url, download_path, 'HTTPError')
-                except socket.timeout as e:
-                    retval = (e, url, download_path, 'SocketTimeout')
-                except socket.error as e:
-                    retval = (e, url, download_path, e.strerror)
-                except httplib.BadStatusLine as e:
-                    retval = (e, url, download_path, e.strerror)
-                else:
-                    try:
-                        tile = resp.data
-                        try:
-                            img = gmImage(pgmagick.Blob(tile))
-                            img.write(download_path)
-                            retval = ([img, tile], url, download_path, None)
-                        except RuntimeError:
-                            e = sys.exc_info()[0]
-                            retval = (e, url, download_path,
-                                      'UnknownGraphicsMagicError')
-                    except socket.error as e:
-                        retval = (e, url, download_path,
-                                  'SocketError while reading response')
-
-                outQueue.put(retval)
+                    url = self._get_tile_url(counter, x, y, mirror)
+
+                    LOG.debug("{} is DOWNLOADING '{}' -> '{}'".format(
+                        threading.current_thread().name, url, download_path))
+
+                    time_started = time.time()
+                    retval, mirror_failed = self._download_tile(http, url, download_path)
+
+                    if mirror is None:
+                        break
+
+                    if mirror_failed:
+                        self._mirrorHealth.report_failure(mirror)
+                    elif retval[3] is None:
+                        self._mirrorHealth.report_success(mirror, time.time() - time_started)
+                    else:
+                        self._mirrorHealth.report_neutral(mirror)
+
+                    if retval[3] is None or len(tried_mirrors) >= len(self._mirrorHealth.mirrors):
+                        break
+
+                    LOG.debug("Download of '{}' failed ({}). Retrying on a different mirror.".format(url, retval[3]))
+
+                outQueue.put(retval + (x, y))
                 inQueue.task_done()
         except KeyboardInterrupt:
             inQueue.task_done()
             exit(1)
 
     # ----------------------------------------------------------------------
-    def _process_download_results_worker(self, inQueue, progress_bar, logfile):
+    def _process_download_results_worker(self, inQueue):
         """
         Handle the completed downloads.
         Saving the file and writing into log file if a download error occured.
+
+        The progress bar and the log file of the current download_tiles() call are
+        found in self._downloadProgressBar and self._downloadLogFile, since the thread
+        is reused by subsequent download_tiles() calls.
         """
         try:
             while True:
                 # The data received from the queue is a tuple as return by the 'download_tile_worker' threads
-                result, url, download_path, errorType = inQueue.get()
+                result, url, download_path, errorType, x, y = inQueue.get()
+                progress_bar = self._downloadProgressBar
+                logfile = self._downloadLogFile
 
                 LOG.debug("{} is PROCESSING DOWNLOADED file for url '{}'".format(
                     threading.current_thread().name, url))
@@ -1596,30 +5101,36 @@ IWH,Map Image Width/Height,{16},{17}""".format(
                     # Use the lock to make sure that threads do not interfere
                     with self._downloadLogFileLock:
                         logfile.write(
-                            "{} - ERROR:'{}' -> '{}'\n".format(time_now, url, download_path))
-                else:
-                    img, tile = result
+                            "{} - ERROR:'{}' -> '{}' ({},{})\n".format(time_now, url, download_path, x, y))
 
                 # Ιf it is the first image we process, update the _tile_width and _tile_height
                 # When we download the first image, progress_bar is just initialized, so progress_bar.currval == 0
                 # Also, when we process the first image, we are waiting for the processing to complete before adding
                 # more items for threaded processing in the queue, so we are sure that when progress_bar.currval == 0
                 # we actually process the first image.
-                if progress_bar.currval == 0:
+                # If the tile dimensions are already known (e.g. from a previous download_tiles() call), a failed
+                # first tile is just logged as any other failed tile.
+                if progress_bar.currval == 0 and (self._tile_width is None or errorType is None):
                     if errorType is not None:
                         # If there is an error when trying to download the first tile, just exit.
                         error_and_exit(
                             "The very first tile must be downloaded in order to continue with the rest, but unfortunately there was an error. Please retry.")
+                    img = gmImage(download_path)
                     self._tile_width = img.columns()
                     self._tile_height = img.rows()
 
+                # The tile is only handed to the optimizer after its dimensions were read, since the optimizer
+                # may replace it (e.g. with a webp tile).
+                if errorType is None:
+                    self._addToOptimizeQueue(download_path)
+
                 # Update the progress bar
                 with self._downloadLogFileLock:
                     pbar_val = progress_bar.currval + 1
                     progress_bar.update(pbar_val)
 
                 try:
-                    self._itemsInProcessing.remove(url)
+                    self._itemsInProcessing.remove(download_path)
                 except ValueError:
                     error_and_exit(
                         "Something strange happened...\nURL '{}' has already been removed from the items to be processed.\nPlease retry..".format(url))
@@ -1629,14 +5140,67 @@ IWH,Map Image Width/Height,{16},{17}""".format(
             inQueue.task_done()
             exit(1)
 
+    # ----------------------------------------------------------------------
+    def _optimize_tile_worker(self, inQueue):
+        """
+        Re-encodes the downloaded tiles according to the self.tile_storage in the background.
+        The worker threads lower their own priority, so that they only use the cpu time that is
+        left over by the downloading and stitching threads.
+        """
+        if hasattr(os, 'setpriority') and hasattr(threading, 'get_native_id'):
+            try:
+                # On Linux the priority of a thread can be set independently from the process.
+                os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+            except OSError:
+                pass
+
+        try:
+            while True:
+                tile_path = inQueue.get()
+
+                LOG.debug("{} is OPTIMIZING '{}'".format(
+                    threading.current_thread().name, tile_path))
+
+                try:
+                    extension = os.path.splitext(tile_path)[1].lower()
+                    if self.tile_storage == 'png' and extension == '.png':
+                        recompress_png(tile_path)
+                    elif self.tile_storage == 'webp' and extension not in ('.webp', '.jpg', '.jpeg'):
+                        # Lossless WebP of an already lossy JPEG tile is usually larger than the original, so
+                        # the JPEG tiles are kept as they are.
+                        convert_tile_to_webp(tile_path)
+                except (IOError, OSError, ValueError, RuntimeError, zlib.error) as e:
+                    LOG.warning("Could not optimize tile '{}': {}".format(tile_path, e))
+
+                inQueue.task_done()
+        except KeyboardInterrupt:
+            inQueue.task_done()
+            exit(1)
+
+    # ----------------------------------------------------------------------
+    def _addToOptimizeQueue(self, tile_path):
+        """
+        Helper function to add a downloaded tile in the optimizer queue.
+        The optimizer threads are started the first time a tile is added.
+        """
+        if self.tile_storage == 'original':
+            return
+
+        if not self._optimizerPoolStarted:
+            instantiate_threadpool('Optimizer-Thread', self.parallelOptimizerThreads,
+                                   self._optimize_tile_worker, (self._inOptimizeQueue, ))
+            self._optimizerPoolStarted = True
+
+        self._inOptimizeQueue.put(tile_path)
+
     # ----------------------------------------------------------------------
     def _addToDownloadInputQueue(self, args):
         """
-        Helper function to add a url in the input queue for threaded processing
+        Helper function to add a tile in the input queue for threaded processing
 
-        args must be (url, download_path) tuple
+        args must be (counter, x, y, download_path) tuple
         """
-        url = args[0]
+        download_path = args[3]
 
         # If we have many pending/unproccessed items, wait until some of the items are processed.
         while len(self._itemsInProcessing) > 2 * self.parallelDownloadThreads:
@@ -1644,7 +5208,7 @@ IWH,Map Image Width/Height,{16},{17}""".format(
 
         # Then add the items in the queue
         self._inDownloadQueue.put(args)
-        self._itemsInProcessing.append(url)
+        self._itemsInProcessing.append(download_path)
 
     # ----------------------------------------------------------------------
     def _addToStitchingInputQueue(self, args):
@@ -1655,7 +5219,7 @@ IWH,Map Image Width/Height,{16},{17}""".format(
         stitch = args[1]
 
         # If we have many pending/unproccessed items, wait until some of the items are processed.
-        while len(self._itemsInProcessing) >= self.parallelStitchingThreads:
+        while len(self._itemsInProcessing) >= self._stitchingThreads:
             time.sleep(0.01)
 
         # Then add the items in the queue
@@ -1668,11 +5232,18 @@ IWH,Map Image Width/Height,{16},{17}""".format(
         Download tiles for a given zoom level.
         If the tiles are already downloaded, this function will only check the consistency
         of the downloaded files.
+
+        Returns the number of tiles that could not be downloaded.
         """
         if self.tile_servers is None:
             raise AssertionError(
                 "tile_servers haven't been provided. Cannot download tiles.")
 
+        # A zoom level that is downloaded without a configuration file (e.g. the zoom level of a preview)
+        # records the layout of its tiles, so that later runs find the tiles in the same layout.
+        if read_tile_layout(self.project_folder, self.zoom) is None:
+            write_tile_layout(self.project_folder, self.zoom, self.tile_layout)
+
         number_of_horizontal_tiles = (tile_east - tile_west) + 1
         number_of_vertical_tiles = (tile_south - tile_north) + 1
 
@@ -1704,41 +5275,56 @@ IWH,Map Image Width/Height,{16},{17}""".format(
         #   list. If this list has more than (2 * self.parallelDownloadThreads) items, then the program sleeps for 10 milliseconds
         #   and checks again the length of the list before adding more url's in the input queue.
 
-        # Instantiate a thread pool with 'self.parallelDownloadThreads' number of threads
-        instantiate_threadpool('Download-Thread', self.parallelDownloadThreads,
-                               self._download_tile_worker, (self._inDownloadQueue, self._outDownloadQueue))
-
-        # Instantiate a single thread to process the results of the downloads
         # The log file has to be opened before we start the threads, because the thread worker is using the log file.
-        downloadLogFile_path = os.path.join(
-            self.project_folder, "zoom-{}-download.log".format(self.zoom))
+        # Distributed workers share the project folder, so each of them uses its own log file.
+        if self.worker_id is None:
+            downloadLogFile_path = os.path.join(
+                self.project_folder, "zoom-{}-download.log".format(self.zoom))
+        else:
+            downloadLogFile_path = os.path.join(
+                self.project_folder, "zoom-{}-download-{}.log".format(self.zoom, self.worker_id))
         # Open the file for reading and writing
         downloadLogFile = open(downloadLogFile_path, 'a+')
         # If the file existed and had some content, ensure it's truncated and we start clean
         downloadLogFile.truncate(0)
-        instantiate_threadpool('ProccessDownloaded-Thread', 1, self._process_download_results_worker,
-                               (self._outDownloadQueue, pbar, downloadLogFile))
+        self._downloadProgressBar = pbar
+        self._downloadLogFile = downloadLogFile
+
+        # The thread pools are started only once, and reused if download_tiles() is called again
+        # (e.g. for every work unit of a distributed download).
+        if not self._downloadPoolStarted:
+            # Instantiate a thread pool with 'self.parallelDownloadThreads' number of threads
+            instantiate_threadpool('Download-Thread', self.parallelDownloadThreads,
+                                   self._download_tile_worker, (self._inDownloadQueue, self._outDownloadQueue))
+
+            # Instantiate a single thread to process the results of the downloads
+            instantiate_threadpool('ProccessDownloaded-Thread', 1, self._process_download_results_worker,
+                                   (self._outDownloadQueue, ))
+            self._downloadPoolStarted = True
 
         # The counter is mostly used to choose different tile servers if more than one tile servers are provided for the specified provider.
         counter = 1
         for x in range(tile_west, tile_east + 1):
-            x_path = os.path.join(self.project_folder, str(self.zoom), str(x))
-            if not os.path.isdir(x_path):
-                os.mkdir(x_path)
+            self._make_tile_folders(x, tile_north, tile_south)
 
             for y in range(tile_north, tile_south + 1):
-                y_path = '{}.{}'.format(os.path.join(
-                    x_path, str(y)), self.saved_tile_format)
+                y_path = self._tile_path(x, y)
 
                 LOG.debug(
                     "Processing tile '{}' (Progress: {}/{})".format(y_path, counter, total_tiles))
 
-                url = self._get_tile_url(counter, x, y)
-
-                # Before adding files in the queue, check if the file exists
-                if os.path.isfile(y_path):
+                # Before adding files in the queue, check if the file exists (possibly
+                # already re-encoded by the tile optimizer)
+                existing_path = self._find_tile(x, y)
+                if existing_path is not None and not (counter == 1 or self.deep_verify_tiles):
+                    # Tiles are atomically renamed in place only after they have been downloaded
+                    # completely, so an existing tile doesn't have to be decoded to be trusted.
+                    pbar.currval += 1
+                    pbar.update(pbar.currval)
+                    self._addToOptimizeQueue(existing_path)
+                elif existing_path is not None:
                     try:
-                        img = gmImage(y_path)
+                        img = gmImage(existing_path)
                         # If it is the first image we process, set the self._tile_width and self._tile_height
                         if counter == 1:
                             self._tile_width = img.columns()
@@ -1747,24 +5333,26 @@ IWH,Map Image Width/Height,{16},{17}""".format(
                         # If the image is already loaded successfully, but the image size differs from
                         # self._tile_height/self._tile_width, try to redownload it.
                         if not (img.columns() == self._tile_width and img.rows() == self._tile_height):
-                            self._addToDownloadInputQueue((url, y_path))
+                            self._addToDownloadInputQueue((counter, x, y, y_path))
                         else:
                             # Update the progress bar
                             pbar.currval += 1
                             pbar.update(pbar.currval)
+                            # Tiles from a previous run may not have been optimized yet.
+                            self._addToOptimizeQueue(existing_path)
                     except RuntimeError:
                         # We execute at this point if the image exists but it cannot be loaded succesfully.
                         # In this case, try to re-download it.
-                        self._addToDownloadInputQueue((url, y_path))
+                        self._addToDownloadInputQueue((counter, x, y, y_path))
                 else:
                     # Else the file does not exist, try to download it for the first time.
-                    self._addToDownloadInputQueue((url, y_path))
+                    self._addToDownloadInputQueue((counter, x, y, y_path))
 
                 # If we are processing the first tile, wait until the processing completes because we have to
                 # read the width/height of this tile before downloading the rest. The rest of the tiles are
                 # processed in parallel by multiple threads.
                 if counter == 1:
-                    while url in self._itemsInProcessing:
+                    while y_path in self._itemsInProcessing:
                         time.sleep(0.01)
 
                 counter += 1
@@ -1796,17 +5384,16 @@ IWH,Map Image Width/Height,{16},{17}""".format(
                 with self._downloadLogFileLock:
                     q = quick_regexp()
                     for line in file_lines:
-                        if q.search(".*ERROR:'(.*)' -> '(.*)'$", line):
-                            url = q.groups[0]
+                        if q.search(".*ERROR:'(.*)' -> '(.*)' \((\d+),(\d+)\)$", line):
                             local_path = q.groups[1]
-                            list_of_missing_files[url] = local_path
+                            list_of_missing_files[local_path] = (int(q.groups[2]), int(q.groups[3]))
 
                     # Erase the contents of the log file at this point.
                     downloadLogFile.truncate(0)
 
                 pbar.maxval = pbar.maxval + len(list_of_missing_files)
-                for url, local_path in list_of_missing_files.items():
-                    self._addToDownloadInputQueue((url, local_path))
+                for local_path, (x, y) in list_of_missing_files.items():
+                    self._addToDownloadInputQueue((retry, x, y, local_path))
 
                 # Wait for the threads to finish their work by joining the in/out Queues
                 self._inDownloadQueue.join()
@@ -1816,146 +5403,893 @@ IWH,Map Image Width/Height,{16},{17}""".format(
                     downloadLogFile.flush()
                     filestat = os.fstat(downloadLogFile.fileno())
 
-        # Close the log file since we have finished downloading at this point.
-        with self._downloadLogFileLock:
-            downloadLogFile.close()
+        # Close the log file since we have finished downloading at this point.
+        with self._downloadLogFileLock:
+            downloadLogFile.flush()
+            downloadLogFile.seek(0)
+            failed_tiles = len(downloadLogFile.readlines())
+            downloadLogFile.close()
+
+        if self._mirrorHealth is not None:
+            LOG.info("Tile server mirrors:\n   " + "\n   ".join(self._mirrorHealth.summary()))
+
+        # The tiles may be renamed by the optimizer (e.g. to .webp), so make sure that the
+        # background optimization is finished before the tiles are handed to the stitcher.
+        if self._optimizerPoolStarted:
+            LOG.info("Waiting for the tile optimizer to finish...")
+            self._inOptimizeQueue.join()
+
+        return failed_tiles
+
+    # ----------------------------------------------------------------------
+    def download_tiles_distributed(self, tile_west, tile_east, tile_north, tile_south, retry_failed,
+                                   wait_for_all=False, unit_size=16, lease_timeout=600, poll_interval=10):
+        """
+        Download tiles for a given zoom level in cooperation with other worker processes (possibly
+        running on different hosts) that share the same project folder.
+
+        The tile range is split in work units of unit_size x unit_size tiles, which are kept in a
+        lease table (an SQLite database in the project folder). This process claims units one by one
+        and downloads them with download_tiles(), while a background thread keeps renewing the lease.
+        Units of crashed workers are claimed again when their lease expires.
+
+        If wait_for_all is False (a plain worker), the function returns when there are no units left
+        to be claimed. If wait_for_all is True (the coordinator), the function returns only when all
+        the units of all the workers have been downloaded.
+        """
+        if self.worker_id is None:
+            self.worker_id = '{}-{}'.format(socket.gethostname(), os.getpid())
+
+        # A new run of the coordinator retries the units that failed in earlier runs, and with
+        # retry_failed it checks the tiles of all the units again.
+        reset = None
+        if wait_for_all:
+            reset = 'all' if retry_failed else 'failed'
+
+        lease_table = tile_lease_table(os.path.join(
+            self.project_folder, 'zoom-{}-leases.sqlite'.format(self.zoom)), lease_timeout)
+        total_units = lease_table.create_units(tile_west, tile_east, tile_north, tile_south, unit_size, reset)
+
+        LOG.info("Worker '{}' is joining the distributed download of {} work units.".format(self.worker_id, total_units))
+
+        while True:
+            unit = lease_table.claim(self.worker_id)
+            if unit is None:
+                progress = lease_table.progress()
+                if progress['done'] + progress['failed'] == total_units:
+                    break
+                if not wait_for_all and progress['pending'] == 0 and progress['leased'] == 0:
+                    break
+                # Units are still leased by other workers. Wait in case a lease expires
+                # (or a unit with failed tiles is released) and has to be downloaded again.
+                LOG.debug("{}/{} work units done, {} leased by other workers.".format(
+                    progress['done'], total_units, progress['leased']))
+                time.sleep(poll_interval)
+                continue
+
+            unit_id, unit_west, unit_east, unit_north, unit_south = unit
+            LOG.info("Worker '{}' claimed work unit {}/{} (x: {}-{}, y: {}-{})".format(
+                self.worker_id, unit_id, total_units, unit_west, unit_east, unit_north, unit_south))
+
+            # Keep renewing the lease while the tiles of the unit are downloaded.
+            unit_finished = threading.Event()
+
+            def renew_lease():
+                while not unit_finished.wait(lease_timeout / 3.0):
+                    if not lease_table.renew(unit_id, self.worker_id):
+                        LOG.warning("Worker '{}' lost the lease of work unit {}.".format(self.worker_id, unit_id))
+                        return
+
+            renew_thread = threading.Thread(target=renew_lease, name='Lease-Renew-Thread')
+            renew_thread.daemon = True
+            renew_thread.start()
+
+            try:
+                failed_tiles = self.download_tiles(unit_west, unit_east, unit_north, unit_south, retry_failed)
+            finally:
+                unit_finished.set()
+                renew_thread.join()
+
+            lease_table.complete(unit_id, self.worker_id, failed_tiles)
+
+        progress = lease_table.progress()
+        LOG.info("Worker '{}' finished. {}/{} work units have been downloaded.".format(
+            self.worker_id, progress['done'], total_units))
+        if progress['failed']:
+            LOG.warning("{} work units could not be downloaded completely after {} attempts.".format(
+                progress['failed'], lease_table.max_attempts))
+
+    # ----------------------------------------------------------------------
+    def _calculate_max_dimensions_per_stitch(self, tile_west, tile_east, tile_north, tile_south, layout=None):
+        """
+        Calculate the layout of the final stitches, so that no stitch is larger than self.max_stitch_dimensions.
+
+        layout: One of STITCH_LAYOUTS, or 'auto' to choose the layout with the lowest cost (see
+                stitch_layout_cost()). If None, self.stitch_layout is used.
+
+        The returned dictionary contains the width of every column of stitches (horizontal_resolutions),
+        the height of every row of stitches (vertical_resolutions), and the cost of the layout.
+        horizontal/vertical_resolution_per_stitch are the size of the largest stitch.
+
+        If the stitches are scaled (self.output_scale), the resolutions are the scaled resolutions of the stitches,
+        and horizontal/vertical_source_resolutions are the source pixels of the zoom level that every column/row
+        of stitches covers. Otherwise both are the same.
+        """
+        if layout is None:
+            layout = self.stitch_layout
+
+        number_of_horizontal_tiles = (tile_east - tile_west) + 1
+        number_of_vertical_tiles = (tile_south - tile_north) + 1
+
+        # If we do not already know the dimensions of the tiles, then read the dimensions.
+        if self._tile_height is None or self._tile_width is None:
+            first_y_tile_path = self._find_tile(tile_west, tile_north)
+            if first_y_tile_path is None:
+                first_y_tile_path = self._tile_path(tile_west, tile_north)
+            try:
+                img = gmImage(first_y_tile_path)
+                self._tile_height = img.rows()
+                self._tile_width = img.columns()
+            except RuntimeError as e:
+                LOG.critical(e)
+                exit(1)
+
+        if layout == 'auto':
+            # min() returns the first of the layouts with the lowest cost, so 'exact' wins the ties.
+            return min([self._calculate_max_dimensions_per_stitch(tile_west, tile_east, tile_north, tile_south, l)
+                        for l in STITCH_LAYOUTS], key=lambda d: d['cost']['cost'])
+
+        # The layout is planned in source pixels, with stitches that are at most max_stitch_dimensions pixels
+        # after they are scaled (one output pixel less, since the scaled stitch boundaries are rounded).
+        max_source_dimensions = self.max_stitch_dimensions
+        if self.output_scale != 1:
+            max_source_dimensions = int((self.max_stitch_dimensions - 1) / self.output_scale)
+        horizontal_source_resolutions = stitch_layout_sizes(
+            number_of_horizontal_tiles, self._tile_width, max_source_dimensions, layout)
+        vertical_source_resolutions = stitch_layout_sizes(
+            number_of_vertical_tiles, self._tile_height, max_source_dimensions, layout)
+
+        horizontal_resolutions = horizontal_source_resolutions
+        vertical_resolutions = vertical_source_resolutions
+        if self.output_scale != 1:
+            horizontal_resolutions, horizontal_source_resolutions = self._scaled_resolutions(horizontal_source_resolutions)
+            vertical_resolutions, vertical_source_resolutions = self._scaled_resolutions(vertical_source_resolutions)
+
+        return {
+            'layout': layout,
+            'total_vertical_resolution': sum(vertical_resolutions),
+            'total_horizontal_resolution': sum(horizontal_resolutions),
+            'vertical_resolution_per_stitch': max(vertical_resolutions),
+            'horizontal_resolution_per_stitch': max(horizontal_resolutions),
+            'vertical_resolutions': vertical_resolutions,
+            'horizontal_resolutions': horizontal_resolutions,
+            'vertical_source_resolutions': vertical_source_resolutions,
+            'horizontal_source_resolutions': horizontal_source_resolutions,
+            'vertical_divide_by': len(vertical_resolutions),
+            'horizontal_divide_by': len(horizontal_resolutions),
+            'cost': stitch_layout_cost(horizontal_source_resolutions, vertical_source_resolutions,
+                                       self._tile_width, self._tile_height)
+        }
+
+    # ----------------------------------------------------------------------
+    def _scaled_resolutions(self, source_resolutions):
+        """
+        Returns the (scaled resolutions, source resolutions) of the stitches along one axis, for the stitches
+        of source_resolutions pixels that are scaled by self.output_scale. Every output pixel belongs to one
+        stitch, so the source pixels of the stitches are adjusted to the output pixels that they fall in.
+        """
+        output_boundaries = [0]
+        source_boundary = 0
+        for size in source_resolutions:
+            source_boundary += size
+            output_boundaries.append(scaled_pixel(source_boundary - 1, self.output_scale) + 1)
+        source_boundaries = [first_source_pixel(b, self.output_scale) for b in output_boundaries]
+
+        return ([b - a for a, b in zip(output_boundaries, output_boundaries[1:])],
+                [b - a for a, b in zip(source_boundaries, source_boundaries[1:])])
+
+    # ----------------------------------------------------------------------
+    def default_preview_zoom(self, tile_west, tile_east, tile_north, tile_south, min_preview_px=512):
+        """
+        Returns the zoom level of the previews (see preview_stitches()): the lowest zoom level where the largest
+        stitch still has at least min_preview_px pixels on its longest side, but at least one zoom level lower
+        than the zoom level (except for zoom 0). If the tile dimensions are not known yet, 256x256 pixels tiles
+        are assumed.
+        """
+        tile_size = max(self._tile_width or 256, self._tile_height or 256)
+        largest_stitch = min(self.max_stitch_dimensions,
+                             max(tile_east + 1 - tile_west, tile_south + 1 - tile_north) * tile_size)
+        levels = min(1, self.zoom)
+        while levels < self.zoom and largest_stitch >> (levels + 1) >= min_preview_px:
+            levels += 1
+
+        return self.zoom - levels
+
+    # ----------------------------------------------------------------------
+    def preview_stitches(self, tile_west, tile_east, tile_north, tile_south, preview_zoom):
+        """
+        Generate a quick-look preview of the stitches of the zoom level from the tiles of the (much lower) zoom
+        level preview_zoom, to check the area and the stitch layout before downloading and stitching the tiles
+        of this zoom level.
+
+        The preview of every stitch of the planned layout is saved in 'preview/ZOOM/Y_X.EXT' of the project folder,
+        with its OziExplorer calibration file 'Y_X.map'. The thumbnails of the previews are upsampled to the size
+        of the thumbnails of the final stitches, so the index images 'preview/ZOOM-index.png' and
+        'preview/ZOOM-index-labeled.png' have the same layout as the final index images.
+        """
+        levels = self.zoom - preview_zoom
+
+        # The tiles have the same dimensions in every zoom level, so read them from the preview tiles.
+        if self._tile_width is None or self._tile_height is None:
+            first_tile_path = self._find_tile(tile_west >> levels, tile_north >> levels, zoom=preview_zoom)
+            if first_tile_path is None:
+                LOG.warning("The first tile of zoom {} hasn't been downloaded. Assuming 256x256 pixels tiles.".format(
+                    preview_zoom))
+                self._tile_width = self._tile_height = 256
+            else:
+                img = gmImage()
+                img.ping(first_tile_path)
+                self._tile_width, self._tile_height = img.columns(), img.rows()
+
+        dimensions = self._calculate_max_dimensions_per_stitch(
+            tile_west, tile_east, tile_north, tile_south)
+        total_stitches = dimensions['vertical_divide_by'] * dimensions['horizontal_divide_by']
+
+        preview_path = os.path.join(self.project_folder, 'preview', str(self.zoom))
+        thumbnails_path = os.path.join(preview_path, 'thumbs')
+        os.makedirs(thumbnails_path, exist_ok=True)
+
+        myProgressBarFd = sys.stderr
+        # If log level is set to 1000 (logging is disabled), or DEBUG, then redirect
+        # the progress bar to /dev/null (use os.devnull to support windows as well)
+        if LOG.getEffectiveLevel() == 1000 or LOG.getEffectiveLevel() == logging.DEBUG:
+            myProgressBarFd = open(os.devnull, "w")
+
+        widgets = ['Previewing stitch ', progressbar.Counter(format='%{}d'.format(len(str(total_stitches)))), '/{}: '.format(total_stitches),
+                   progressbar.Percentage(), ' ', progressbar.Bar(marker='#'), ' ', progressbar.RotatingMarker(), ' ', progressbar.ETA()]
+
+        pbar = progressbar.ProgressBar(
+            widgets=widgets, maxval=total_stitches, fd=myProgressBarFd).start()
+
+        extension = self.saved_stitched_tile_format
+        all_thumb_stitches = []
+        try:
+            y_pixel = tile_north * self._tile_height
+            for y, y_res in enumerate(dimensions['vertical_resolutions']):
+                x_pixel = tile_west * self._tile_width
+                y_source_res = dimensions['vertical_source_resolutions'][y]
+                for x, x_res in enumerate(dimensions['horizontal_resolutions']):
+                    x_source_res = dimensions['horizontal_source_resolutions'][x]
+                    filename = '{}_{}'.format(y, x)
+                    path_to_preview = os.path.join(preview_path, '{}.{}'.format(filename, extension))
+                    path_to_thumb = os.path.join(thumbnails_path, '{}.{}'.format(filename, extension))
+
+                    # The area of the stitch in the preview zoom level
+                    x0, y0 = x_pixel >> levels, y_pixel >> levels
+                    x1, y1 = -(-(x_pixel + x_source_res) >> levels), -(-(y_pixel + y_source_res) >> levels)
+                    preview_west, preview_north = x0 // self._tile_width, y0 // self._tile_height
+                    x_tiles = (x1 - 1) // self._tile_width + 1 - preview_west
+                    y_tiles = (y1 - 1) // self._tile_height + 1 - preview_north
+                    list_of_files = [self._find_tile(preview_west + i, preview_north + j, zoom=preview_zoom) or
+                                     self._tile_path(preview_west + i, preview_north + j, zoom=preview_zoom)
+                                     for j in range(y_tiles) for i in range(x_tiles)]
+
+                    try:
+                        pixels = assemble_tiles(list_of_files, x_tiles, y_tiles, self._tile_width, self._tile_height,
+                                                x1 - x0, y1 - y0, x0 - preview_west * self._tile_width,
+                                                y0 - preview_north * self._tile_height)
+                        write_image_pixels(path_to_preview, pixels)
+
+                        thumb = thumbnail_accumulator(x1 - x0, y1 - y0)
+                        thumb.add_rows(0, pixels)
+                        pixels_to_image(resize_nearest(thumb.pixels(), *thumbnail_size(x_res, y_res))).write(path_to_thumb)
+                    except (RuntimeError, ValueError) as e:
+                        LOG.error("ERROR: Could not generate the preview '{}': {}".format(path_to_preview, e))
+                        return
+
+                    # The preview covers whole pixels of the preview zoom level, which may be slightly more
+                    # than the stitch, so it is calibrated with its own corners.
+                    N_deg, W_deg = self.pixel2deg((x0 << levels) + 1, (y0 << levels) + 1, self._tile_width, self._tile_height)
+                    S_deg, E_deg = self.pixel2deg(x1 << levels, y1 << levels, self._tile_width, self._tile_height)
+                    with open(os.path.join(preview_path, '{}.map'.format(filename)), 'w+') as f:
+                        f.write(self.generate_OZI_map_file(filename, extension, x1 - x0, y1 - y0, preview_zoom,
+                                                           N_deg, S_deg, W_deg, E_deg))
+
+                    all_thumb_stitches.append(path_to_thumb)
+                    pbar.currval += 1
+                    pbar.update(pbar.currval)
+                    x_pixel += x_source_res
+                y_pixel += y_source_res
+        finally:
+            pbar.finish()
+
+        index_file = '{}-index.png'.format(preview_path)
+        try:
+            render_index_images(all_thumb_stitches, dimensions['horizontal_divide_by'],
+                                dimensions['vertical_divide_by'], index_file, '{}-index-labeled.png'.format(preview_path))
+        except (RuntimeError, ValueError) as e:
+            LOG.error("ERROR: Could not generate image index '{}': {}".format(index_file, e))
+            return
+
+        LOG.info("The preview of the {} stitches ({}x{}) of zoom {} was generated from zoom {} in '{}'.".format(
+            total_stitches, dimensions['horizontal_divide_by'], dimensions['vertical_divide_by'], self.zoom,
+            preview_zoom, preview_path))
+        LOG.info("Run the script again without --preview to download and stitch the tiles of zoom {}.".format(self.zoom))
+
+    # ----------------------------------------------------------------------
+    def stitch_layout_plan(self, tile_west, tile_east, tile_north, tile_south):
+        """
+        Returns a printable table with the cost of every stitch layout for the given tiles.
+        The layout that is used with the current self.stitch_layout is marked with a '*'.
+        """
+        chosen = self._calculate_max_dimensions_per_stitch(tile_west, tile_east, tile_north, tile_south)
+
+        lines = ["Stitch layouts for zoom {} (max stitch dimensions: {} px, tiles: {}x{} px):".format(
+            self.zoom, self.max_stitch_dimensions, self._tile_width, self._tile_height)]
+        lines.append("    {:<14}{:>10}{:>16}{:>18}{:>16}{:>20}{:>10}".format(
+            'layout', 'stitches', 'grid', 'largest stitch', 'decoded MPx', 'redundant MPx', 'cost'))
+        for layout in STITCH_LAYOUTS:
+            d = self._calculate_max_dimensions_per_stitch(tile_west, tile_east, tile_north, tile_south, layout)
+            lines.append("  {} {:<14}{:>10}{:>16}{:>18}{:>16}{:>20}{:>10}".format(
+                '*' if layout == chosen['layout'] else ' ',
+                layout,
+                d['cost']['stitches'],
+                '{}x{}'.format(d['horizontal_divide_by'], d['vertical_divide_by']),
+                '{}x{} px'.format(d['horizontal_resolution_per_stitch'], d['vertical_resolution_per_stitch']),
+                '{:.1f}'.format(d['cost']['decoded_pixels'] / 1000000.0),
+                '{:.1f} ({:.1f}%)'.format(d['cost']['redundant_pixels'] / 1000000.0,
+                                          100.0 * d['cost']['redundant_pixels'] / d['cost']['decoded_pixels']),
+                '{:.1f}'.format(d['cost']['cost'])))
+
+        lines.append("  Largest stitch of the chosen layout '{}': {:.1f} MB of RGBA pixels.".format(
+            chosen['layout'], chosen['cost']['max_stitch_bytes'] / 1048576.0))
+        lines.append("  Widths of the stitch columns: {}".format(chosen['horizontal_resolutions']))
+        lines.append("  Heights of the stitch rows: {}".format(chosen['vertical_resolutions']))
+
+        return '\n'.join(lines)
+
+    # ----------------------------------------------------------------------
+    def _stitch_thumbnail(self, img, thumb_filepath, x_res=144, y_res=144):
+        """
+        Function to generate a thumbnail from a stitch img.
+        img is a graphicmagick Image object.
+        """
+
+        LOG.debug("Generating thumbnail '{}'".format(thumb_filepath))
+
+        geometry = pgmagick.Geometry(*thumbnail_size(img.columns(), img.rows(), x_res, y_res))
+        img.scale(geometry)
+        img.write(thumb_filepath)
+
+    # ----------------------------------------------------------------------
+    def _stitch_montage(self, list_of_files, stitch_filepath, x_tiles, y_tiles, x_res, y_res, crop_left, crop_top):
+        """
+        Stitch the tiles with the montage command line utility, and crop the result.
+        Returns the stitched graphicsmagick Image object, or None if the montage failed.
+        """
+        # Prepare the montage command to execute on command line.
+        # Graphicsmagick has a bug (at least in the version that I am using) and when doing the montage
+        # from jpg files, the resulting montaged images are half of the expected size. So when stitching
+        # from jpg source files, use the imagemagick montage, while for all the rest, use gm montage which
+        # is faster.
+        if self.saved_tile_format == 'jpg' or self.saved_tile_format == 'jpeg':
+            montage_cmd = ['montage']
+        else:
+            montage_cmd = ['gm', 'montage']
+        montage_cmd.extend(list_of_files)
+        # Run the montage, but do not save into a file! Instead, redirect a png output to stdout. Since the stdout is binary
+        # data and stored in memory, we use pgmagick.Blob to load it in a pgmagick object and crop it later without having to
+        # write a intermediate file on hard disk in between.
+        montage_cmd.extend(['-tile', '{}x{}'.format(x_tiles, y_tiles),
+                            '-background', 'none', '-geometry', '+0+0', 'png:-'])
+
+        # Stitch the images here
+        montage = executeCommand(montage_cmd)
+
+        if montage.getReturnCode() != 0 and montage.getReturnCode() is not None:
+            LOG.error("ERROR: Could not generate stitch file '{}.".format(
+                stitch_filepath))
+            return None
+        else:
+            # Load the stitched image and first crop and save it....
+            LOG.debug("Cropping tile '{}' left, top: {}, {}".format(
+                stitch_filepath, crop_left, crop_top))
+            # Use a Blob to load the output of the montage command we executed earlier.
+            img = gmImage(pgmagick.Blob(
+                montage.getStdout(getList=False, decode=False)))
+            img.crop('{}x{}+{}+{}'.format(x_res,
+                                          y_res, crop_left, crop_top))
+            return img
+
+    # ----------------------------------------------------------------------
+    def _stitch_native(self, list_of_files, stitch_filepath, thumb_filepath, x_tiles, y_tiles, x_res, y_res,
+                       crop_left, crop_top, uniform_tiles=None, scaling=None):
+        """
+        Stitch the tiles in-process: every tile is decoded once straight into a preallocated numpy
+        canvas, only the needed part of the boundary tiles is copied (so there is no separate crop
+        step), and the canvas is encoded once when the stitch is saved. The thumbnail is built from the canvas.
+        PNG stitches are deflated in parallel by self._encoderThreads threads.
+
+        Compared to the montage, this saves the process spawn and a full encode/decode cycle of the
+        stitch per stitch, and it isn't affected by the gm montage bug with jpg tiles.
+
+        scaling: (scale, x_offset, y_offset) to scale the tiles as they are placed (see assemble_tiles_scaled()).
+
+        Returns True if the stitch and the thumbnail were generated successfully.
+        """
+        try:
+            if scaling is not None:
+                canvas = assemble_tiles_scaled(list_of_files, x_tiles, y_tiles, self._tile_width, self._tile_height,
+                                               x_res, y_res, crop_left, crop_top, *scaling, tile_cache=self._tileCache,
+                                               uniform_tiles=uniform_tiles)
+            else:
+                canvas = assemble_tiles(list_of_files, x_tiles, y_tiles, self._tile_width, self._tile_height,
+                                        x_res, y_res, crop_left, crop_top, tile_cache=self._tileCache,
+                                        uniform_tiles=uniform_tiles)
+        except (RuntimeError, ValueError) as e:
+            LOG.error("ERROR: Could not generate stitch file '{}': {}".format(stitch_filepath, e))
+            return False
+
+        self._write_thumbnail([(0, canvas)], x_res, y_res, thumb_filepath)
+
+        LOG.debug("Saving tile '{}'".format(stitch_filepath))
+        if self.saved_stitched_tile_format == 'png':
+            try:
+                self._write_png_stitch(stitch_filepath, canvas)
+            except ValueError as e:
+                LOG.error("ERROR: Could not generate stitch file '{}': {}".format(stitch_filepath, e))
+                return False
+        else:
+            img = pixels_to_image(canvas)
+            # The raw RGBA magick of the canvas must not be used when the stitch is written.
+            img.magick('JPEG')
+            img.write(stitch_filepath)
+
+        return True
+
+    # ----------------------------------------------------------------------
+    def _write_png_stitch(self, stitch_filepath, canvas):
+        """
+        Write the (y_res, x_res, 4) canvas (a numpy array or a memory mapped canvas) in a png stitch, one row
+        of tiles at a time, deflated by self._encoderThreads threads.
+
+        If self.quantize_colors is set, the stitch is written as an indexed color png with a palette of at most
+        self.quantize_colors colors (see palette_quantizer), unless the stitch has too many colors for the palette
+        (e.g. aerial imagery), in which case it is written in true color.
+        """
+        y_res, x_res = canvas.shape[:2]
+        bands = range(0, y_res, self._tile_height)
+
+        quantizer = None
+        if self.quantize_colors:
+            quantizer = palette_quantizer(self.quantize_colors, self.dither, self.quantize_max_error)
+            if all(quantizer.add_rows(canvas[y:y + self._tile_height]) for y in bands) and quantizer.build():
+                LOG.debug("Stitch '{}' is written with a palette of {} colors (RMS error {:.1f}).".format(
+                    stitch_filepath, len(quantizer.palette), quantizer.error))
+            else:
+                LOG.debug("Stitch '{}' has too many colors for a palette. It is written in true color.".format(
+                    stitch_filepath))
+                quantizer = None
+
+        writer = png_stream_writer(stitch_filepath, x_res, y_res, threads=self._encoderThreads,
+                                   palette=quantizer.palette if quantizer is not None else None)
+        try:
+            for y in bands:
+                rows = canvas[y:y + self._tile_height]
+                if quantizer is not None:
+                    rows = quantizer.indices(rows, y)[:, :, np.newaxis]
+                writer.write_rows(rows)
+            writer.close()
+        except ValueError:
+            writer.abort()
+            raise
+
+    # ----------------------------------------------------------------------
+    def _stitch_jpegtran(self, list_of_files, stitch_filepath, thumb_filepath, x_tiles, y_tiles, x_res, y_res,
+                         crop_left, crop_top, uniform_tiles=None):
+        """
+        Stitch JPEG tiles losslessly in the DCT domain with jpegtran, without decoding and encoding them again:
+        the tiles of every row of tiles are joined in pairs (the second one is dropped (inserted) in an expanded
+        copy of the first one), the pairs in pairs again until the row is complete, the rows are joined in the
+        same way, and the result is cropped to the stitch. Every tile is rewritten only log2(x_tiles) +
+        log2(y_tiles) times, so the I/O does not grow quadratically with the size of the stitch. The stitch
+        has no generation loss and the stitching is I/O bound.
+
+        The coefficients can only be moved in whole MCUs (usually 16x16 pixels), so the tiles must have the same
+        sampling factors and quantization tables, and the tile size and the crop offsets must be multiples of
+        the MCU size (e.g. with --stitch-layout tile-aligned). Otherwise the stitch is stitched by the native
+        engine. The thumbnail is decoded from the stitch with the reduced DCT scaling of libjpeg.
+
+        Returns True if the stitch and the thumbnail were generated successfully.
+        """
+        infos = [jpeg_frame_info(path) if os.path.isfile(path) else None for path in list_of_files]
+        first = infos[0]
+        if (None in infos or any(info['signature'] != first['signature'] or info['width'] != self._tile_width or
+                                 info['height'] != self._tile_height for info in infos) or
+                self._tile_width % first['mcu_width'] or self._tile_height % first['mcu_height'] or
+                crop_left % first['mcu_width'] or crop_top % first['mcu_height']):
+            LOG.debug("The tiles of '{}' can't be joined losslessly (missing, different or not MCU aligned tiles). "
+                      "Stitching them with the native engine.".format(stitch_filepath))
+            return self._stitch_native(list_of_files, stitch_filepath, thumb_filepath, x_tiles, y_tiles,
+                                       x_res, y_res, crop_left, crop_top, uniform_tiles)
+
+        tmp_path = partial_path(stitch_filepath)
+        work_paths = []
+
+        def remove_work_file(path):
+            if path in work_paths and os.path.exists(path):
+                os.remove(path)
+
+        def join(parts, horizontal):
+            # Join the (path, width, height) parts side by side (or one below the other) in pairs, and the pairs
+            # in pairs again, so that every tile is rewritten log2(len(parts)) times instead of len(parts) times.
+            while len(parts) > 1:
+                joined = []
+                for (first_path, first_width, first_height), (second_path, second_width, second_height) in \
+                        zip(parts[0::2], parts[1::2]):
+                    if horizontal:
+                        width, height, offset = first_width + second_width, first_height, '+{}+0'.format(first_width)
+                    else:
+                        width, height, offset = first_width, first_height + second_height, '+0+{}'.format(first_height)
+                    expanded_path = '{}.{}'.format(tmp_path, len(work_paths))
+                    joined_path = '{}.{}'.format(tmp_path, len(work_paths) + 1)
+                    work_paths.extend([expanded_path, joined_path])
+                    jpegtran(first_path, expanded_path, '-crop', '{}x{}+0+0'.format(width, height))
+                    jpegtran(expanded_path, joined_path, '-drop', offset, second_path)
+                    for path in (expanded_path, first_path, second_path):
+                        remove_work_file(path)
+                    joined.append((joined_path, width, height))
+                if len(parts) % 2:
+                    joined.append(parts[-1])
+                parts = joined
+
+            return parts[0]
+
+        try:
+            rows = [join([(path, self._tile_width, self._tile_height)
+                          for path in list_of_files[row * x_tiles:(row + 1) * x_tiles]], True)
+                    for row in range(y_tiles)]
+            canvas_path = join(rows, False)[0]
+
+            jpegtran(canvas_path, tmp_path, '-crop', '{}x{}+{}+{}'.format(x_res, y_res, crop_left, crop_top))
+            os.replace(tmp_path, stitch_filepath)
+        except RuntimeError as e:
+            LOG.warning("Could not join the tiles of '{}' losslessly ({}). Stitching them with the native "
+                        "engine.".format(stitch_filepath, e))
+            return self._stitch_native(list_of_files, stitch_filepath, thumb_filepath, x_tiles, y_tiles,
+                                       x_res, y_res, crop_left, crop_top, uniform_tiles)
+        finally:
+            for path in work_paths + [tmp_path]:
+                if os.path.exists(path):
+                    os.remove(path)
+
+        # Let libjpeg decode the stitch at the smallest DCT scale that is not smaller than the thumbnail.
+        img = gmImage()
+        img.size(pgmagick.Geometry(*thumbnail_size(x_res, y_res)))
+        img.read(stitch_filepath)
+        self._stitch_thumbnail(img, thumb_filepath)
+
+        return True
+
+    # ----------------------------------------------------------------------
+    def _write_thumbnail(self, bands, x_res, y_res, thumb_filepath):
+        """
+        Write the thumbnail of a x_res x y_res stitch from its bands: an iterable of (y0, rows)
+        with the rows of the stitch that start at row y0.
+        """
+        LOG.debug("Generating thumbnail '{}'".format(thumb_filepath))
+        thumb = thumbnail_accumulator(x_res, y_res)
+        for y0, rows in bands:
+            thumb.add_rows(y0, rows)
+
+        pixels_to_image(thumb.pixels()).write(thumb_filepath)
+
+    # ----------------------------------------------------------------------
+    def _thumbnail_from_tiles(self, list_of_files, x_tiles, y_tiles, x_res, y_res, crop_left, crop_top, thumb_filepath,
+                              uniform_tiles=None):
+        """
+        Build the thumbnail of a stitch straight from its tiles, one row of tiles at a time,
+        without stitching (or decoding) the complete stitch.
+        """
+        self._write_thumbnail(
+            ((y0, assemble_tiles(list_of_files[row * x_tiles:(row + 1) * x_tiles], x_tiles, 1, self._tile_width,
+                                 self._tile_height, x_res, y1 - y0, crop_left, band_crop_top,
+                                 tile_cache=self._tileCache, uniform_tiles=uniform_tiles))
+             for row, y0, y1, band_crop_top in self._stitch_bands(y_tiles, y_res, crop_top)),
+            x_res, y_res, thumb_filepath)
+
+    # ----------------------------------------------------------------------
+    def _thumbnail_from_lower_zoom(self, x_pixel, y_pixel, x_res, y_res, thumb_filepath):
+        """
+        Build the thumbnail of the x_res x y_res stitch that starts at the global pixel x_pixel/y_pixel,
+        from the tiles of the lowest zoom level of the project that still has at least as many pixels
+        as the thumbnail. Every zoom level less has 4 times less pixels to decode.
+
+        Returns False if no lower zoom level has all the tiles that are needed.
+        """
+        thumb_width, thumb_height = thumbnail_size(x_res, y_res)
+        levels = 0
+        while levels < self.zoom and (x_res >> (levels + 1)) >= thumb_width and (y_res >> (levels + 1)) >= thumb_height:
+            levels += 1
+
+        for levels in range(levels, 0, -1):
+            # The area of the stitch in the lower zoom level
+            x0, y0 = x_pixel >> levels, y_pixel >> levels
+            x1, y1 = -(-(x_pixel + x_res) >> levels), -(-(y_pixel + y_res) >> levels)
+            tile_west, tile_north = x0 // self._tile_width, y0 // self._tile_height
+            x_tiles = (x1 - 1) // self._tile_width + 1 - tile_west
+            y_tiles = (y1 - 1) // self._tile_height + 1 - tile_north
+
+            list_of_files = [self._find_tile(tile_west + x, tile_north + y, zoom=self.zoom - levels)
+                             for y in range(y_tiles) for x in range(x_tiles)]
+            if None in list_of_files:
+                continue
+
+            LOG.debug("Generating thumbnail '{}' from zoom level {}".format(thumb_filepath, self.zoom - levels))
+            try:
+                self._thumbnail_from_tiles(list_of_files, x_tiles, y_tiles, x1 - x0, y1 - y0,
+                                           x0 - tile_west * self._tile_width, y0 - tile_north * self._tile_height,
+                                           thumb_filepath)
+                return True
+            except (RuntimeError, ValueError) as e:
+                LOG.debug("Could not use zoom level {} for the thumbnail: {}".format(self.zoom - levels, e))
+
+        return False
+
+    # ----------------------------------------------------------------------
+    def _stitch_bands(self, y_tiles, y_res, crop_top):
+        """
+        Generator that yields (row, y0, y1, band_crop_top) for every row of tiles of a stitch that
+        falls inside the stitch: the row of tiles covers the rows y0 to y1 - 1 of the stitch, after
+        band_crop_top pixels are cropped from the top of the row of tiles.
+        """
+        for row in range(y_tiles):
+            band_top = row * self._tile_height - crop_top
+            y0, y1 = max(band_top, 0), min(band_top + self._tile_height, y_res)
+            if y1 > y0:
+                yield row, y0, y1, y0 - band_top
+
+    # ----------------------------------------------------------------------
+    def _stitch_streaming(self, list_of_files, stitch_filepath, thumb_filepath, x_tiles, y_tiles, x_res, y_res,
+                          crop_left, crop_top, uniform_tiles=None):
+        """
+        Stitch the tiles one row of tiles at a time and write the stitch incrementally with the
+        png_stream_writer, so the memory that is needed is bounded by one row of tiles (x_res * tile height
+        RGBA pixels), regardless of the size of the stitch. The thumbnail is built from the bands while
+        they are written, so the stitch never has to be decoded again.
+
+        Returns True if the stitch and the thumbnail were generated successfully.
+        """
+        x_res, y_res, crop_left, crop_top = int(x_res), int(y_res), int(crop_left), int(crop_top)
+
+        thumb = thumbnail_accumulator(x_res, y_res)
+
+        writer = png_stream_writer(stitch_filepath, x_res, y_res, threads=self._encoderThreads)
+        try:
+            for row, y0, y1, band_crop_top in self._stitch_bands(y_tiles, y_res, crop_top):
+                band = assemble_tiles(list_of_files[row * x_tiles:(row + 1) * x_tiles], x_tiles, 1,
+                                      self._tile_width, self._tile_height, x_res, y1 - y0, crop_left, band_crop_top,
+                                      tile_cache=self._tileCache, uniform_tiles=uniform_tiles)
+                writer.write_rows(band)
+                thumb.add_rows(y0, band)
+
+            writer.close()
+        except (RuntimeError, ValueError) as e:
+            writer.abort()
+            LOG.error("ERROR: Could not generate stitch file '{}': {}".format(stitch_filepath, e))
+            return False
+
+        LOG.debug("Generating thumbnail '{}'".format(thumb_filepath))
+        pixels_to_image(thumb.pixels()).write(thumb_filepath)
+
+        return True
 
     # ----------------------------------------------------------------------
-    def _calculate_max_dimensions_per_stitch(self, tile_west, tile_east, tile_north, tile_south):
+    def _stitch_memmap(self, list_of_files, stitch_filepath, thumb_filepath, x_tiles, y_tiles, x_res, y_res,
+                       crop_left, crop_top, uniform_tiles=None):
         """
-        Calculate the max horizontal/vertical dimensions for the final stitches
+        Stitch the tiles in a memory mapped raw RGBA canvas file next to the stitch. The rows of tiles
+        are disjoint regions of the canvas, so they are assembled in parallel by the band threads of
+        self._bandExecutor, which lets all the cores work on a single enormous stitch. The encoder then
+        reads the pixels straight from the mapped file (png stitches are streamed with the png_stream_writer,
+        one row of tiles at a time), and the canvas file is removed.
+
+        Returns True if the stitch and the thumbnail were generated successfully.
         """
-        number_of_horizontal_tiles = (tile_east - tile_west) + 1
-        number_of_vertical_tiles = (tile_south - tile_north) + 1
+        x_res, y_res, crop_left, crop_top = int(x_res), int(y_res), int(crop_left), int(crop_top)
+
+        canvas_path = os.path.join(os.path.dirname(stitch_filepath),
+                                   '.{}.canvas'.format(os.path.basename(stitch_filepath)))
+        # The canvas file is created sparse, so the areas of the missing tiles are already transparent.
+        canvas = np.memmap(canvas_path, dtype=np.uint8, mode='w+', shape=(y_res, x_res, 4))
+        band_executor = self._bandExecutor
+        in_processes = band_executor is self._stitchProcessPool
+        try:
+            if in_processes:
+                # Every worker process maps the canvas file itself.
+                bands = [band_executor.submit(run_counting_tile_cache, assemble_tiles_in_memmap, canvas_path,
+                                              canvas.shape, y0, y1, list_of_files[row * x_tiles:(row + 1) * x_tiles],
+                                              x_tiles, self._tile_width, self._tile_height, crop_left, band_crop_top,
+                                              uniform_tiles)
+                         for row, y0, y1, band_crop_top in self._stitch_bands(y_tiles, y_res, crop_top)]
+            else:
+                bands = [band_executor.submit(assemble_tiles, list_of_files[row * x_tiles:(row + 1) * x_tiles],
+                                              x_tiles, 1, self._tile_width, self._tile_height, x_res, y1 - y0,
+                                              crop_left, band_crop_top, canvas[y0:y1], tile_cache=self._tileCache,
+                                              uniform_tiles=uniform_tiles)
+                         for row, y0, y1, band_crop_top in self._stitch_bands(y_tiles, y_res, crop_top)]
+            for band in bands:
+                result = band.result()
+                if in_processes:
+                    self._count_process_tile_cache(result)
+
+            LOG.debug("Saving tile '{}'".format(stitch_filepath))
+            if self.saved_stitched_tile_format == 'png':
+                self._write_png_stitch(stitch_filepath, canvas)
+            else:
+                img = pixels_to_image(canvas)
+                img.magick('JPEG')
+                img.write(stitch_filepath)
+
+            self._write_thumbnail(((y, canvas[y:y + self._tile_height]) for y in range(0, y_res, self._tile_height)),
+                                  x_res, y_res, thumb_filepath)
+        except concurrent.futures.BrokenExecutor:
+            # A worker process died, so the pool is broken for all the stitches: replace it, and let the
+            # stitching thread count the stitch as failed.
+            if in_processes:
+                self._replace_broken_stitch_process_pool(band_executor)
+            raise
+        except (RuntimeError, ValueError, MemoryError) as e:
+            LOG.error("ERROR: Could not generate stitch file '{}': {}".format(stitch_filepath, e))
+            return False
+        finally:
+            del canvas
+            os.remove(canvas_path)
 
-        # If we do not already know the dimensions of the tiles, then read the dimensions.
-        if self._tile_height is None or self._tile_width is None:
-            x_path = os.path.join(self.project_folder,
-                                  str(self.zoom), str(tile_west))
-            first_y_tile_path = '{}.{}'.format(os.path.join(
-                x_path, str(tile_north)), self.saved_tile_format)
-            try:
-                img = gmImage(first_y_tile_path)
-                self._tile_height = img.rows()
-                self._tile_width = img.columns()
-            except RuntimeError as e:
-                LOG.critical(e.message)
-                exit(1)
+        return True
 
-        total_vertical_resolution = self._tile_height * number_of_vertical_tiles
-        total_horizontal_resolution = self._tile_width * number_of_horizontal_tiles
+    # ----------------------------------------------------------------------
+    def _stitch_one(self, list_of_files, stitch_filepath, thumb_filepath, x_tiles, y_tiles, x_res, y_res,
+                    crop_left, crop_top, uniform_tiles=None, scaling=None):
+        """
+        Stitch one stitch and its thumbnail with self.stitch_engine.
+        This runs either in a stitching thread or in a stitching worker process.
+        uniform_tiles: The {path: (r, g, b, a)} dictionary of the tiles of the stitch that have a single color.
+        scaling: (scale, x_offset, y_offset) if the stitch is scaled (see assemble_tiles_scaled()). The scaled
+                 stitches are always stitched by the native engine, which scales the tiles as they are placed.
 
-        vertical_resolution_per_stitch = total_vertical_resolution
-        horizontal_resolution_per_stitch = total_horizontal_resolution
+        Returns True if the stitch was generated successfully.
+        """
+        if scaling is not None:
+            return self._stitch_native(list_of_files, stitch_filepath, thumb_filepath, x_tiles, y_tiles,
+                                       x_res, y_res, crop_left, crop_top, uniform_tiles, scaling)
+        elif self.stitch_engine == 'streaming':
+            return self._stitch_streaming(list_of_files, stitch_filepath, thumb_filepath, x_tiles, y_tiles,
+                                          x_res, y_res, crop_left, crop_top, uniform_tiles)
+        elif self.stitch_engine == 'memmap':
+            return self._stitch_memmap(list_of_files, stitch_filepath, thumb_filepath, x_tiles, y_tiles,
+                                       x_res, y_res, crop_left, crop_top, uniform_tiles)
+        elif self.stitch_engine == 'native':
+            return self._stitch_native(list_of_files, stitch_filepath, thumb_filepath, x_tiles, y_tiles,
+                                       x_res, y_res, crop_left, crop_top, uniform_tiles)
+        elif self.stitch_engine == 'jpegtran':
+            return self._stitch_jpegtran(list_of_files, stitch_filepath, thumb_filepath, x_tiles, y_tiles,
+                                         x_res, y_res, crop_left, crop_top, uniform_tiles)
+        else:
+            img = self._stitch_montage(list_of_files, stitch_filepath, x_tiles, y_tiles,
+                                       x_res, y_res, crop_left, crop_top)
+            if img is not None:
+                LOG.debug("Saving tile '{}'".format(stitch_filepath))
+                img.write(stitch_filepath)
 
-        vertical_divide_by = 1
-        horizontal_divide_by = 1
+                # Second, generate a thumbnail for the final image index.
+                self._stitch_thumbnail(img, thumb_filepath)
 
-        while vertical_resolution_per_stitch > self.max_stitch_dimensions:
-            # If we have an accurate division without any remainder,
-            if total_vertical_resolution % vertical_divide_by == 0:
-                # If the accurately divided number does not result in a resolution less than
-                # self.max_stitch_dimensions, increase the divisor and try again.
-                if total_vertical_resolution / vertical_divide_by > self.max_stitch_dimensions:
-                    vertical_divide_by += 1
-                else:
-                    # Otherwise use this value for the vertical resolution
-                    # and keep this divisor
-                    vertical_resolution_per_stitch = total_vertical_resolution / vertical_divide_by
-            else:
-                # Otherwise, increase the divisor
-                vertical_divide_by += 1
-
-        # Same story as the previous while-loop, but do it for the horizontal resolution.
-        while horizontal_resolution_per_stitch > self.max_stitch_dimensions:
-            if total_horizontal_resolution % horizontal_divide_by == 0:
-                if total_horizontal_resolution / horizontal_divide_by > self.max_stitch_dimensions:
-                    horizontal_divide_by += 1
-                else:
-                    horizontal_resolution_per_stitch = total_horizontal_resolution / horizontal_divide_by
-            else:
-                horizontal_divide_by += 1
+        return img is not None
 
-        return {
-            'total_vertical_resolution': total_vertical_resolution,
-            'total_horizontal_resolution': total_horizontal_resolution,
-            'vertical_resolution_per_stitch': vertical_resolution_per_stitch,
-            'horizontal_resolution_per_stitch': horizontal_resolution_per_stitch,
-            'vertical_divide_by': vertical_divide_by,
-            'horizontal_divide_by': horizontal_divide_by
-        }
+    # ----------------------------------------------------------------------
+    def _stitch_checking_uniform_tiles(self, unchecked_tiles, list_of_files, stitch_filepath, thumb_filepath, x_tiles,
+                                       y_tiles, x_res, y_res, crop_left, crop_top, uniform_tiles, scaling):
+        """
+        Check the candidate tiles of the stitch that have not been checked for a single color yet (see
+        check_uniform_tiles()), and stitch the stitch with _stitch_one(). This runs either in a stitching
+        thread or in a stitching worker process, so the dispatching thread never decodes tiles.
+
+        Returns (stitched, entries): True if the stitch was generated successfully, and the checked tiles
+        for uniform_tile_index.record(). The montage engine does not use the uniform tiles, so it does not
+        check them.
+        """
+        entries = []
+        if self.stitch_engine != 'montage' or scaling is not None:
+            entries = check_uniform_tiles(unchecked_tiles, self._tileCache)
+            if entries:
+                uniform_tiles = dict(uniform_tiles)
+                uniform_tiles.update(uniform_tile_colors(entries))
+
+        return self._stitch_one(list_of_files, stitch_filepath, thumb_filepath, x_tiles, y_tiles, x_res, y_res,
+                                crop_left, crop_top, uniform_tiles, scaling), entries
 
     # ----------------------------------------------------------------------
-    def _stitch_thumbnail(self, img, thumb_filepath, x_res=144, y_res=144):
+    def _run_in_stitch_process(self, function, *args):
         """
-        Function to generate a thumbnail from a stitch img.
-        img is a graphicmagick Image object.
+        Run function(*args) in the stitching process pool and return its result. If a worker process
+        died (e.g. it was killed by the OOM killer), the pool is broken for all the pending stitches,
+        so replace it with a new pool before the exception is raised.
         """
+        pool = self._stitchProcessPool
+        try:
+            return self._count_process_tile_cache(pool.submit(run_counting_tile_cache, function, *args).result())
+        except concurrent.futures.BrokenExecutor:
+            self._replace_broken_stitch_process_pool(pool)
+            raise
 
-        LOG.debug("Generating thumbnail '{}'".format(thumb_filepath))
+    # ----------------------------------------------------------------------
+    def _count_process_tile_cache(self, result_and_counters):
+        """
+        Adds the tile cache counters of a run_counting_tile_cache() call to the sums of the stitching
+        worker processes, and returns the result of the call.
+        """
+        result, counters = result_and_counters
+        if counters is not None:
+            with self._stitchProcessPoolLock:
+                self._processTileCacheCounters = [total + count for total, count in
+                                                  zip(self._processTileCacheCounters or (0, 0, 0), counters)]
 
-        im_w = img.columns()
-        im_h = img.rows()
-        if im_w > im_h:
-            geo_size = "{}x{}".format(x_res, int(
-                math.ceil((float(im_h) / im_w)) * x_res))
-        else:
-            geo_size = "{}x{}".format(
-                int(math.ceil((float(im_w) / im_h) * y_res)), y_res)
+        return result
 
-        geometry = pgmagick.Geometry(geo_size)
-        img.scale(geometry)
-        img.write(thumb_filepath)
+    # ----------------------------------------------------------------------
+    def _replace_broken_stitch_process_pool(self, pool):
+        """
+        Replace the broken stitching process pool 'pool' with a new pool, unless another stitching thread
+        has already replaced it. The memmap stitches assemble their rows of tiles in the same pool, so the
+        band executor is pointed to the new pool as well.
+        """
+        with self._stitchProcessPoolLock:
+            if self._stitchProcessPool is pool:
+                self._stitchProcessPool = self._new_stitch_process_pool()
+                if self._bandExecutor is pool:
+                    self._bandExecutor = self._stitchProcessPool
 
     # ----------------------------------------------------------------------
     def _stitch_tile_worker(self, inQueue):
         """
         The function will get a list of input files (the paths of the files)
         and stitch them together. It will also generate a thumbnail.
+
+        If the stitches are stitched in worker processes, the thread only hands
+        the stitch to the process pool and waits for it.
+
+        The inputs of the stitches that are generated successfully are recorded in the stitch manifest.
         """
         try:
             while True:
-                list_of_files, stitch_filepath, thumb_filepath, x_tiles, y_tiles, x_res, y_res, crop_left, crop_top, progress_bar = inQueue.get()
+                (list_of_files, stitch_filepath, thumb_filepath, x_tiles, y_tiles, x_res, y_res, crop_left, crop_top,
+                 uniform_tiles, unchecked_tiles, scaling, manifest_params, manifest_inputs, progress_bar,
+                 prefetch_reads) = inQueue.get()
 
                 LOG.debug("{} is STITCHING '{}'".format(
                     threading.current_thread().name, stitch_filepath))
 
-                # Prepare the montage command to execute on command line.
-                # Graphicsmagick has a bug (at least in the version that I am using) and when doing the montage
-                # from jpg files, the resulting montaged images are half of the expected size. So when stitching
-                # from jpg source files, use the imagemagick montage, while for all the rest, use gm montage which
-                # is faster.
-                if self.saved_tile_format == 'jpg' or self.saved_tile_format == 'jpeg':
-                    montage_cmd = ['montage']
-                else:
-                    montage_cmd = ['gm', 'montage']
-                montage_cmd.extend(list_of_files)
-                # Run the montage, but do not save into a file! Instead, redirect a png output to stdout. Since the stdout is binary
-                # data and stored in memory, we use pgmagick.Blob to load it in a pgmagick object and crop it later without having to
-                # write a intermediate file on hard disk in between.
-                montage_cmd.extend(['-tile', '{}x{}'.format(x_tiles, y_tiles),
-                                    '-background', 'none', '-geometry', '+0+0', 'png:-'])
-
-                # Stitch the images here
-                montage = executeCommand(montage_cmd)
-
-                if montage.getReturnCode() != 0 and montage.getReturnCode() is not None:
-                    LOG.error("ERROR: Could not generate stitch file '{}.".format(
-                        stitch_filepath))
-                else:
-                    # Load the stitched image and first crop and save it....
-                    LOG.debug("Cropping tile '{}' left, top: {}, {}".format(
-                        stitch_filepath, crop_left, crop_top))
-                    # Use a Blob to load the output of the montage command we executed earlier.
-                    img = gmImage(pgmagick.Blob(
-                        montage.getStdout(getList=False, decode=False)))
-                    img.crop('{}x{}+{}+{}'.format(x_res,
-                                                  y_res, crop_left, crop_top))
-                    LOG.debug("Saving tile '{}'".format(stitch_filepath))
-                    img.write(stitch_filepath)
-
-                    # Second, generate a thumbnail for the final image index.
-                    self._stitch_thumbnail(img, thumb_filepath)
+                if prefetch_reads is not None:
+                    self._tilePrefetcher.started(prefetch_reads)
+
+                args = (unchecked_tiles, list_of_files, stitch_filepath, thumb_filepath, x_tiles, y_tiles, x_res, y_res,
+                        crop_left, crop_top, uniform_tiles, scaling)
+                stitched = False
+                try:
+                    if self._stitchProcessPool is not None and (self.stitch_engine in ('native', 'streaming', 'jpegtran') or
+                                                                scaling is not None):
+                        stitched, entries = self._run_in_stitch_process(self._stitch_checking_uniform_tiles, *args)
+                    else:
+                        # The memmap stitches are assembled in the worker processes one row of tiles at a time.
+                        stitched, entries = self._stitch_checking_uniform_tiles(*args)
+                    self._uniformTiles.record(entries)
+                except (MemoryError, concurrent.futures.BrokenExecutor) as e:
+                    LOG.error("ERROR: Could not generate stitch file '{}' ({}). The stitch needs more memory than "
+                              "expected; try fewer --stitching-threads.".format(stitch_filepath, type(e).__name__))
+
+                if stitched and self._stitchManifest is not None:
+                    self._stitchManifest.record(os.path.basename(stitch_filepath), manifest_params, manifest_inputs)
 
                 # Update the progress bar
                 with self._downloadLogFileLock:
@@ -1969,6 +6303,90 @@ IWH,Map Image Width/Height,{16},{17}""".format(
             inQueue.task_done()
             exit(1)
 
+    # ----------------------------------------------------------------------
+    def _stitch_footprint(self, x_res, y_res):
+        """
+        Returns the estimated memory in bytes that one stitching worker needs for a x_res x y_res stitch.
+        The streaming engine and the memmap workers only hold one row of tiles in memory. The scaled
+        stitches also hold the 32 bit sums of their pixels.
+        """
+        if self.output_scale != 1:
+            pixels = x_res * y_res * 5
+        elif self.stitch_engine in ('streaming', 'memmap'):
+            pixels = x_res * self._tile_height
+        else:
+            pixels = x_res * y_res
+        # The montage command line utility holds both the montage and the cropped stitch.
+        if self.stitch_engine == 'montage':
+            pixels *= 2
+
+        return STITCH_BYTES_PER_PIXEL * pixels
+
+    # ----------------------------------------------------------------------
+    def _default_stitching_workers(self, dimensions, footprint=None, description='stitching'):
+        """
+        Returns the number of stitching workers to use when --stitching-threads is not given: the
+        physical cores of the machine, but not more workers than the available memory can hold
+        (the tile cache and the largest stitch per worker). If footprint is not None, it is the
+        memory that every worker needs instead of the largest stitch of the dimensions (e.g. for
+        the atlas sheets).
+        """
+        cores = get_physical_cores()
+        available_memory = get_available_memory()
+        if available_memory is None:
+            return cores
+
+        if footprint is None:
+            footprint = self._stitch_footprint(dimensions['horizontal_resolution_per_stitch'],
+                                               dimensions['vertical_resolution_per_stitch'])
+        # The tile cache is shared by the threads, or split between the worker processes.
+        available_memory -= self.tile_cache_mb * 1024 * 1024
+
+        workers = max(1, min(cores, available_memory // footprint))
+        LOG.info("Using {} {} workers ({} physical cores, {:.1f} GB of available memory, "
+                 "~{:.1f} GB per {} worker).".format(workers, description, cores, available_memory / 1073741824.0,
+                                                      footprint / 1073741824.0, description))
+        return workers
+
+    # ----------------------------------------------------------------------
+    def _worker_memory_limit(self, footprint, workers):
+        """
+        Returns the address space limit of a worker process of a pool with 'workers' processes (see
+        init_stitch_process()): its share of the available memory, but at least twice the expected footprint
+        of its task. Returns None if the available memory is not known.
+        """
+        available_memory = get_available_memory()
+        if available_memory is None:
+            return None
+
+        return max(2 * footprint, available_memory // workers) + PROCESS_BASE_ADDRESS_SPACE
+
+    # ----------------------------------------------------------------------
+    def _new_stitch_process_pool(self):
+        """
+        Returns a process pool with self._stitchingThreads stitching worker processes. The workers are
+        replaced after STITCH_TASKS_PER_CHILD stitches, and the address space of every worker is limited to
+        its share of the available memory (but at least twice the expected footprint of a stitch).
+        """
+        footprint = self._stitch_footprint(self._maxStitchDimensions[0], self._maxStitchDimensions[1])
+        memory_limit = self._worker_memory_limit(footprint, self._stitchingThreads)
+        if memory_limit is not None:
+            if self.stitch_engine == 'memmap':
+                # The memory mapped canvas is mapped in the address space of the workers as well.
+                memory_limit += self._maxStitchDimensions[0] * self._maxStitchDimensions[1] * 4
+
+        kwargs = {}
+        # Worker recycling needs python 3.11 or newer.
+        if sys.version_info >= (3, 11):
+            kwargs['max_tasks_per_child'] = STITCH_TASKS_PER_CHILD
+
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=self._stitchingThreads,
+            initializer=init_stitch_process,
+            initargs=(memory_limit, self.tile_cache_mb * 1024 * 1024 // self._stitchingThreads,
+                      LOG.getEffectiveLevel()),
+            **kwargs)
+
     # ----------------------------------------------------------------------
     def stitch_tiles(self, tile_west, tile_east, tile_north, tile_south):
         """
@@ -1980,12 +6398,34 @@ IWH,Map Image Width/Height,{16},{17}""".format(
         total_stitches = dimensions['vertical_divide_by'] * \
             dimensions['horizontal_divide_by']
 
-        # Create a thread pool with 'self.parallelStitchingThreads' number of threads for the stitching.
-        instantiate_threadpool('Stitching-Thread', self.parallelStitchingThreads,
+        self._stitchingThreads = self.parallelStitchingThreads or self._default_stitching_workers(dimensions)
+        # The cores that are not used by the stitching workers deflate the stitches in parallel.
+        self._encoderThreads = self.encoder_threads or max(1, get_physical_cores() // self._stitchingThreads)
+        self._maxStitchDimensions = (dimensions['horizontal_resolution_per_stitch'],
+                                     dimensions['vertical_resolution_per_stitch'])
+
+        # Create a thread pool with 'self._stitchingThreads' number of threads for the stitching.
+        # With the process executor, the in-process stitch engines are GIL bound, so the threads hand the
+        # stitches (or the rows of tiles of the memmap stitches) to a pool of worker processes. The montage
+        # engine runs the stitching in gm/imagemagick processes anyway, so it always uses the threads.
+        instantiate_threadpool('Stitching-Thread', self._stitchingThreads,
                                self._stitch_tile_worker, (self._inStitchingQueue, ))
+        use_processes = self.stitch_executor == 'process' and self.stitch_engine != 'montage'
+        if use_processes:
+            self._stitchProcessPool = self._new_stitch_process_pool()
+        elif self.tile_cache_mb > 0 and self.stitch_engine != 'montage':
+            self._tileCache = decoded_tile_cache(self.tile_cache_mb * 1024 * 1024)
+        if self.stitch_engine == 'memmap':
+            # The rows of tiles of the memory mapped stitches are assembled by a separate pool of threads (or the
+            # worker processes), so that all the workers can work on the same stitch.
+            if use_processes:
+                self._bandExecutor = self._stitchProcessPool
+            else:
+                self._bandExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=self._stitchingThreads,
+                                                                           thread_name_prefix='Band-Thread')
 
         stitches_path = os.path.join(
-            self.project_folder, "stitched_maps", str(zoom))
+            self.project_folder, "stitched_maps", str(self.zoom))
         thumbnails_path = os.path.join(stitches_path, "thumbs")
         if not os.path.isdir(stitches_path):
             os.makedirs(stitches_path)
@@ -1993,6 +6433,10 @@ IWH,Map Image Width/Height,{16},{17}""".format(
         if not os.path.isdir(thumbnails_path):
             os.makedirs(thumbnails_path)
 
+        # The inputs of the stitches, to rebuild only the stitches with changed tiles.
+        self._stitchManifest = stitch_manifest(os.path.join(stitches_path, '.stitch-manifest.sqlite'), self.hash_tiles)
+        self._uniformTiles = self._uniform_tile_index()
+
         counter = 1
 
         myProgressBarFd = sys.stderr
@@ -2026,15 +6470,25 @@ IWH,Map Image Width/Height,{16},{17}""".format(
         # In order to build each of the tiles, the graphicsmagick command
         # should be given the files in the above order, and is should be
         # asked to make 3x2 tiles for each stitch.
-        total_number_of_horizontal_tiles = (tile_east + 1) - tile_west
-        total_number_of_vertical_tiles = (tile_south + 1) - tile_north
-        horizontal_tiles_per_stitch = float(
-            total_number_of_horizontal_tiles) / dimensions['horizontal_divide_by']
-        vertical_tiles_per_stitch = float(
-            total_number_of_vertical_tiles) / dimensions['vertical_divide_by']
+        # The stitches may not have the same size (depending on the stitch layout), so each stitch
+        # starts at the sum of the widths/heights of the previous stitches.
+        horizontal_offsets = [sum(dimensions['horizontal_resolutions'][:x]) for x in range(dimensions['horizontal_divide_by'])]
+        vertical_offsets = [sum(dimensions['vertical_resolutions'][:y]) for y in range(dimensions['vertical_divide_by'])]
+        # If the stitches are scaled, the tiles are chosen by the source pixels of the stitches.
+        horizontal_source_offsets = [sum(dimensions['horizontal_source_resolutions'][:x])
+                                     for x in range(dimensions['horizontal_divide_by'])]
+        vertical_source_offsets = [sum(dimensions['vertical_source_resolutions'][:y])
+                                   for y in range(dimensions['vertical_divide_by'])]
 
         # This array stores all of the thumbnail filenames of the final stitches, in order to create a final index image in the end
         all_thumb_stitches = []
+        # The stitches that have to be built wait here until the tiles of the next PREFETCH_STITCHES_AHEAD stitches
+        # are being read ahead, before they are handed to the stitching workers.
+        prefetcher = tile_prefetcher(self.prefetch_depth) if self.prefetch_depth else None
+        self._tilePrefetcher = prefetcher
+        prefetched_stitches = deque()
+        # The stitches are queued in raster order (row by row), so that the tiles on the boundaries of a stitch
+        # are still in the decoded tile cache when the stitch on the right and the stitch below are built.
         for y in range(dimensions['vertical_divide_by']):
             for x in range(dimensions['horizontal_divide_by']):
                 # The stitch_key must contain the final image extension
@@ -2044,42 +6498,34 @@ IWH,Map Image Width/Height,{16},{17}""".format(
                 # The files_stitch array stores the filename path of all the original images to be stitched in the current stitch.
                 files_stitch = []
 
-                start_x_tile = int(
-                    tile_west + math.floor(x * horizontal_tiles_per_stitch))
-                start_y_tile = int(
-                    tile_north + math.floor(y * vertical_tiles_per_stitch))
-
-                # Crop the stitched tiles as needed so that we do not have overlaps and make sure that each tile fits the given dimensions.
-                crop_from_left = x * \
-                    dimensions['horizontal_resolution_per_stitch'] - \
-                    self._tile_width * (start_x_tile - tile_west)
-                crop_from_top = y * \
-                    dimensions['vertical_resolution_per_stitch'] - \
-                    self._tile_height * (start_y_tile - tile_north)
-
-                # The variables horizontal_tiles_per_stitch and vertical_tiles_per_stitch are float numbers, since the stitches
-                # may need to be composed out of e.g. 25 tiles + 64 pixels. This is 25.25 tiles if each tile is 256x256 pixels.
-                # In this case, we might come in a situation that we actually need to process 27 tiles in order to stitch the final
-                # tile. 25 whole tiles, and it might be that we have to get 32 pixels from a tile that was used in a previous stitch
-                # and another 32 pixels from a tile that it will be partly used for the next stitch. These 32 + 32 pixels make up
-                # for the additional 0.25 tiles (remember in this example we need 25.25 horizontal tiles per stitch) but this
-                # additional 0.25 tiles might be located either on a tile before the whole 25 tiles, after, or shared in one tile
-                # before and one after. If that's the case, the crop_from_left variable has the value 256 - 32 = 224, and since
-                # these 224 pixels will be cropped from the start tile, we need to add them in the horizontal_tiles_per_stitch
-                # with the 'float(crop_from_left) / self._tile_width'.
-                end_x_tile = int(start_x_tile + math.ceil(
-                    horizontal_tiles_per_stitch + float(crop_from_left) / self._tile_width))
-                end_y_tile = int(
-                    start_y_tile + math.ceil(vertical_tiles_per_stitch + float(crop_from_top) / self._tile_height))
+                x_res = dimensions['horizontal_resolutions'][x]
+                y_res = dimensions['vertical_resolutions'][y]
+                x_source_res = dimensions['horizontal_source_resolutions'][x]
+                y_source_res = dimensions['vertical_source_resolutions'][y]
+                scaling = None
+                if self.output_scale != 1:
+                    scaling = (self.output_scale, horizontal_offsets[x], vertical_offsets[y])
+
+                # The stitches may be composed out of e.g. 25 tiles + 64 pixels (25.25 tiles if each tile is 256x256 pixels),
+                # and the 64 pixels might be located either on a tile before the whole 25 tiles, after, or shared in one tile
+                # before and one after. In that case we actually need to process 27 tiles in order to stitch the final tile,
+                # and crop the pixels that belong to the previous stitch (crop_from_left) from the start tile.
+                start_x_tile, crop_from_left, x_tiles = stitch_tile_span(
+                    horizontal_source_offsets[x], x_source_res, self._tile_width)
+                start_y_tile, crop_from_top, y_tiles = stitch_tile_span(
+                    vertical_source_offsets[y], y_source_res, self._tile_height)
+                start_x_tile += tile_west
+                start_y_tile += tile_north
+                end_x_tile = start_x_tile + x_tiles
+                end_y_tile = start_y_tile + y_tiles
 
                 # The end tiles are excluded... So for the current stitch, we
                 # actually process from 'start_x_tile' until 'end_x_tile - 1'
                 for y_orig_tile in range(start_y_tile, end_y_tile):
                     for x_orig_tile in range(start_x_tile, end_x_tile):
-                        x_path = os.path.join(self.project_folder, str(
-                            self.zoom), str(x_orig_tile))
-                        y_path = '{}.{}'.format(os.path.join(
-                            x_path, str(y_orig_tile)), self.saved_tile_format)
+                        y_path = self._find_tile(x_orig_tile, y_orig_tile)
+                        if y_path is None:
+                            y_path = self._tile_path(x_orig_tile, y_orig_tile)
 
                         files_stitch.append(y_path)
 
@@ -2088,28 +6534,89 @@ IWH,Map Image Width/Height,{16},{17}""".format(
                 path_to_stitch = os.path.join(stitches_path, stitch_key)
                 path_to_thumb = os.path.join(thumbnails_path, stitch_key)
 
+                # Only the tiles that are already known to be uniform are looked up here. The candidates that have not
+                # been checked yet are checked by the stitching worker (see _stitch_checking_uniform_tiles()).
+                uniform_tiles, unchecked_tiles = self._uniformTiles.lookup(files_stitch)
+                if (self.skip_uniform_stitches and len(uniform_tiles) + len(unchecked_tiles) == len(set(files_stitch)) and
+                        len(set(uniform_tiles.values())) <= 1):
+                    # The stitch may consist of a single color: check its candidates now.
+                    entries = check_uniform_tiles(unchecked_tiles, self._tileCache)
+                    self._uniformTiles.record(entries)
+                    uniform_tiles.update(uniform_tile_colors(entries))
+                    unchecked_tiles = {}
+                if (self.skip_uniform_stitches and len(uniform_tiles) == len(set(files_stitch)) and
+                        len(set(uniform_tiles.values())) == 1):
+                    # All the tiles of the stitch have the same color. Only write a thumbnail for the index.
+                    LOG.debug("Stitch '{}' has a single color {}. Skipping it.".format(path_to_stitch,
+                                                                                       next(iter(uniform_tiles.values()))))
+                    if os.path.isfile(path_to_stitch):
+                        os.remove(path_to_stitch)
+                    if not os.path.isfile(path_to_thumb):
+                        thumb_width, thumb_height = thumbnail_size(x_res, y_res)
+                        pixels_to_image(np.full((thumb_height, thumb_width, 4), next(iter(uniform_tiles.values())),
+                                                dtype=np.uint8)).write(path_to_thumb)
+                    all_thumb_stitches.append(path_to_thumb)
+                    pbar.currval += 1
+                    pbar.update(pbar.currval)
+                    counter += 1
+                    continue
+
+                manifest_params = '{}x{}+{}+{} ({}x{} tiles)'.format(x_res, y_res, crop_from_left, crop_from_top,
+                                                                     x_tiles, y_tiles)
+                if scaling is not None:
+                    manifest_params += ' scaled by {}'.format(self.output_scale)
+                if self.quantize_colors and self.saved_stitched_tile_format == 'png':
+                    manifest_params += ' {} colors{} max error {}'.format(
+                        self.quantize_colors, ' dithered' if self.dither else '', self.quantize_max_error)
+                up_to_date, manifest_inputs = self._stitchManifest.check(stitch_key, manifest_params, files_stitch)
+
                 try:
-                    img = gmImage(path_to_stitch)
+                    if up_to_date is False:
+                        if os.path.isfile(path_to_stitch):
+                            LOG.info("The tiles of stitch '{}' have changed. Stitching it again.".format(path_to_stitch))
+                        raise RuntimeError
 
-                    if not (img.rows() == dimensions['vertical_resolution_per_stitch'] and
-                            img.columns() == dimensions['horizontal_resolution_per_stitch']):
+                    # Only read the dimensions of the existing stitch. Decoding a large stitch
+                    # needs as much memory as generating it.
+                    img = gmImage()
+                    img.ping(path_to_stitch)
+
+                    if not (img.rows() == y_res and img.columns() == x_res):
                         raise RuntimeError
+
+                    if up_to_date is None:
+                        # The stitch was generated before the stitch manifest existed. It is stale if any of its
+                        # tiles is newer than the stitch, otherwise its current inputs are recorded.
+                        stitch_mtime = os.stat(path_to_stitch).st_mtime_ns
+                        if any(entry[2] is not None and entry[2] > stitch_mtime for entry in manifest_inputs):
+                            LOG.info("Some tiles of stitch '{}' are newer than the stitch. Stitching it again.".format(
+                                path_to_stitch))
+                            raise RuntimeError
+                        self._stitchManifest.record(stitch_key, manifest_params, manifest_inputs)
+
+                    if not os.path.isfile(path_to_thumb):
+                        # Build the missing thumbnail from a lower zoom level of the project if possible,
+                        # or from the tiles of the stitch, but never decode the complete stitch.
+                        if not self._thumbnail_from_lower_zoom(tile_west * self._tile_width + horizontal_source_offsets[x],
+                                                               tile_north * self._tile_height + vertical_source_offsets[y],
+                                                               x_source_res, y_source_res, path_to_thumb):
+                            self._thumbnail_from_tiles(files_stitch, x_tiles, y_tiles, x_source_res, y_source_res,
+                                                       crop_from_left, crop_from_top, path_to_thumb, uniform_tiles)
+                    pbar.currval += 1
+                    pbar.update(pbar.currval)
+                except (RuntimeError, ValueError):
+                    args = (files_stitch, path_to_stitch, path_to_thumb, x_tiles, y_tiles, x_res, y_res,
+                            crop_from_left, crop_from_top, uniform_tiles, unchecked_tiles, scaling, manifest_params,
+                            manifest_inputs, pbar)
+                    if prefetcher is None:
+                        self._addToStitchingInputQueue(args + (None, ))
                     else:
-                        if not os.path.isfile(path_to_thumb):
-                            self._stitch_thumbnail(img, path_to_thumb)
-                        pbar.currval += 1
-                        pbar.update(pbar.currval)
-                except RuntimeError:
-                    self._addToStitchingInputQueue((files_stitch,
-                                                    path_to_stitch,
-                                                    path_to_thumb,
-                                                    end_x_tile - start_x_tile,
-                                                    end_y_tile - start_y_tile,
-                                                    dimensions['horizontal_resolution_per_stitch'],
-                                                    dimensions['vertical_resolution_per_stitch'],
-                                                    crop_from_left,
-                                                    crop_from_top,
-                                                    pbar))
+                        # The uniform tiles are never decoded, so they are not read either. The reads are
+                        # handed to the stitching worker, which checks them when it starts the stitch.
+                        prefetched_stitches.append(args + (prefetcher.prefetch(
+                            [f for f in files_stitch if f not in uniform_tiles]), ))
+                        if len(prefetched_stitches) > PREFETCH_STITCHES_AHEAD:
+                            self._addToStitchingInputQueue(prefetched_stitches.popleft())
 
                 # Add the thumb to the all_thumb_stitches array
                 all_thumb_stitches.append(path_to_thumb)
@@ -2125,44 +6632,55 @@ IWH,Map Image Width/Height,{16},{17}""".format(
 
                 counter += 1
 
+            # Record the tiles that were checked for a single color after every row of stitches.
+            self._uniformTiles.flush()
+
+        while prefetched_stitches:
+            self._addToStitchingInputQueue(prefetched_stitches.popleft())
+
         self._inStitchingQueue.join()
+        if prefetcher is not None:
+            prefetcher.close()
+            LOG.info("Tile prefetch: {}".format(prefetcher.summary()))
+            self._tilePrefetcher = None
+        if self._bandExecutor is not None:
+            if self._bandExecutor is not self._stitchProcessPool:
+                self._bandExecutor.shutdown()
+            self._bandExecutor = None
+        if self._stitchProcessPool is not None:
+            self._stitchProcessPool.shutdown()
+            self._stitchProcessPool = None
+        if self._tileCache is not None:
+            LOG.info("Decoded tile cache: {}".format(self._tileCache.summary()))
+            self._tileCache = None
+        if self._processTileCacheCounters is not None:
+            LOG.info("Decoded tile caches of the {} stitching processes: {}".format(
+                self._stitchingThreads, tile_cache_summary(*self._processTileCacheCounters)))
+            self._processTileCacheCounters = None
+        self._stitchManifest = None
+        self._uniformTiles.flush()
+        self._uniformTiles = None
 
         pbar.finish()
 
         LOG.info("Generating image index...")
-        # Make a "clean" index (no labels)
+        # Make a "clean" index (no labels) and one more index with labels. The index images are
+        # generated again if any of the thumbnails is newer (its stitch was generated again).
         index_file = '{}-index.png'.format(stitches_path)
-        montage = executeCommand()
-        if not os.path.isfile(index_file):
-            montage_cmd = ['gm', 'montage']
-            montage_cmd.extend(all_thumb_stitches)
-            montage_cmd.extend(['-tile', '{}x{}'.format(dimensions['horizontal_divide_by'],
-                                                        dimensions['vertical_divide_by']), '-background', 'white', '-geometry', '+1+1', index_file])
-            montage.execute(montage_cmd)
-
-        if montage.getReturnCode() != 0 and montage.getReturnCode() is not None:
-            LOG.error(
-                "ERROR: Could not generate image index '{}".format(index_file))
-        else:
-            LOG.info(
-                "Image index '{}' was generated successfully.".format(index_file))
-
-        # Make one more index with labels
-        index_file = '{}-index-labeled.png'.format(stitches_path)
-        if not os.path.isfile(index_file):
-            montage_cmd = ['gm', 'montage', '-draw',
-                           'gravity South fill red stroke red text 0,7 "%f"', '-pointsize', '16']
-            montage_cmd.extend(all_thumb_stitches)
-            montage_cmd.extend(['-tile', '{}x{}'.format(dimensions['horizontal_divide_by'],
-                                                        dimensions['vertical_divide_by']), '-background', 'white', '-geometry', '+1+1', index_file])
-            montage.execute(montage_cmd)
+        labeled_index_file = '{}-index-labeled.png'.format(stitches_path)
+        thumbs_mtime = max([os.path.getmtime(f) for f in all_thumb_stitches if os.path.isfile(f)], default=0)
+        stale_index_files = [f if not os.path.isfile(f) or os.path.getmtime(f) < thumbs_mtime else None
+                             for f in (index_file, labeled_index_file)]
+        if stale_index_files != [None, None]:
+            try:
+                render_index_images(all_thumb_stitches, dimensions['horizontal_divide_by'],
+                                    dimensions['vertical_divide_by'], *stale_index_files)
+            except (RuntimeError, ValueError) as e:
+                LOG.error("ERROR: Could not generate image index '{}': {}".format(index_file, e))
+                return
 
-        if montage.getReturnCode() != 0 and montage.getReturnCode() is not None:
-            LOG.error(
-                "ERROR: Could not generate image index '{}".format(index_file))
-        else:
-            LOG.info(
-                "Image index '{}' was generated successfully.".format(index_file))
+        LOG.info("Image index '{}' was generated successfully.".format(index_file))
+        LOG.info("Image index '{}' was generated successfully.".format(labeled_index_file))
 
     # ----------------------------------------------------------------------
     def calibrate_tiles(self, tile_west, tile_east, tile_north, tile_south):
@@ -2188,10 +6706,13 @@ IWH,Map Image Width/Height,{16},{17}""".format(
             widgets=widgets, maxval=total_stitches, fd=myProgressBarFd).start()
 
         stitches_path = os.path.join(
-            self.project_folder, "stitched_maps", str(zoom))
+            self.project_folder, "stitched_maps", str(self.zoom))
         if not os.path.isdir(stitches_path):
             os.makedirs(stitches_path)
 
+        # The corners of all the stitches, for the OziExplorer map files.
+        N, S, W, E = self.stitch_corners(tile_west, tile_north, dimensions)
+
         for y in range(dimensions['vertical_divide_by']):
             for x in range(dimensions['horizontal_divide_by']):
                 # The filename and extension is used in the ozi .map file, to find the matching image map
@@ -2200,28 +6721,7 @@ IWH,Map Image Width/Height,{16},{17}""".format(
 
                 map_file = os.path.join(
                     stitches_path, '{}.{}'.format(filename, 'map'))
-
-                # First find the corresponding pixels in the global map.
-                # Use +1 because if tile_west = 0, then this will return pixel number 0. while it should return pixel 1
-                # tile_west = 1 this will return 256+1 (the first pixel of the 1st tile) etc.
-                WesternMost_xpixel = tile_west * self._tile_width + 1
-                NorthernMost_ypixel = tile_north * self._tile_height + 1
-
-                W_xpixel = WesternMost_xpixel + x * \
-                    dimensions['horizontal_resolution_per_stitch']
-                E_xpixel = WesternMost_xpixel + \
-                    (x + 1) * \
-                    dimensions['horizontal_resolution_per_stitch'] - 1
-                N_ypixel = NorthernMost_ypixel + y * \
-                    dimensions['vertical_resolution_per_stitch']
-                S_ypixel = NorthernMost_ypixel + \
-                    (y + 1) * dimensions['vertical_resolution_per_stitch'] - 1
-
-                # Then use the pixel2deg function to get the longtitude and latitude of the stitched tile
-                N_deg, W_deg = self.pixel2deg(
-                    W_xpixel, N_ypixel, self._tile_width, self._tile_height)
-                S_deg, E_deg = self.pixel2deg(
-                    E_xpixel, S_ypixel, self._tile_width, self._tile_height)
+                N_deg, S_deg, W_deg, E_deg = float(N[y, x]), float(S[y, x]), float(W[y, x]), float(E[y, x])
 
                 pbar.currval += 1
                 pbar.update(pbar.currval)
@@ -2235,15 +6735,740 @@ IWH,Map Image Width/Height,{16},{17}""".format(
                         self.generate_OZI_map_file(
                             filename,
                             extension,
-                            dimensions['horizontal_resolution_per_stitch'],
-                            dimensions['vertical_resolution_per_stitch'],
+                            dimensions['horizontal_resolutions'][x],
+                            dimensions['vertical_resolutions'][y],
                             self.zoom,
-                            N_deg, S_deg, W_deg, E_deg
+                            N_deg, S_deg, W_deg, E_deg,
+                            self.output_scale
                         )
                     )
 
         pbar.finish()
 
+        self._write_georeferencing_sidecars(tile_west, tile_north, dimensions)
+
+    # ----------------------------------------------------------------------
+    def _write_georeferencing_sidecars(self, tile_west, tile_north, dimensions):
+        """
+        Write the georeferencing files of the stitches for GIS software, besides the OziExplorer map files:
+
+          'stitched_maps/ZOOM/Y_X.pgw' (or .jgw): The world file of every stitch, in web mercator (EPSG:3857) meters.
+          'stitched_maps/ZOOM.vrt': A GDAL virtual raster that mosaics all the stitches of the zoom level in EPSG:3857.
+          'stitched_maps/ZOOM.kml': A KML GroundOverlay for every stitch (e.g. for Google Earth).
+          'stitched_maps/ZOOM.geojson': The outlines of the stitches with their file names, rows and columns.
+
+        The edges of all the stitches are calculated in one batch from the pixels of the zoom level, and the existing
+        stitches are recorded in the stitch_index of the project ('stitched_maps/.stitch-index.sqlite').
+        The stitches that don't exist (e.g. the skipped single color stitches) are left out of the VRT, the KML and
+        the stitch index.
+        """
+        stitches_path = os.path.join(self.project_folder, "stitched_maps", str(self.zoom))
+        extension = self.saved_stitched_tile_format
+        widths = dimensions['horizontal_resolutions']
+        heights = dimensions['vertical_resolutions']
+        x_offsets = np.concatenate(([0], np.cumsum(widths)))
+        y_offsets = np.concatenate(([0], np.cumsum(heights)))
+
+        # The edges of the stitches in the pixels of the zoom level, in degrees and in meters.
+        scale = float(self.output_scale)
+        x_edges = tile_west * self._tile_width + x_offsets / scale
+        y_edges = tile_north * self._tile_height + y_offsets / scale
+        lat_edges, lon_edges = self.pixel2deg_batch(x_edges[np.newaxis, :], y_edges[:, np.newaxis],
+                                                    self._tile_width, self._tile_height)
+        lat_edges, lon_edges = lat_edges[:, 0], lon_edges[0, :]
+        x_meters, y_meters = self.pixel2meters_batch(x_edges[np.newaxis, :], y_edges[:, np.newaxis],
+                                                     self._tile_width, self._tile_height)
+        x_meters, y_meters = x_meters[0, :], y_meters[:, 0]
+        pixel_size = WEB_MERCATOR_EXTENT / (self._tile_width * 2 ** self.zoom) / scale
+
+        world_file_extension = '{}{}w'.format(extension[0], extension[-1])
+        indexed_stitches = []
+        vrt_sources = []
+        kml_overlays = []
+        features = []
+        for y in range(len(heights)):
+            for x in range(len(widths)):
+                filename = '{}_{}.{}'.format(y, x, extension)
+                stitch_path = os.path.join(stitches_path, filename)
+                relative_path = '{}/{}'.format(self.zoom, filename)
+
+                # The world file references the center of the upper left pixel.
+                with open(os.path.join(stitches_path, '{}_{}.{}'.format(y, x, world_file_extension)), 'w') as f:
+                    f.write('{!r}\n0.0\n0.0\n{!r}\n{!r}\n{!r}\n'.format(
+                        pixel_size, -pixel_size, float(x_meters[x]) + pixel_size / 2, float(y_meters[y]) - pixel_size / 2))
+
+                features.append(OrderedDict([
+                    ('type', 'Feature'),
+                    ('properties', OrderedDict([('stitch', relative_path), ('zoom', self.zoom), ('row', y), ('column', x),
+                                                ('width', widths[x]), ('height', heights[y]),
+                                                ('exists', os.path.isfile(stitch_path))])),
+                    ('geometry', OrderedDict([
+                        ('type', 'Polygon'),
+                        ('coordinates', [[[float(lon_edges[c]), float(lat_edges[r])]
+                                          for c, r in ((x, y + 1), (x + 1, y + 1), (x + 1, y), (x, y), (x, y + 1))]])]))]))
+
+                if not os.path.isfile(stitch_path):
+                    continue
+
+                indexed_stitches.append((y, x, os.path.join('stitched_maps', relative_path), widths[x], heights[y],
+                                         (float(lat_edges[y]), float(lat_edges[y + 1]), float(lon_edges[x]), float(lon_edges[x + 1])),
+                                         (float(x_meters[x]), float(y_meters[y]), float(x_meters[x + 1]), float(y_meters[y + 1]))))
+                vrt_sources.append((relative_path, stitch_bands(stitch_path), widths[x], heights[y],
+                                    int(x_offsets[x]), int(y_offsets[y])))
+                kml_overlays.append(
+                    '    <GroundOverlay>\n'
+                    '      <name>{}</name>\n'
+                    '      <Icon><href>{}</href></Icon>\n'
+                    '      <LatLonBox><north>{!r}</north><south>{!r}</south><east>{!r}</east><west>{!r}</west></LatLonBox>\n'
+                    '    </GroundOverlay>\n'.format(filename, relative_path, float(lat_edges[y]), float(lat_edges[y + 1]),
+                                                     float(lon_edges[x + 1]), float(lon_edges[x])))
+
+        bands = []
+        for band, color in enumerate(('Red', 'Green', 'Blue', 'Alpha') if extension == 'png' else ('Red', 'Green', 'Blue')):
+            sources = []
+            for relative_path, source_bands, width, height, x_offset, y_offset in vrt_sources:
+                source = source_bands[band]
+                rects = ('      <SrcRect xOff="0" yOff="0" xSize="{0}" ySize="{1}"/>\n'
+                         '      <DstRect xOff="{2}" yOff="{3}" xSize="{0}" ySize="{1}"/>\n'.format(
+                             width, height, x_offset, y_offset))
+                if source is None:
+                    # The stitch has no alpha channel: it is opaque.
+                    sources.append('    <ComplexSource>\n'
+                                   '      <SourceFilename relativeToVRT="1">{}</SourceFilename>\n'
+                                   '      <SourceBand>1</SourceBand>\n{}'
+                                   '      <ScaleOffset>255</ScaleOffset>\n'
+                                   '      <ScaleRatio>0</ScaleRatio>\n'
+                                   '    </ComplexSource>\n'.format(relative_path, rects))
+                elif source[1] is not None:
+                    # Indexed color stitch: expand the palette.
+                    sources.append('    <ComplexSource>\n'
+                                   '      <SourceFilename relativeToVRT="1">{}</SourceFilename>\n'
+                                   '      <SourceBand>{}</SourceBand>\n{}'
+                                   '      <ColorTableComponent>{}</ColorTableComponent>\n'
+                                   '    </ComplexSource>\n'.format(relative_path, source[0], rects, source[1]))
+                else:
+                    sources.append('    <SimpleSource>\n'
+                                   '      <SourceFilename relativeToVRT="1">{}</SourceFilename>\n'
+                                   '      <SourceBand>{}</SourceBand>\n{}'
+                                   '    </SimpleSource>\n'.format(relative_path, source[0], rects))
+            bands.append('  <VRTRasterBand dataType="Byte" band="{}">\n'
+                         '    <ColorInterp>{}</ColorInterp>\n{}'
+                         '  </VRTRasterBand>\n'.format(band + 1, color, ''.join(sources)))
+
+        with open('{}.vrt'.format(stitches_path), 'w') as f:
+            f.write('<VRTDataset rasterXSize="{}" rasterYSize="{}">\n'
+                    '  <SRS>EPSG:3857</SRS>\n'
+                    '  <GeoTransform>{!r}, {!r}, 0.0, {!r}, 0.0, {!r}</GeoTransform>\n'
+                    '{}'
+                    '</VRTDataset>\n'.format(int(x_offsets[-1]), int(y_offsets[-1]), float(x_meters[0]), pixel_size,
+                                              float(y_meters[0]), -pixel_size, ''.join(bands)))
+
+        with open('{}.kml'.format(stitches_path), 'w') as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                    '<kml xmlns="http://www.opengis.net/kml/2.2">\n'
+                    '  <Folder>\n'
+                    '    <name>Zoom {}</name>\n'
+                    '{}'
+                    '  </Folder>\n'
+                    '</kml>\n'.format(self.zoom, ''.join(kml_overlays)))
+
+        with open('{}.geojson'.format(stitches_path), 'w') as f:
+            json.dump(OrderedDict([('type', 'FeatureCollection'), ('features', features)]), f, indent=1)
+
+        stitch_index(os.path.join(self.project_folder, 'stitched_maps', '.stitch-index.sqlite')).replace_zoom(
+            self.zoom, indexed_stitches)
+
+    # ----------------------------------------------------------------------
+    def stitch_geotiff(self, tile_west, tile_east, tile_north, tile_south):
+        """
+        Stitch all the tiles of the zoom level in one tiled, compressed BigTIFF with internal
+        overviews (Cloud Optimized GeoTIFF layout), georeferenced in EPSG:3857 (web mercator).
+
+        The tiles are stitched one row of tiles at a time, and the blocks are compressed in
+        'self.parallelStitchingThreads' threads. The memory usage doesn't depend on the height of the
+        zoom level, but it grows with its width (see geotiff_writer.buffer_size()), so the GeoTIFF is
+        not generated if it would need more than the available memory.
+        GIS software can open the whole zoom level at once and read only the blocks that they need.
+        """
+        stitches_path = os.path.join(self.project_folder, "stitched_maps")
+        os.makedirs(stitches_path, exist_ok=True)
+
+        geotiff_path = os.path.join(stitches_path, '{}.tif'.format(self.zoom))
+        if os.path.isfile(geotiff_path):
+            LOG.info("GeoTIFF '{}' already exists. Skipping.".format(geotiff_path))
+            return
+
+        x_tiles = (tile_east + 1) - tile_west
+        y_tiles = (tile_south + 1) - tile_north
+        width = x_tiles * self._tile_width
+        height = y_tiles * self._tile_height
+
+        # The writer buffers and the row of tiles that is being written
+        footprint = geotiff_writer.buffer_size(width) + 4 * width * self._tile_height
+        available_memory = get_available_memory()
+        if available_memory is not None and footprint > available_memory:
+            LOG.error("ERROR: The GeoTIFF of zoom {} needs ~{:.1f} GB of memory, but only {:.1f} GB are available. "
+                      "Skipping.".format(self.zoom, footprint / 1073741824.0, available_memory / 1073741824.0))
+            return
+
+        # The corners of the stitched area, first in degrees and then in web mercator meters.
+        N_deg, W_deg = self.pixel2deg(tile_west * self._tile_width, tile_north * self._tile_height,
+                                      self._tile_width, self._tile_height)
+        S_deg, E_deg = self.pixel2deg((tile_east + 1) * self._tile_width, (tile_south + 1) * self._tile_height,
+                                      self._tile_width, self._tile_height)
+        left, top = mercantile.xy(W_deg, N_deg)
+        right, bottom = mercantile.xy(E_deg, S_deg)
+
+        myProgressBarFd = sys.stderr
+        # If log level is set to 1000 (logging is disabled), or DEBUG, then redirect
+        # the progress bar to /dev/null (use os.devnull to support windows as well)
+        if LOG.getEffectiveLevel() == 1000 or LOG.getEffectiveLevel() == logging.DEBUG:
+            myProgressBarFd = open(os.devnull, "w")
+
+        widgets = ['Writing GeoTIFF row ', progressbar.Counter(format='%{}d'.format(len(str(y_tiles)))), '/{}: '.format(y_tiles),
+                   progressbar.Percentage(), ' ', progressbar.Bar(marker='#'), ' ', progressbar.RotatingMarker(), ' ', progressbar.ETA()]
+
+        pbar = progressbar.ProgressBar(
+            widgets=widgets, maxval=y_tiles, fd=myProgressBarFd).start()
+
+        writer = geotiff_writer(geotiff_path, width, height, threads=self.parallelStitchingThreads or get_physical_cores(),
+                                geotransform=(left, top, (right - left) / width, (top - bottom) / height))
+        uniform_tiles = self._uniform_tile_index()
+        try:
+            for y in range(tile_north, tile_south + 1):
+                files = [self._find_tile(x, y) for x in range(tile_west, tile_east + 1)]
+                writer.write_rows(assemble_tiles(files, x_tiles, 1, self._tile_width, self._tile_height,
+                                                 width, self._tile_height, 0, 0,
+                                                 uniform_tiles=uniform_tiles.colors(files)))
+                pbar.currval += 1
+                pbar.update(pbar.currval)
+
+            uniform_tiles.flush()
+            writer.close()
+        except (RuntimeError, ValueError) as e:
+            writer.abort()
+            LOG.error("ERROR: Could not generate GeoTIFF '{}': {}".format(geotiff_path, e))
+            return
+
+        pbar.finish()
+        LOG.info("GeoTIFF '{}' was generated successfully.".format(geotiff_path))
+
+    # ----------------------------------------------------------------------
+    def _wait_for_tile_futures(self, pending, max_pending, pbar, description='pyramid tile', uniform_tiles=None,
+                               on_success=None):
+        """
+        Wait until at most max_pending tiles of the 'pending' set of futures are still being built.
+        The futures of run_checking_uniform_tiles() return the tiles that were checked for a single color,
+        which are recorded in the uniform_tile_index uniform_tiles. If on_success is not None, it is
+        called with every future that completed successfully.
+        """
+        while len(pending) > max_pending:
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                pending.remove(future)
+                try:
+                    result = future.result()
+                    if uniform_tiles is not None and result is not None:
+                        uniform_tiles.record(result[1])
+                    if on_success is not None:
+                        on_success(future)
+                except (RuntimeError, ValueError, MemoryError) as e:
+                    LOG.error("ERROR: Could not generate {}: {}".format(description, e))
+                pbar.currval += 1
+                pbar.update(pbar.currval)
+
+    # ----------------------------------------------------------------------
+    def export_pyramid(self, tile_west, tile_east, tile_north, tile_south, pyramid_format='dzi', tile_size=512):
+        """
+        Export the tiles of the zoom level as one image pyramid for web viewers, with tile_size x tile_size tiles in
+        the saved_stitched_tile_format:
+
+          'dzi': A Deep Zoom Image: 'pyramid/ZOOM.dzi' and the tiles in 'pyramid/ZOOM_files/LEVEL/COLUMN_ROW.EXT',
+                 from level 0 (1x1 pixel) to the full resolution level. The edge tiles are cropped to the image.
+          'xyz': 'pyramid/ZOOM/Z/X/Y.EXT' tiles, from Z = 0 (the whole image in one tile) to the full resolution level,
+                 for viewers with a simple (non geographic) coordinate system. The edge tiles are padded.
+
+        The full resolution level is assembled from the source tiles, and every other level by halving the resolution
+        of the next level (2x2 pixels are averaged). The tiles of every level are built in parallel in a pool of
+        worker processes. A pyramid tile is only built if it is missing or older than one of its source tiles (or
+        the tiles of the next level), so only the changed tiles are written again when the export is repeated.
+        The parameters of the pyramid (the tile size and the area) are recorded in 'pyramid/ZOOM-FORMAT.conf', and
+        if they change, the tiles of the previous pyramid are removed and the whole pyramid is built again.
+        """
+        width = (tile_east + 1 - tile_west) * self._tile_width
+        height = (tile_south + 1 - tile_north) * self._tile_height
+        extension = self.saved_stitched_tile_format
+        pyramid_path = os.path.join(self.project_folder, 'pyramid')
+
+        max_level = int(math.ceil(math.log(max(width, height), 2)))
+        min_level = 0
+        pad_to = None
+        if pyramid_format == 'xyz':
+            pad_to = tile_size
+            min_level = max_level
+            while -(-width >> (max_level - min_level)) > tile_size or -(-height >> (max_level - min_level)) > tile_size:
+                min_level -= 1
+
+        def level_size(level):
+            return -(-width >> (max_level - level)), -(-height >> (max_level - level))
+
+        def tile_path(level, column, row):
+            if pyramid_format == 'dzi':
+                return os.path.join(pyramid_path, '{}_files'.format(self.zoom), str(level),
+                                    '{}_{}.{}'.format(column, row, extension))
+            return os.path.join(pyramid_path, str(self.zoom), str(level - min_level), str(column),
+                                '{}.{}'.format(row, extension))
+
+        os.makedirs(pyramid_path, exist_ok=True)
+        tiles_path = os.path.join(pyramid_path, '{}_files'.format(self.zoom) if pyramid_format == 'dzi' else str(self.zoom))
+        if replace_export_parameters(os.path.join(pyramid_path, '{}-{}.conf'.format(self.zoom, pyramid_format)),
+                                     'Pyramid-{}-Settings'.format(self.zoom),
+                                     OrderedDict([('tile_size', tile_size), ('format', extension), ('width', width),
+                                                  ('height', height), ('tile_west', tile_west),
+                                                  ('tile_north', tile_north)])) and os.path.isdir(tiles_path):
+            LOG.info("The parameters of the pyramid of zoom {} have changed. Building it again.".format(self.zoom))
+            shutil.rmtree(tiles_path)
+
+        def is_up_to_date(path, inputs):
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                return False
+            return all(os.stat(f).st_mtime_ns <= mtime for f in inputs if f is not None and os.path.isfile(f))
+
+        total_tiles = 0
+        for level in range(min_level, max_level + 1):
+            level_width, level_height = level_size(level)
+            total_tiles += -(-level_width // tile_size) * -(-level_height // tile_size)
+
+        myProgressBarFd = sys.stderr
+        # If log level is set to 1000 (logging is disabled), or DEBUG, then redirect
+        # the progress bar to /dev/null (use os.devnull to support windows as well)
+        if LOG.getEffectiveLevel() == 1000 or LOG.getEffectiveLevel() == logging.DEBUG:
+            myProgressBarFd = open(os.devnull, "w")
+
+        widgets = ['Building pyramid tile ', progressbar.Counter(format='%{}d'.format(len(str(total_tiles)))), '/{}: '.format(total_tiles),
+                   progressbar.Percentage(), ' ', progressbar.Bar(marker='#'), ' ', progressbar.RotatingMarker(), ' ', progressbar.ETA()]
+
+        pbar = progressbar.ProgressBar(
+            widgets=widgets, maxval=total_tiles, fd=myProgressBarFd).start()
+
+        # A worker holds the 2x2 children of a parent tile (or the source tiles of a base tile).
+        footprint = STITCH_BYTES_PER_PIXEL * (2 * tile_size) ** 2
+        workers = self.parallelStitchingThreads or self._default_stitching_workers(None, footprint, 'pyramid')
+        pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, initializer=init_stitch_process,
+            initargs=(self._worker_memory_limit(footprint, workers), self.tile_cache_mb * 1024 * 1024 // workers,
+                      LOG.getEffectiveLevel()))
+        uniform_tiles = self._uniform_tile_index()
+        pending = set()
+        built = 0
+        try:
+            for level in range(max_level, min_level - 1, -1):
+                level_width, level_height = level_size(level)
+                columns, rows = -(-level_width // tile_size), -(-level_height // tile_size)
+                child_width, child_height = level_size(level + 1) if level < max_level else (None, None)
+                child_columns = -(-child_width // tile_size) if child_width else 0
+                child_rows = -(-child_height // tile_size) if child_height else 0
+
+                for column in range(columns):
+                    column_path = os.path.dirname(tile_path(level, column, 0))
+                    os.makedirs(column_path, exist_ok=True)
+
+                    for row in range(rows):
+                        path = tile_path(level, column, row)
+                        if level == max_level:
+                            w = min(tile_size, level_width - column * tile_size)
+                            h = min(tile_size, level_height - row * tile_size)
+                            first_x, crop_left, x_tiles = stitch_tile_span(column * tile_size, w, self._tile_width)
+                            first_y, crop_top, y_tiles = stitch_tile_span(row * tile_size, h, self._tile_height)
+                            files = []
+                            for y in range(tile_north + first_y, tile_north + first_y + y_tiles):
+                                for x in range(tile_west + first_x, tile_west + first_x + x_tiles):
+                                    files.append(self._find_tile(x, y) or self._tile_path(x, y))
+                            if is_up_to_date(path, files):
+                                pbar.currval += 1
+                                pbar.update(pbar.currval)
+                                continue
+                            known_tiles, unchecked_tiles = uniform_tiles.lookup(files)
+                            future = pool.submit(run_checking_uniform_tiles, pyramid_base_tile, known_tiles,
+                                                 unchecked_tiles, path, files, x_tiles, y_tiles, self._tile_width,
+                                                 self._tile_height, w, h, crop_left, crop_top, pad_to)
+                        else:
+                            children = [tile_path(level + 1, 2 * column + i % 2, 2 * row + i // 2)
+                                        if 2 * column + i % 2 < child_columns and 2 * row + i // 2 < child_rows else None
+                                        for i in range(4)]
+                            if is_up_to_date(path, children):
+                                pbar.currval += 1
+                                pbar.update(pbar.currval)
+                                continue
+                            future = pool.submit(pyramid_parent_tile, path, children,
+                                                 min(2 * tile_size, child_width - 2 * column * tile_size),
+                                                 min(2 * tile_size, child_height - 2 * row * tile_size),
+                                                 tile_size, pad_to)
+                        pending.add(future)
+                        built += 1
+                        self._wait_for_tile_futures(pending, 4 * workers, pbar, uniform_tiles=uniform_tiles)
+
+                # The next level is built from the tiles of this level.
+                self._wait_for_tile_futures(pending, 0, pbar, uniform_tiles=uniform_tiles)
+                uniform_tiles.flush()
+        finally:
+            pool.shutdown()
+
+        pbar.finish()
+
+        if pyramid_format == 'dzi':
+            with open(os.path.join(pyramid_path, '{}.dzi'.format(self.zoom)), 'w') as f:
+                f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                        '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" TileSize="{}" Overlap="0" Format="{}">\n'
+                        '  <Size Width="{}" Height="{}"/>\n'
+                        '</Image>\n'.format(tile_size, extension, width, height))
+
+        LOG.info("Pyramid of zoom {} was exported in '{}' ({} out of {} tiles were built).".format(
+            self.zoom, pyramid_path, built, total_tiles))
+
+    # ----------------------------------------------------------------------
+    def migrate_tile_layout(self, new_layout):
+        """
+        Move the downloaded tiles of the zoom level from the current tile_layout to new_layout (see
+        tile_relative_path()), and record the new layout in the zoom configuration file.
+
+        All the tile files are collected before any of them is moved, the tiles are renamed in place (no data
+        is copied), and the folders that are left empty are removed. The paths of the tiles in the uniform tile
+        index and in the stitch manifest are updated as well, so neither the tiles nor the stitches are decoded
+        or rebuilt again because of the migration. Files that are not tiles of the current layout are left alone.
+        An interrupted migration can be repeated: the tiles that were already moved are found in their new place.
+        """
+        zoom_path = os.path.join(self.project_folder, str(self.zoom))
+        if new_layout == self.tile_layout:
+            LOG.info("The tiles of zoom {} already have the '{}' layout.".format(self.zoom, new_layout))
+            return
+
+        # Only the tiles of the current layout are moved; the tiles of the new layout (from an interrupted
+        # migration) are already in place.
+        renamed = {}
+        for dirpath, dirnames, filenames in os.walk(zoom_path):
+            for filename in filenames:
+                if filename.startswith('.'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                parsed = parse_tile_relative_path(os.path.relpath(path, zoom_path), self.tile_layout)
+                if parsed is None:
+                    continue
+                x, y, extension = parsed
+                renamed[path] = '{}.{}'.format(os.path.join(zoom_path, tile_relative_path(x, y, new_layout)), extension)
+
+        myProgressBarFd = sys.stderr
+        # If log level is set to 1000 (logging is disabled), or DEBUG, then redirect
+        # the progress bar to /dev/null (use os.devnull to support windows as well)
+        if LOG.getEffectiveLevel() == 1000 or LOG.getEffectiveLevel() == logging.DEBUG:
+            myProgressBarFd = open(os.devnull, "w")
+
+        total_tiles = max(len(renamed), 1)
+        widgets = ['Moving tile ', progressbar.Counter(format='%{}d'.format(len(str(total_tiles)))), '/{}: '.format(total_tiles),
+                   progressbar.Percentage(), ' ', progressbar.Bar(marker='#'), ' ', progressbar.RotatingMarker(), ' ', progressbar.ETA()]
+
+        pbar = progressbar.ProgressBar(
+            widgets=widgets, maxval=total_tiles, fd=myProgressBarFd).start()
+
+        old_folders = set()
+        for old_path, new_path in sorted(renamed.items()):
+            new_folder = os.path.dirname(new_path)
+            os.makedirs(new_folder, exist_ok=True)
+            os.replace(old_path, new_path)
+            old_folders.add(os.path.dirname(old_path))
+            pbar.currval += 1
+            pbar.update(pbar.currval)
+
+        # Remove the folders of the old layout that are now empty (deepest first).
+        for folder in sorted(old_folders, key=lambda f: f.count(os.sep), reverse=True):
+            while folder != zoom_path and os.path.isdir(folder) and not os.listdir(folder):
+                os.rmdir(folder)
+                folder = os.path.dirname(folder)
+
+        pbar.finish()
+
+        if os.path.isfile(os.path.join(zoom_path, '.uniform-tiles.sqlite')):
+            self._uniform_tile_index().rename(renamed)
+        manifest_path = os.path.join(self.project_folder, 'stitched_maps', str(self.zoom), '.stitch-manifest.sqlite')
+        if os.path.isfile(manifest_path):
+            stitch_manifest(manifest_path, self.hash_tiles).rename_inputs(renamed)
+
+        write_tile_layout(self.project_folder, self.zoom, new_layout)
+        self.tile_layout = new_layout
+        self._tileLayouts[self.zoom] = new_layout
+        LOG.info("{} tiles of zoom {} were moved to the '{}' layout.".format(len(renamed), self.zoom, new_layout))
+
+    # ----------------------------------------------------------------------
+    def overlay_tiles(self, tile_west, tile_east, tile_north, tile_south, overlay_project, destination_project,
+                      opacity=1.0):
+        """
+        Compose the downloaded tiles of the zoom level (the base layer) with the tiles of the same zoom level of
+        the overlay_project (e.g. hiking paths), and save the composed tiles in the destination_project, which can
+        then be stitched, or exported to Maverick/OsmAnd like any other project. The alpha of the overlay is
+        multiplied by opacity. This supersedes the overlay-tiles.sh script.
+
+        Each project may use a different tile layout (as it is recorded in its zoom configuration file); the
+        destination project gets the layout and the zoom configuration file of the base project. A tile that is
+        missing from the overlay project is copied unchanged, and the tiles that are already in the destination
+        project are not composed again. The tiles are composed in parallel in a pool of worker processes.
+        """
+        destination_conf = os.path.join(destination_project, 'zoom-{}.conf'.format(self.zoom))
+        os.makedirs(destination_project, exist_ok=True)
+        if not os.path.isfile(destination_conf):
+            base_conf = os.path.join(self.project_folder, 'zoom-{}.conf'.format(self.zoom))
+            if os.path.isfile(base_conf):
+                shutil.copy2(base_conf, destination_conf)
+            write_tile_layout(destination_project, self.zoom, self.tile_layout)
+        destination_layout = read_tile_layout(destination_project, self.zoom)
+        overlay_layout = read_tile_layout(overlay_project, self.zoom) or 'flat'
+
+        def find_overlay_tile(x, y):
+            path = os.path.join(overlay_project, str(self.zoom), tile_relative_path(x, y, overlay_layout))
+            for extension in (self.saved_tile_format, 'webp'):
+                if os.path.isfile('{}.{}'.format(path, extension)):
+                    return '{}.{}'.format(path, extension)
+            return None
+
+        total_tiles = (tile_east + 1 - tile_west) * (tile_south + 1 - tile_north)
+
+        myProgressBarFd = sys.stderr
+        # If log level is set to 1000 (logging is disabled), or DEBUG, then redirect
+        # the progress bar to /dev/null (use os.devnull to support windows as well)
+        if LOG.getEffectiveLevel() == 1000 or LOG.getEffectiveLevel() == logging.DEBUG:
+            myProgressBarFd = open(os.devnull, "w")
+
+        widgets = ['Overlaying tile ', progressbar.Counter(format='%{}d'.format(len(str(total_tiles)))), '/{}: '.format(total_tiles),
+                   progressbar.Percentage(), ' ', progressbar.Bar(marker='#'), ' ', progressbar.RotatingMarker(), ' ', progressbar.ETA()]
+
+        pbar = progressbar.ProgressBar(
+            widgets=widgets, maxval=total_tiles, fd=myProgressBarFd).start()
+
+        # A worker holds the base and the overlay tile as floats (the tiles are at most 512x512 pixels).
+        footprint = STITCH_BYTES_PER_PIXEL * 2 * 512 * 512
+        workers = self.parallelStitchingThreads or self._default_stitching_workers(None, footprint, 'overlay')
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        pending = set()
+        composed = copied = missing = 0
+        try:
+            for x in range(tile_west, tile_east + 1):
+                for y in range(tile_north, tile_south + 1):
+                    base_path = self._find_tile(x, y)
+                    if base_path is None:
+                        missing += 1
+                        pbar.currval += 1
+                        continue
+                    destination_path = '{}{}'.format(
+                        os.path.join(destination_project, str(self.zoom), tile_relative_path(x, y, destination_layout)),
+                        os.path.splitext(base_path)[1])
+                    if os.path.isfile(destination_path) and os.path.getsize(destination_path) > 0:
+                        pbar.currval += 1
+                        continue
+                    os.makedirs(os.path.dirname(destination_path), exist_ok=True)
+
+                    overlay_path = find_overlay_tile(x, y)
+                    if overlay_path is None:
+                        shutil.copy2(base_path, destination_path)
+                        copied += 1
+                        pbar.currval += 1
+                        continue
+
+                    pending.add(pool.submit(overlay_tile, base_path, overlay_path, destination_path, opacity))
+                    composed += 1
+                    self._wait_for_tile_futures(pending, 4 * workers, pbar, 'overlayed tile')
+                pbar.update(pbar.currval)
+
+            self._wait_for_tile_futures(pending, 0, pbar, 'overlayed tile')
+        finally:
+            pool.shutdown()
+
+        pbar.finish()
+        LOG.info("Zoom {}: {} tiles were overlayed and {} tiles without an overlay were copied to '{}' "
+                 "({} tiles are missing from the base project).".format(
+                     self.zoom, composed, copied, destination_project, missing))
+
+    # ----------------------------------------------------------------------
+    def render_atlas(self, tile_west, tile_east, tile_north, tile_south, paper='A4', orientation='auto', dpi=300,
+                     overlap_mm=10):
+        """
+        Cut the map of the zoom level in sheets of a paper size (one of PAPER_SIZES) for print at 'dpi' dots per
+        inch, without shrinking it: the map is printed at the resolution of the zoom level (scaled by the
+        output_scale). Every sheet has a margin of ATLAS_MARGIN_MM with the grid labels, a compass and a scale
+        ruler (see decorate_map_for_print()), and the maps of neighbouring sheets overlap by overlap_mm.
+        The orientation of the paper is 'portrait', 'landscape' or 'auto' (the one with the fewest sheets).
+
+        The sheets are assembled directly from the source tiles (the stitches are not needed) and rendered in
+        parallel in a pool of worker processes. They are saved in 'atlas/ZOOM-PAPER-ORIENTATION-DPIdpi/ROW_COLUMN.EXT'
+        in the saved_stitched_tile_format, every sheet with its OziExplorer calibration file (for the whole sheet,
+        margins included). The parameters and the tiles of every sheet are recorded in a stitch_manifest, and a
+        sheet (and its calibration file) is only rendered again if it is missing or if its parameters (e.g. the
+        overlap, the scale or the area) or its tiles have changed. The sheets of a previous atlas that are not
+        part of the current atlas are removed.
+        """
+        scale = self.output_scale
+        source_width = (tile_east + 1 - tile_west) * self._tile_width
+        source_height = (tile_south + 1 - tile_north) * self._tile_height
+        total_width = scaled_pixel(source_width - 1, scale) + 1
+        total_height = scaled_pixel(source_height - 1, scale) + 1
+        margin_px = int(round(ATLAS_MARGIN_MM / 25.4 * dpi))
+        overlap_px = int(round(overlap_mm / 25.4 * dpi))
+
+        def sheets(paper_width_mm, paper_height_mm):
+            map_width = int(paper_width_mm / 25.4 * dpi) - 2 * margin_px
+            map_height = int(paper_height_mm / 25.4 * dpi) - 2 * margin_px
+            if 2 * overlap_px >= min(map_width, map_height):
+                error_and_exit("The overlap of the atlas sheets ({} mm) should be less than half of the map on a {} sheet.".format(
+                    overlap_mm, paper))
+            return atlas_sheet_offsets(total_width, map_width, overlap_px), atlas_sheet_offsets(total_height, map_height, overlap_px)
+
+        portrait = sheets(*PAPER_SIZES[paper])
+        landscape = sheets(*reversed(PAPER_SIZES[paper]))
+        if orientation == 'auto':
+            orientation = 'portrait' if len(portrait[0][0]) * len(portrait[1][0]) <= \
+                len(landscape[0][0]) * len(landscape[1][0]) else 'landscape'
+        (x_offsets, sheet_width), (y_offsets, sheet_height) = portrait if orientation == 'portrait' else landscape
+
+        extension = self.saved_stitched_tile_format
+        atlas_path = os.path.join(self.project_folder, 'atlas', '{}-{}-{}-{}dpi'.format(self.zoom, paper, orientation, dpi))
+        os.makedirs(atlas_path, exist_ok=True)
+
+        # Remove the sheets of a previous atlas with more rows or columns of sheets.
+        sheet_names = set('{}_{}'.format(row, column) for row in range(len(y_offsets)) for column in range(len(x_offsets)))
+        for name in os.listdir(atlas_path):
+            match = re.match(r'^(\d+_\d+)\.(?:png|jpg|map)$', name)
+            if match and match.group(1) not in sheet_names:
+                LOG.debug("Removing the sheet '{}' of a previous atlas.".format(name))
+                os.remove(os.path.join(atlas_path, name))
+        manifest = stitch_manifest(os.path.join(atlas_path, '.atlas-manifest.sqlite'), self.hash_tiles)
+
+        total_sheets = len(x_offsets) * len(y_offsets)
+        LOG.info("Zoom {}: {} {} {} sheets ({}x{}) at {} DPI.".format(self.zoom, total_sheets, paper, orientation,
+                                                                     len(x_offsets), len(y_offsets), dpi))
+
+        # The corners of the maps and of the whole sheets, for the scale rulers and the calibration files (with the
+        # same pixel convention as calibrate_tiles()).
+        origin_x = tile_west * self._tile_width + 1
+        origin_y = tile_north * self._tile_height + 1
+        x_starts = np.array(x_offsets, dtype=np.float64)
+        y_starts = np.array(y_offsets, dtype=np.float64)
+        map_N, map_W = self.pixel2deg_batch(origin_x + x_starts[np.newaxis, :] / float(scale),
+                                            origin_y + y_starts[:, np.newaxis] / float(scale),
+                                            self._tile_width, self._tile_height)
+        map_S, map_E = self.pixel2deg_batch(origin_x + (x_starts[np.newaxis, :] + sheet_width - 1) / float(scale),
+                                            origin_y + (y_starts[:, np.newaxis] + sheet_height - 1) / float(scale),
+                                            self._tile_width, self._tile_height)
+        sheet_N, sheet_W = self.pixel2deg_batch(origin_x + (x_starts[np.newaxis, :] - margin_px) / float(scale),
+                                                origin_y + (y_starts[:, np.newaxis] - margin_px) / float(scale),
+                                                self._tile_width, self._tile_height)
+        sheet_S, sheet_E = self.pixel2deg_batch(
+            origin_x + (x_starts[np.newaxis, :] + sheet_width + margin_px - 1) / float(scale),
+            origin_y + (y_starts[:, np.newaxis] + sheet_height + margin_px - 1) / float(scale),
+            self._tile_width, self._tile_height)
+
+        myProgressBarFd = sys.stderr
+        # If log level is set to 1000 (logging is disabled), or DEBUG, then redirect
+        # the progress bar to /dev/null (use os.devnull to support windows as well)
+        if LOG.getEffectiveLevel() == 1000 or LOG.getEffectiveLevel() == logging.DEBUG:
+            myProgressBarFd = open(os.devnull, "w")
+
+        widgets = ['Rendering atlas sheet ', progressbar.Counter(format='%{}d'.format(len(str(total_sheets)))), '/{}: '.format(total_sheets),
+                   progressbar.Percentage(), ' ', progressbar.Bar(marker='#'), ' ', progressbar.RotatingMarker(), ' ', progressbar.ETA()]
+
+        pbar = progressbar.ProgressBar(
+            widgets=widgets, maxval=total_sheets, fd=myProgressBarFd).start()
+
+        # A worker holds a whole sheet: the assembled map (and the sums of its pixels, if it is scaled, see
+        # _stitch_footprint()) and the decorated canvas with the margins.
+        map_pixels = sheet_width * sheet_height
+        footprint = STITCH_BYTES_PER_PIXEL * (map_pixels * (5 if scale != 1 else 1) +
+                                              (sheet_width + 2 * margin_px) * (sheet_height + 2 * margin_px))
+        workers = self.parallelStitchingThreads or self._default_stitching_workers(None, footprint, 'atlas')
+        pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, initializer=init_stitch_process,
+            initargs=(self._worker_memory_limit(footprint, workers), self.tile_cache_mb * 1024 * 1024 // workers,
+                      LOG.getEffectiveLevel()))
+        uniform_tiles = self._uniform_tile_index()
+        pending = set()
+        rendering = {}
+        rendered = 0
+
+        def sheet_rendered(future):
+            # The calibration file is only written together with its sheet.
+            map_path, map_file, filename, params, inputs = rendering.pop(future)
+            with open(map_path, 'w') as f:
+                f.write(map_file)
+            manifest.record(filename, params, inputs)
+
+        try:
+            for row, y_offset in enumerate(y_offsets):
+                for column, x_offset in enumerate(x_offsets):
+                    filename = '{}_{}'.format(row, column)
+                    sheet_path = os.path.join(atlas_path, '{}.{}'.format(filename, extension))
+
+                    # The source pixels of the map of the sheet.
+                    source_x = first_source_pixel(x_offset, scale)
+                    source_y = first_source_pixel(y_offset, scale)
+                    first_x, crop_left, x_tiles = stitch_tile_span(
+                        source_x, min(first_source_pixel(x_offset + sheet_width, scale), source_width) - source_x,
+                        self._tile_width)
+                    first_y, crop_top, y_tiles = stitch_tile_span(
+                        source_y, min(first_source_pixel(y_offset + sheet_height, scale), source_height) - source_y,
+                        self._tile_height)
+                    files = []
+                    for y in range(tile_north + first_y, tile_north + first_y + y_tiles):
+                        for x in range(tile_west + first_x, tile_west + first_x + x_tiles):
+                            files.append(self._find_tile(x, y) or self._tile_path(x, y))
+
+                    map_path = os.path.join(atlas_path, '{}.map'.format(filename))
+                    # Everything that the pixels and the calibration of the sheet depend on, besides its tiles.
+                    params = '{}x{}+{}+{} margin {} scaled by {} at {} DPI, tiles {}x{} from {}/{}'.format(
+                        sheet_width, sheet_height, x_offset, y_offset, margin_px, scale, dpi, self._tile_width,
+                        self._tile_height, tile_west, tile_north)
+                    up_to_date, inputs = manifest.check(filename, params, files)
+                    if up_to_date and os.path.isfile(sheet_path) and os.path.isfile(map_path):
+                        pbar.currval += 1
+                        pbar.update(pbar.currval)
+                        continue
+
+                    future = pool.submit(
+                        run_checking_uniform_tiles, render_atlas_sheet, *uniform_tiles.lookup(files),
+                        sheet_path, files, x_tiles, y_tiles, self._tile_width, self._tile_height,
+                        sheet_width, sheet_height, crop_left, crop_top,
+                        (scale, x_offset, y_offset) if scale != 1 else None, self.zoom,
+                        (float(map_N[row, column]), float(map_S[row, column]), float(map_W[row, column]),
+                         float(map_E[row, column])), margin_px, dpi)
+                    rendering[future] = (map_path, self.generate_OZI_map_file(
+                        filename, extension, sheet_width + 2 * margin_px, sheet_height + 2 * margin_px, self.zoom,
+                        float(sheet_N[row, column]), float(sheet_S[row, column]),
+                        float(sheet_W[row, column]), float(sheet_E[row, column]), scale), filename, params, inputs)
+                    pending.add(future)
+                    rendered += 1
+                    self._wait_for_tile_futures(pending, 2 * workers, pbar, 'atlas sheet', uniform_tiles, sheet_rendered)
+
+                uniform_tiles.flush()
+            self._wait_for_tile_futures(pending, 0, pbar, 'atlas sheet', uniform_tiles, sheet_rendered)
+            uniform_tiles.flush()
+        finally:
+            pool.shutdown()
+
+        pbar.finish()
+        LOG.info("Atlas of zoom {} was rendered in '{}' ({} out of {} sheets were rendered).".format(
+            self.zoom, atlas_path, rendered, total_sheets))
+
+    # ----------------------------------------------------------------------
+    def _export_tile(self, tile_path, export_path, export_format):
+        """
+        Copy a downloaded tile to the export_path of an external software.
+        If the tile has been re-encoded by the tile optimizer to a format that is not
+        the saved_tile_format (e.g. webp), it is converted back to export_format.
+        """
+        if os.path.splitext(tile_path)[1] == '.{}'.format(self.saved_tile_format):
+            shutil.copy2(tile_path, export_path)
+        else:
+            img = gmImage(tile_path)
+            img.write('{}:{}'.format(export_format, export_path))
+
     # ----------------------------------------------------------------------
     def prepareMaverickTiles(self, tile_west, tile_east, tile_north, tile_south):
         """
@@ -2301,29 +7526,25 @@ IWH,Map Image Width/Height,{16},{17}""".format(
                     mapserverFile.write("{}|{}|18|1\n".format(
                         self.tile_servers[0], self.saved_tile_format))
 
+        # Maverick expects the flat ZOOM/X/Y layout, whatever the layout of the downloaded tiles is.
         for x in range(tile_west, tile_east + 1):
-            x_path = os.path.join(self.project_folder, str(self.zoom), str(x))
-            if not os.path.isdir(x_path):
-                os.mkdir(x_path)
-
             x_path_maverick = os.path.join(
                 maverick_folder, str(self.zoom), str(x))
             if not os.path.isdir(x_path_maverick):
                 os.makedirs(x_path_maverick)
 
             for y in range(tile_north, tile_south + 1):
-                y_path = '{}.{}'.format(os.path.join(
-                    x_path, str(y)), self.saved_tile_format)
+                y_path = self._find_tile(x, y)
                 y_path_maverick = '{}.{}.tile'.format(os.path.join(
                     x_path_maverick, str(y)), self.saved_tile_format)
 
-                if not os.path.isfile(y_path):
+                if y_path is None:
                     LOG.warning(
-                        "File {} is missing. Maverick tile for this file will not be generated.".format(y_path))
+                        "File {} is missing. Maverick tile for this file will not be generated.".format(self._tile_path(x, y)))
                 else:
                     # Only copy the file if it doesn't exist already.
                     if not os.path.isfile(y_path_maverick):
-                        shutil.copy2(y_path, y_path_maverick)
+                        self._export_tile(y_path, y_path_maverick, self.saved_tile_format)
 
     # ----------------------------------------------------------------------
 
@@ -2337,28 +7558,24 @@ IWH,Map Image Width/Height,{16},{17}""".format(
         """
         osmand_folder = os.path.join(self.project_folder, 'osmand')
 
+        # OsmAnd expects the flat ZOOM/X/Y layout, whatever the layout of the downloaded tiles is.
         for x in range(tile_west, tile_east + 1):
-            x_path = os.path.join(self.project_folder, str(self.zoom), str(x))
-            if not os.path.isdir(x_path):
-                os.mkdir(x_path)
-
             x_path_osmand = os.path.join(osmand_folder, str(self.zoom), str(x))
             if not os.path.isdir(x_path_osmand):
                 os.makedirs(x_path_osmand)
 
             for y in range(tile_north, tile_south + 1):
-                y_path = '{}.{}'.format(os.path.join(
-                    x_path, str(y)), self.saved_tile_format)
+                y_path = self._find_tile(x, y)
                 y_path_osmand = '{}png.tile'.format(os.path.join(
                     x_path_osmand, str(y)), self.saved_tile_format)
 
-                if not os.path.isfile(y_path):
+                if y_path is None:
                     LOG.warning(
-                        "File {} is missing. OsmAnd tile for this file will not be generated.".format(y_path))
+                        "File {} is missing. OsmAnd tile for this file will not be generated.".format(self._tile_path(x, y)))
                 else:
                     # Only copy the file if it doesn't exist already.
                     if not os.path.isfile(y_path_osmand):
-                        shutil.copy2(y_path, y_path_osmand)
+                        self._export_tile(y_path, y_path_osmand, self.saved_tile_format)
 
 # ----------------------------------------------------------------------
 
@@ -2739,7 +7956,7 @@ def DrawableMapLabels(map_width, map_height, canvas_margin, fontsize=80, x_grid_
 # ----------------------------------------------------------------------
 
 
-def DrawableScaleRuler(x, y, latitude_mid_of_tile, zoom, rulersize=16, anchor='lowerleft'):
+def DrawableScaleRuler(x, y, latitude_mid_of_tile, zoom, rulersize=16, anchor='lowerleft', scale=1):
     """
     The ruler size defines the thickness of the ruler.
 
@@ -2747,6 +7964,8 @@ def DrawableScaleRuler(x, y, latitude_mid_of_tile, zoom, rulersize=16, anchor='l
 
     The zoom level the openstreetmap zoom level for the specified stitched image.
 
+    The scale is the scale factor of the stitched image, if it has been scaled from the resolution of the zoom level.
+
     The formula to calculate the horizontalMetersPerPixel is the same with the formula used for MMB1
     calculation when calibrating OziExplorer files. Look at the function generate_OZI_map_file() for
     more details
@@ -2762,7 +7981,7 @@ def DrawableScaleRuler(x, y, latitude_mid_of_tile, zoom, rulersize=16, anchor='l
         raise KeyError
 
     horizontalMetersPerPixel = 40075017 * \
-        math.cos(latitude_mid_of_tile / 180.0 * math.pi) / 2**(zoom + 8)
+        math.cos(latitude_mid_of_tile / 180.0 * math.pi) / 2**(zoom + 8) / float(scale)
 
     ruler = pgmagick.DrawableList()
     black = pgmagick.Color('black')
@@ -2916,24 +8135,35 @@ def DrawableScaleRuler(x, y, latitude_mid_of_tile, zoom, rulersize=16, anchor='l
 # ----------------------------------------------------------------------
 
 
-def prepareStitchForPrint(mapInputFile, zoom, outputFile, N, S, W, E):
+def prepareStitchForPrint(mapInputFile, zoom, outputFile, N, S, W, E, scale=1):
     """
     This function will generate a stitched tile with labeled grid, a compass and a scale ruler.
-    Useful for printouts.
+    Useful for printouts. Use stitch_osm_tiles.render_atlas() for maps that are cut in sheets
+    of a paper size.
 
     mapfile: The source file to prepare for printout
     zoom: The zoom level that is used by this file
+    scale: The scale factor of the stitch, if it has been scaled from the resolution of the zoom level
 
     N, S, W, E are the corresponding edge coordinates of the mapInputFile.
+    """
+    canvas = decorate_map_for_print(pgmagick.Image(mapInputFile), zoom, N, S, W, E, scale)
+
+    # Save the file in the outputFile
+    canvas.write(outputFile)
+
+# ----------------------------------------------------------------------
+
+
+def decorate_map_for_print(img, zoom, N, S, W, E, scale=1, canvas_margin_px=144):
+    """
+    Returns a white canvas with the map image 'img' in the middle, a margin of canvas_margin_px pixels
+    around it with the labels of a semitransparent grid, a compass and a scale ruler.
 
-    # TODO: Add an option to let use choose paper-type friendly stitches (A4, A3 etc...)
-    #       Then the function should cut the maps in smaller part so that they can fit in the
-    #       chosen paper type without shrinking.
+    N, S, W, E are the corresponding edge coordinates of img, and scale is the scale factor of img,
+    if it has been scaled from the resolution of the zoom level.
     """
-    # Read the image
-    img = pgmagick.Image(mapInputFile)
     # Create a canvas
-    canvas_margin_px = 144
     canvas_width = img.columns() + canvas_margin_px * 2
     canvas_height = img.rows() + canvas_margin_px * 2
     canvas_geometry = pgmagick.Geometry(canvas_width, canvas_height)
@@ -2969,11 +8199,10 @@ def prepareStitchForPrint(mapInputFile, zoom, outputFile, N, S, W, E):
     # Add a ruler widget to indicate the scale of the map.
     latMidTile = S + (N - S) / 2.0
     ruler = DrawableScaleRuler(
-        canvas_margin_px + 100, img.rows() + canvas_margin_px - 100, latMidTile, zoom, 35)
+        canvas_margin_px + 100, img.rows() + canvas_margin_px - 100, latMidTile, zoom, 35, scale=scale)
     canvas.draw(ruler)
 
-    # Save the file in the outputFile
-    canvas.write(outputFile)
+    return canvas
 
 
 # ----------------------------------------------------------------------
@@ -2985,6 +8214,9 @@ if __name__ == '__main__':
     options = _command_Line_Options()
     # Configure logging
     _configureLogging(options.loglevel)
+    if options.query is not None:
+        query_stitch_index(options)
+        sys.exit(0)
     # Validate the command line arguments
     validate_arguments(options)
 
@@ -3000,18 +8232,56 @@ if __name__ == '__main__':
 
         for zoom in options.zoom_level:
             zoom_folder = os.path.join(options.project_folder, str(zoom))
-            if not os.path.isdir(zoom_folder):
-                os.mkdir(zoom_folder)
-
-            tileWorker = stitch_osm_tiles(zoom=zoom,
-                                          project_folder=options.project_folder,
-                                          tile_servers=options.tile_servers,
-                                          dyn_tile_url=options.dyn_tile_url,
-                                          saved_tile_format=options.tile_format,
-                                          saved_stitched_tile_format=options.stitched_tile_format,
-                                          max_stitch_dimensions=options.max_resolution_px,
-                                          parallelDownloadThreads=options.download_threads,
-                                          parallelStitchingThreads=options.stitching_threads)
+            os.makedirs(zoom_folder, exist_ok=True)
+
+            output_scale = options.output_scale
+            if options.paper_scale is not None:
+                output_scale = paper_output_scale(zoom, (options.lat1 + options.lat2) / 2.0, options.dpi, options.paper_scale)
+                if output_scale > 1:
+                    error_and_exit("Zoom level {} is not detailed enough for a 1:{} map at {} DPI (the stitches would"
+                                   " have to be scaled by {:.2f}). Use a higher zoom level.".format(
+                                       zoom, options.paper_scale, options.dpi, output_scale))
+                if output_scale < 1.0 / OUTPUT_SCALE_DENOMINATOR:
+                    error_and_exit("Zoom level {} is too detailed for a 1:{} map at {} DPI (the stitches would"
+                                   " have to be scaled by less than 1/{}). Use a lower zoom level.".format(
+                                       zoom, options.paper_scale, options.dpi, OUTPUT_SCALE_DENOMINATOR))
+                LOG.info("The stitches of zoom {} are scaled by {:.3f} for a 1:{} map at {} DPI.".format(
+                    zoom, output_scale, options.paper_scale, options.dpi))
+
+            # The existing zoom levels keep the layout that their tiles were downloaded with.
+            tile_layout = read_tile_layout(options.project_folder, zoom)
+            if tile_layout is None:
+                tile_layout = options.tile_layout or 'flat'
+            elif options.tile_layout and options.tile_layout != tile_layout and not options.migrate_tile_layout:
+                error_and_exit("The tiles of zoom {} have the '{}' layout, but --tile-layout is '{}'.\n"
+                               "Use --migrate-tile-layout {} to move the existing tiles to the new layout.".format(
+                                   zoom, tile_layout, options.tile_layout, options.tile_layout))
+
+            worker_options = dict(project_folder=options.project_folder,
+                                  tile_servers=options.tile_servers,
+                                  dyn_tile_url=options.dyn_tile_url,
+                                  saved_tile_format=options.tile_format,
+                                  saved_stitched_tile_format=options.stitched_tile_format,
+                                  max_stitch_dimensions=options.max_resolution_px,
+                                  parallelDownloadThreads=options.download_threads,
+                                  parallelStitchingThreads=options.stitching_threads,
+                                  tile_storage=options.tile_storage,
+                                  parallelOptimizerThreads=options.optimizer_threads,
+                                  verify_downloads=options.verify_downloads,
+                                  deep_verify_tiles=options.deep_verify_tiles,
+                                  stitch_engine=options.stitch_engine,
+                                  stitch_layout=options.stitch_layout,
+                                  tile_cache_mb=options.tile_cache_mb,
+                                  prefetch_depth=options.prefetch_depth,
+                                  stitch_executor=options.stitch_executor,
+                                  hash_tiles=options.hash_tiles,
+                                  encoder_threads=options.encoder_threads,
+                                  skip_uniform_stitches=options.skip_uniform_stitches,
+                                  output_scale=output_scale,
+                                  quantize_colors=options.quantize_colors,
+                                  dither=options.dither,
+                                  quantize_max_error=options.quantize_max_error)
+            tileWorker = stitch_osm_tiles(zoom=zoom, tile_layout=tile_layout, **worker_options)
 
             # TODO: All the stitch_osm_tiles class functions should operate on the same tiles as they
             #       operate on the same zoom level. This means that functions such as the stitch_tiles
@@ -3030,6 +8300,50 @@ if __name__ == '__main__':
             number_of_vertical_tiles = (tile_south - tile_north) + 1
             total_tiles = number_of_horizontal_tiles * number_of_vertical_tiles
 
+            if options.plan:
+                # The tile dimensions are read from the first tile. If it hasn't been downloaded
+                # yet, plan with the standard 256x256 pixels tiles.
+                if tileWorker._find_tile(tile_west, tile_north) is None:
+                    LOG.warning("The first tile of zoom {} hasn't been downloaded yet. Assuming 256x256 pixels tiles.".format(zoom))
+                    tileWorker._tile_width = tileWorker._tile_height = 256
+                print_(tileWorker.stitch_layout_plan(tile_west, tile_east, tile_north, tile_south))
+                continue
+
+            if options.preview is not None:
+                # Download (or reuse) the tiles of a much lower zoom level that covers the same area,
+                # and preview the planned stitches from them.
+                if options.preview == 'auto':
+                    preview_zoom = tileWorker.default_preview_zoom(tile_west, tile_east, tile_north, tile_south)
+                else:
+                    preview_zoom = max(0, zoom - options.preview)
+                if preview_zoom >= zoom:
+                    LOG.error("ERROR: There is no zoom level lower than zoom {} for the preview.".format(zoom))
+                    continue
+                previewWorker = stitch_osm_tiles(
+                    zoom=preview_zoom, tile_layout=read_tile_layout(options.project_folder, preview_zoom) or tile_layout,
+                    **worker_options)
+                preview_folder = os.path.join(options.project_folder, str(preview_zoom))
+                os.makedirs(preview_folder, exist_ok=True)
+                if not options.skip_downloading:
+                    levels = zoom - preview_zoom
+                    previewWorker.download_tiles(tile_west >> levels, tile_east >> levels,
+                                                 tile_north >> levels, tile_south >> levels, options.retry_failed)
+                tileWorker.preview_stitches(tile_west, tile_east, tile_north, tile_south, preview_zoom)
+                continue
+
+            if options.migrate_tile_layout:
+                if read_tile_layout(options.project_folder, zoom) is None:
+                    LOG.warning("Zoom {} has no configuration file in '{}'. Skipping the migration.".format(
+                        zoom, options.project_folder))
+                else:
+                    tileWorker.migrate_tile_layout(options.migrate_tile_layout)
+                continue
+
+            if options.overlay_project:
+                tileWorker.overlay_tiles(tile_west, tile_east, tile_north, tile_south, options.overlay_project,
+                                         options.overlay_destination, options.overlay_opacity)
+                continue
+
             # Prepare the configuration dictionary
             # The configuration dictionary a two levels nested dictionary. The top level key
             # is the config option, each top level key has dictionary value. The key of the dictionary value
@@ -3048,6 +8362,7 @@ if __name__ == '__main__':
             config_dict['overlay'] = {
                 options.tile_server_provider_layer: 1} if options.tile_server_provider_layer else {"": 0}
             config_dict['tile_format'] = {options.tile_format: 1}
+            config_dict['tile_storage'] = {options.tile_storage: 0}
             config_dict['stitched_tile_format'] = {
                 options.stitched_tile_format: 1}
             config_dict['zoom'] = {str(zoom): 1}
@@ -3069,17 +8384,30 @@ if __name__ == '__main__':
             config_dict['degrees_by_southern_most_tile'] = {
                 str(tileWorker.tilenums2deg(tile_east + 1, tile_south + 1)[0]): 1}
             config_dict['max_resolution'] = {str(options.max_resolution_px): 1}
+            config_dict['tile_layout'] = {tile_layout: 0}
 
             # Check if there is an existing config file, and if the necessary config
             # values do not match, warn the user and exit.
             zoom_conf, main_config_section = read_zoom_config(
                 zoom, config_dict)
 
-            # Write the configuration in a conf file
-            write_zoom_config(zoom_conf, config_dict, main_config_section)
-
-            if not options.skip_downloading and not options.only_calibrate:
-                download_logfile = tileWorker.download_tiles(
+            # Write the configuration in a conf file.
+            # Distributed workers that share the project folder only write the configuration
+            # if it doesn't exist yet, to avoid rewriting it concurrently with other workers.
+            if not options.worker or not os.path.isfile(zoom_conf):
+                write_zoom_config(zoom_conf, config_dict, main_config_section)
+
+            if options.worker:
+                tileWorker.download_tiles_distributed(
+                    tile_west, tile_east, tile_north, tile_south, options.retry_failed,
+                    wait_for_all=False, unit_size=options.work_unit_size, lease_timeout=options.lease_timeout)
+                continue
+            elif options.coordinator and not options.skip_downloading and not options.only_calibrate:
+                tileWorker.download_tiles_distributed(
+                    tile_west, tile_east, tile_north, tile_south, options.retry_failed,
+                    wait_for_all=True, unit_size=options.work_unit_size, lease_timeout=options.lease_timeout)
+            elif not options.skip_downloading and not options.only_calibrate:
+                tileWorker.download_tiles(
                     tile_west, tile_east, tile_north, tile_south, options.retry_failed)
             else:
                 LOG.info("Skipping tile downloading as requested.")
@@ -3095,6 +8423,8 @@ if __name__ == '__main__':
             config_dict['resolution_per_stitch'] = {'{}x{} px ({} MPixels)'.format(dimensions['horizontal_resolution_per_stitch'],
                                                                                    dimensions['vertical_resolution_per_stitch'],
                                                                                    round(dimensions['horizontal_resolution_per_stitch'] * dimensions['vertical_resolution_per_stitch'] / 1000000.0, 1)): 0}
+            config_dict['stitch_layout'] = {dimensions['layout']: 0}
+            config_dict['output_scale'] = {str(tileWorker.output_scale): 0}
             write_zoom_config(zoom_conf, config_dict, main_config_section)
 
             if not options.skip_stitching and not options.only_calibrate:
@@ -3107,6 +8437,20 @@ if __name__ == '__main__':
                 tileWorker.calibrate_tiles(
                     tile_west, tile_east, tile_north, tile_south)
 
+            if options.geotiff and not options.only_calibrate:
+                tileWorker.stitch_geotiff(
+                    tile_west, tile_east, tile_north, tile_south)
+
+            if options.pyramid and not options.only_calibrate:
+                tileWorker.export_pyramid(
+                    tile_west, tile_east, tile_north, tile_south,
+                    pyramid_format=options.pyramid, tile_size=options.pyramid_tile_size)
+
+            if options.atlas and not options.only_calibrate:
+                tileWorker.render_atlas(
+                    tile_west, tile_east, tile_north, tile_south, paper=options.atlas,
+                    orientation=options.atlas_orientation, dpi=options.dpi, overlap_mm=options.atlas_overlap)
+
             # If the user has asked to prepare paper friendly maps, do it now.
             if options.printout:
                 total_tiles = dimensions['horizontal_divide_by'] * \
@@ -3128,6 +8472,8 @@ if __name__ == '__main__':
                     options.project_folder, "paper_maps", str(zoom))
                 if not os.path.isdir(printer_maps_path):
                     os.makedirs(printer_maps_path)
+                # The same corners as in the OziExplorer map files of the stitches.
+                N, S, W, E = tileWorker.stitch_corners(tile_west, tile_north, dimensions)
                 for y in range(dimensions['horizontal_divide_by']):
                     for x in range(dimensions['vertical_divide_by']):
                         inputFile = os.path.join(options.project_folder, "stitched_maps", str(
@@ -3135,32 +8481,15 @@ if __name__ == '__main__':
                         outputFile = os.path.join(printer_maps_path, '{}_{}_print.{}'.format(
                             x, y, options.stitched_tile_format))
                         if os.path.isfile(inputFile):
-                            if not os.path.isfile(outputFile):
-                                mapCalibrationFile = os.path.join(
-                                    options.project_folder, "stitched_maps", str(zoom), '{}_{}.map'.format(x, y))
-                                if os.path.isfile(mapCalibrationFile):
-                                    r = quick_regexp()
-                                    N = S = W = E = None
-                                    with open(mapCalibrationFile) as f:
-                                        for line in f:
-                                            if r.search('MMPLL\s*,\s*1\s*,\s*(.+)\s*,\s*(.+)', line):
-                                                W = float(r.groups[0])
-                                                N = float(r.groups[1])
-                                            elif r.search('MMPLL\s*,\s*3\s*,\s*(.+)\s*,\s*(.+)', line):
-                                                E = float(r.groups[0])
-                                                S = float(r.groups[1])
-
-                                    if (N is None or S is None or W is None or E is None):
-                                        error_and_exit("Could not read the coordinates from the map file '{}' properly.".format(
-                                            mapCalibrationFile))
-
-                                    prepareStitchForPrint(
-                                        inputFile, zoom, outputFile, N, S, W, E)
-                                    pbar.currval += 1
-                                else:
-                                    error_and_exit("Looked for {}, but I could not locate the specified map calibration file.\n"
-                                                   "The map calibration file is needed in order to calculate the scale of the map.".format(mapCalibrationFile))
+                            # The paper map is generated again if its stitch was generated again.
+                            if not os.path.isfile(outputFile) or os.path.getmtime(outputFile) < os.path.getmtime(inputFile):
+                                prepareStitchForPrint(
+                                    inputFile, zoom, outputFile, float(N[x, y]), float(S[x, y]), float(W[x, y]),
+                                    float(E[x, y]), tileWorker.output_scale)
+                                pbar.currval += 1
                             pbar.update(pbar.currval)
+                        elif options.skip_uniform_stitches:
+                            LOG.debug("File '{}' not found. It is skipped as a single color stitch.".format(inputFile))
                         else:
                             error_and_exit(
                                 "File '{}' not found.\nYou need to stitch the necessary files before creating paper friendly maps.".format(inputFile))